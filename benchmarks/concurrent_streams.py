@@ -0,0 +1,78 @@
+"""
+Concurrent chat streams writing through the sync and the async database layer.
+
+    python -m benchmarks.concurrent_streams --streams 20 --ticks 30
+
+Each stream sleeps for --tick-seconds (standing in for the LLM) and then upserts its
+message, like game.assistant_generate does without write-behind. A heartbeat task
+measures how long the event loop is blocked.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from sqlmodel import SQLModel
+
+from rngesus import async_database, database
+from rngesus.models import Chat
+
+
+async def stream(campaign_id: int, ticks: int, tick_seconds: float, use_async: bool):
+    chat = Chat(campaign_id=campaign_id, user_type="assistant", message="")
+    for i in range(ticks):
+        await asyncio.sleep(tick_seconds)
+        chat.message += f"token {i} "
+        if use_async:
+            chat = await async_database.upsert_chat_message(chat)
+        else:
+            chat = database.upsert_chat_message(chat)
+
+
+async def heartbeat(interval: float, lags: list):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(streams: int, ticks: int, tick_seconds: float, use_async: bool):
+    lags = []
+    beat = asyncio.create_task(heartbeat(0.005, lags))
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[stream(i, ticks, tick_seconds, use_async) for i in range(streams)]
+    )
+    elapsed = time.perf_counter() - start
+    beat.cancel()
+    lags.sort()
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "writes_per_s": round(streams * ticks / elapsed, 1),
+        "loop_lag_p99_ms": round(lags[int(len(lags) * 0.99)] * 1000, 2) if lags else 0,
+        "loop_lag_max_ms": round(lags[-1] * 1000, 2) if lags else 0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--ticks", type=int, default=30)
+    parser.add_argument("--tick-seconds", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.engine = database.create_database_engine(f"sqlite:///{tmp}/bench.db")
+        SQLModel.metadata.create_all(database.engine)
+        for use_async in (False, True):
+            result = asyncio.run(
+                run(args.streams, args.ticks, args.tick_seconds, use_async)
+            )
+            print("async" if use_async else "sync ", result)
+
+
+if __name__ == "__main__":
+    main()
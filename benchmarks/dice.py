@@ -0,0 +1,95 @@
+"""
+Speed and accuracy of the dice engine.
+
+    python -m benchmarks.dice --times 1000000
+
+For each expression this times parsing it, rolling it once the way a chat marker or
+the API does, rolling it `--times` times in one batch (or as many as one call may), and
+working out its exact distribution, cold and from the cache. The last columns are the
+total variation distance between the batch's totals and the exact distribution, and
+the distance expected from sampling alone; the script exits with 1 if any distance is
+more than `--tolerance` times the expected one.
+"""
+import argparse
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from rngesus import dice
+
+EXPRESSIONS = [
+    "d20",
+    "3d6+2",
+    "4d6kh3",
+    "d20adv+5",
+    "d20dis",
+    "2d10!-1",
+    "d%",
+    "8d6dl2",
+    "5d8kl2+1d4",
+    "10d10kh3",
+    "100d6",
+    "2d6!kh1",
+]
+
+
+def us(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1e6
+
+
+def distance(expression: str, times: int, rng: np.random.Generator) -> tuple:
+    low, probabilities = dice.outcomes(expression)
+    rolled = dice.totals(expression, times, rng) - low
+    observed = np.bincount(rolled, minlength=len(probabilities)) / times
+    off = np.abs(observed[: len(probabilities)] - probabilities).sum() / 2
+    # each count is off by about sqrt(2 p / (pi times)) on average
+    expected = np.sqrt(2 * probabilities / (np.pi * times)).sum() / 2
+    return float(off), float(expected)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--times", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--tolerance", type=float, default=3)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    print(
+        f"{'expression':>12} {'parse us':>9} {'roll us':>8} {'batch ms':>9} "
+        f"{'rolls/s':>9} {'exact ms':>9} {'cached us':>10} {'distance':>9} "
+        f"{'expected':>9}"
+    )
+    failed = False
+    for expression in EXPRESSIONS:
+        start = time.perf_counter()
+        parsed = dice.parse(expression)
+        parse = (time.perf_counter() - start) * 1e6
+        one = us(lambda: dice.roll(expression, rng=rng), args.repeat)
+        # one call rolls at most MAX_BATCH dice
+        times = min(args.times, dice.MAX_BATCH // sum(d.count for d in parsed.dice))
+        start = time.perf_counter()
+        dice.totals(expression, times, rng)
+        batch = time.perf_counter() - start
+        start = time.perf_counter()
+        dice.distribution(expression)
+        exact = (time.perf_counter() - start) * 1000
+        cached = us(lambda: dice.outcomes(expression), args.repeat)
+        off, expected = distance(expression, times, rng)
+        failed |= off > args.tolerance * expected
+        print(
+            f"{expression:>12} {parse:>9.1f} {one:>8.1f} {batch * 1000:>9.1f} "
+            f"{times / batch:>9.2g} {exact:>9.2f} {cached:>10.1f} {off:>9.4f} "
+            f"{expected:>9.4f}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
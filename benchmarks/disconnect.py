@@ -0,0 +1,152 @@
+"""
+What happens to a chat reply when the client disconnects halfway through.
+
+    python -m benchmarks.disconnect --policy abort --grace 0.5 --max-seconds 2
+
+Starts the app with uvicorn and the mock LLM backend on a fresh database, requests a
+chat reply, reads its first update and drops the connection. With --policy abort it
+reports how long the mock's LLM stream stayed open afterwards and fails (exit code 1)
+if that is longer than --max-seconds or nothing was saved of the reply. With --policy
+finish it fails unless the reply was generated and saved in full.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+directory = tempfile.mkdtemp()
+os.environ["LLM_BACKEND"] = "mock"
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'disconnect.db')}"
+os.environ.setdefault("SILENT_GUIDANCE", "1")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--policy", choices=["abort", "finish"], default="abort")
+    parser.add_argument("--grace", type=float, default=0.5)
+    parser.add_argument("--max-seconds", type=float, default=2)
+    parser.add_argument("--tokens-per-second", type=float, default=20)
+    parser.add_argument("--max-tokens", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8766)
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ["GENERATION_ON_DISCONNECT"] = args.policy
+os.environ["GENERATION_ABORT_GRACE_SECONDS"] = str(args.grace)
+os.environ["MOCK_LLM_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+os.environ["MOCK_LLM_LATENCY_SECONDS"] = "0.1"
+os.environ["MOCK_LLM_MAX_TOKENS"] = str(args.max_tokens)
+os.environ["JOB_WORKERS"] = "0"
+
+import guidance
+import httpx
+import uvicorn
+
+from rngesus import database, generations, llm
+from rngesus.app import app
+from rngesus.models import Campaign, Character
+
+
+def seed() -> int:
+    campaign = database.upsert_campaign(
+        Campaign(
+            prompt="a heist in a floating city",
+            title="Skyward",
+            description="A heist game.",
+            summary="A heist game.",
+            character_classes=["Thief"],
+            character_types=["Human"],
+            attributes=["Agility"],
+            # a scenario means the reply is the only thing the program generates
+            scenario="Rob the sky bank.",
+        )
+    )
+    database.upsert_character(
+        Character(
+            campaign_id=campaign.id,
+            name="Vex",
+            character_class="Thief",
+            character_type="Human",
+            backstory="Grew up on the docks.",
+            attributes={"Agility": 15},
+            primary_goal="Get rich",
+            inventory=[],
+            activated=1,
+        )
+    )
+    return campaign.id
+
+
+def wait_for(condition, timeout: float) -> float | None:
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return time.monotonic() - start
+        time.sleep(0.005)
+    return None
+
+
+def run(base_url: str, campaign_id: int) -> bool:
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        with client.stream(
+            "PUT",
+            f"/api/campaigns/{campaign_id}/chat",
+            params={"user_message": "I pick the lock"},
+        ) as response:
+            response.raise_for_status()
+            generation_id = response.headers["X-Generation-Id"]
+            next(response.iter_lines())
+            if not wait_for(lambda: guidance.llm.streaming, 10):
+                print("the LLM stream did not start")
+                return False
+    # leaving the block closed the connection
+    generation = generations.get(generation_id)
+    full = args.max_tokens / args.tokens_per_second
+    if args.policy == "abort":
+        closed = wait_for(lambda: not guidance.llm.streaming, full)
+        saved = database.get_chat_history(campaign_id)[-1].message
+        if closed is None:
+            print(f"LLM stream still open {full:.1f}s after the client left")
+            return False
+        print(
+            f"LLM stream closed {closed:.3f}s after the client left "
+            f"(grace {args.grace}s), aborted={generation.aborted}, "
+            f"{len(saved.split())} of {args.max_tokens} words saved"
+        )
+        return closed <= args.max_seconds and generation.aborted and bool(saved)
+    finished = wait_for(lambda: generation.done, full + 5)
+    saved = database.get_chat_history(campaign_id)[-1].message
+    if finished is None:
+        print(f"generation still running {full + 5:.1f}s after the client left")
+        return False
+    print(
+        f"generation finished {finished:.1f}s after the client left, "
+        f"aborted={generation.aborted}, {len(saved.split())} of "
+        f"{args.max_tokens} words saved"
+    )
+    return not generation.aborted and len(saved.split()) == args.max_tokens
+
+
+def main() -> None:
+    database.main()
+    campaign_id = seed()
+    llm.configure()
+    server = uvicorn.Server(
+        uvicorn.Config(app, port=args.port, log_level="warning", lifespan="on")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        ok = run(f"http://127.0.0.1:{args.port}", campaign_id)
+    finally:
+        server.should_exit = True
+        thread.join()
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Import time of the entry points, checked against a budget.
+
+    python -m benchmarks.import_time --budget-seconds 1.0
+
+Imports each module in a fresh interpreter with `-X importtime`, --runs times, and
+reports the fastest run along with the slowest imports under it. Fails (exit code 1)
+if a module takes longer than the budget or pulls in one of the LLM libraries, which
+are only meant to be imported once something generates text.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+MODULES = ["rngesus.app", "rngesus.api", "rngesus.jobs"]
+LAZY = ["guidance", "openai", "tiktoken"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-seconds", type=float, default=1.0)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    return parser.parse_args()
+
+
+def measure(module: str) -> Tuple[float, Dict[str, int], List[str]]:
+    """Total seconds, cumulative microseconds per imported module, and lazy leaks."""
+    check = f"import sys, {module}; print(*[m for m in {LAZY!r} if m in sys.modules])"
+    env = {k: v for k, v in os.environ.items() if k != "OPENAI_API_KEY"}
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    cumulative = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, total, name = line[len("import time:") :].split("|")
+        cumulative[name.strip()] = int(total)
+    return cumulative[module] / 1e6, cumulative, out.stdout.split()
+
+
+def main() -> None:
+    args = parse_args()
+    failed = False
+    for module in args.modules:
+        seconds, cumulative, leaked = min(
+            (measure(module) for _ in range(args.runs)), key=lambda r: r[0]
+        )
+        over = seconds > args.budget_seconds
+        status = "over budget" if over else "ok"
+        if leaked:
+            status += f", imported {', '.join(leaked)}"
+        print(f"{module:<20} {seconds:.3f}s  {status}")
+        # top-level packages only, since nested imports are included in their parent
+        top = sorted(
+            ((t, n) for n, t in cumulative.items() if "." not in n and n != module),
+            reverse=True,
+        )[: args.top]
+        for total, name in top:
+            print(f"    {name:<28} {total / 1e6:.3f}s")
+        failed = failed or over or bool(leaked)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Load test of the streaming endpoints against the mock LLM backend.
+
+    python -m benchmarks.load --sessions 20 --tokens-per-second 40 --latency 0.5
+
+Starts the app with uvicorn on a fresh database in a background thread, then runs
+--sessions concurrent sessions that each create a campaign, roll a character and send
+--turns chat messages. Reports p50/p99 time to first byte and total time per endpoint,
+throughput, and how many rows the database wrote.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+directory = tempfile.mkdtemp()
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+os.environ["LLM_BACKEND"] = "mock"
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'load.db')}"
+os.environ.setdefault("SILENT_GUIDANCE", "1")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--tokens-per-second", type=float, default=40)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--max-tokens", type=int, default=120)
+    parser.add_argument("--port", type=int, default=8765)
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ["MOCK_LLM_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+os.environ["MOCK_LLM_LATENCY_SECONDS"] = str(args.latency)
+os.environ["MOCK_LLM_MAX_TOKENS"] = str(args.max_tokens)
+# one worker per session so campaign creation is not queued behind the others
+os.environ.setdefault("JOB_WORKERS", str(args.sessions))
+
+import httpx
+import uvicorn
+from sqlalchemy import event
+
+from rngesus import database
+from rngesus.app import app
+
+writes: Dict[str, int] = defaultdict(int)
+
+
+@event.listens_for(database.engine, "before_cursor_execute")
+def count_writes(conn, cursor, statement, parameters, context, executemany) -> None:
+    verb = statement.lstrip().split(" ", 1)[0].upper()
+    if verb in ("INSERT", "UPDATE", "DELETE"):
+        writes[verb] += len(parameters) if executemany else 1
+
+
+class Timings:
+    def __init__(self):
+        self.ttfb: Dict[str, List[float]] = defaultdict(list)
+        self.total: Dict[str, List[float]] = defaultdict(list)
+        self.bytes = 0
+
+
+async def timed(client: httpx.AsyncClient, timings: Timings, name: str, *a, **kw):
+    start = time.perf_counter()
+    body = b""
+    async with client.stream(*a, **kw) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            if not body:
+                timings.ttfb[name].append(time.perf_counter() - start)
+            body += chunk
+    timings.total[name].append(time.perf_counter() - start)
+    timings.bytes += len(body)
+    return body
+
+
+async def session(client: httpx.AsyncClient, timings: Timings, n: int, turns: int):
+    headers = {"X-Client-Id": f"session-{n}"}
+    body = await timed(
+        client,
+        timings,
+        "POST /api/campaigns",
+        "POST",
+        "/api/campaigns",
+        json={"description": f"load test campaign {n}"},
+        headers=headers,
+    )
+    campaign_id = httpx.Response(200, content=body.splitlines()[-1]).json()["id"]
+    body = await timed(
+        client,
+        timings,
+        "POST /api/characters",
+        "POST",
+        "/api/characters",
+        params={"campaign_id": campaign_id},
+    )
+    character_id = httpx.Response(200, content=body.splitlines()[-1]).json()["id"]
+    database.activate_character(character_id, int(time.time() * 1000))
+    for turn in range(turns):
+        await timed(
+            client,
+            timings,
+            "PUT /api/campaigns/{id}/chat",
+            "PUT",
+            f"/api/campaigns/{campaign_id}/chat",
+            params={"user_message": f"turn {turn}"},
+        )
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+async def run(base_url: str) -> None:
+    timings = Timings()
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[session(client, timings, n, args.turns) for n in range(args.sessions)]
+        )
+        elapsed = time.perf_counter() - start
+    requests = sum(len(v) for v in timings.total.values())
+    print(
+        f"{'endpoint':<30} {'n':>4} {'ttfb p50':>9} {'ttfb p99':>9} "
+        f"{'total p50':>10} {'total p99':>10}"
+    )
+    for name, totals in timings.total.items():
+        ttfb = timings.ttfb[name]
+        print(
+            f"{name:<30} {len(totals):>4} {statistics.median(ttfb):>9.3f} "
+            f"{percentile(ttfb, 0.99):>9.3f} {statistics.median(totals):>10.3f} "
+            f"{percentile(totals, 0.99):>10.3f}"
+        )
+    print(
+        f"\n{requests} requests in {elapsed:.1f}s: {requests / elapsed:.1f} req/s, "
+        f"{timings.bytes / elapsed / 1024:.1f} KiB/s streamed"
+    )
+    print(
+        f"database writes: {dict(writes)} "
+        f"({sum(writes.values()) / requests:.1f} per request)"
+    )
+
+
+def main() -> None:
+    server = uvicorn.Server(
+        uvicorn.Config(app, port=args.port, log_level="warning", lifespan="on")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    writes.clear()
+    try:
+        asyncio.run(run(f"http://127.0.0.1:{args.port}"))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
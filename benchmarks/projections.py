@@ -0,0 +1,208 @@
+"""
+Full-row reads against column projections on a seeded database.
+
+    python -m benchmarks.projections --campaigns 10000 --lookups 2000
+
+Seeds a fresh SQLite file with --campaigns campaigns (multi-kilobyte descriptions and
+JSON columns) and --characters-per-campaign characters each, then compares, per call:
+the campaign list built with and without pydantic validation, single campaign and
+character reads as full rows and with `?fields=`, the per-campaign character list,
+and the active characters a chat turn loads. The last table goes through the API.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from typing import Callable
+
+directory = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'projections.db')}"
+os.environ.setdefault("JOB_WORKERS", "0")
+
+import httpx
+from sqlmodel import Session, select
+
+from rngesus import database
+from rngesus.models import (
+    Campaign,
+    CampaignSummary,
+    CampaignSummaryTuple,
+    Character,
+    field_columns,
+)
+
+WORDS = "ancient bold crimson dragon ember fable goblin harbor iron jade keep".split()
+
+
+def text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed(campaigns: int, characters: int) -> None:
+    rng = random.Random(0)
+    with Session(database.engine) as session:
+        for i in range(campaigns):
+            session.add(
+                Campaign(
+                    prompt=text(rng, 20),
+                    title=f"Campaign {i}",
+                    description=text(rng, 800),
+                    summary=text(rng, 40),
+                    character_classes=[text(rng, 2) for _ in range(6)],
+                    character_types=[text(rng, 2) for _ in range(6)],
+                    attributes=[text(rng, 1) for _ in range(6)],
+                    scenario=text(rng, 150),
+                )
+            )
+        session.commit()
+        for campaign_id in range(1, campaigns + 1):
+            for n in range(characters):
+                session.add(
+                    Character(
+                        campaign_id=campaign_id,
+                        name=f"Hero {n}",
+                        character_class=text(rng, 2),
+                        character_type=text(rng, 2),
+                        backstory=text(rng, 200),
+                        attributes={w: rng.randint(1, 18) for w in WORDS[:6]},
+                        primary_goal=text(rng, 20),
+                        inventory=[text(rng, 2) for _ in range(10)],
+                        activated=1 if n % 2 == 0 else None,
+                    )
+                )
+        session.commit()
+
+
+def validated_summaries():
+    # what get_campaign_summaries did before it skipped validation
+    with Session(database.engine) as session:
+        rows = session.exec(select(*CampaignSummaryTuple)).all()
+        return [CampaignSummary(id=r[0], title=r[1], summary=r[2]) for r in rows]
+
+
+def full_characters(campaign_id: int):
+    with Session(database.engine) as session:
+        query = session.query(Character).filter(Character.campaign_id == campaign_id)
+        return query.all()
+
+
+def timed(fn: Callable[[int], object], ids: list) -> float:
+    start = time.perf_counter()
+    for id in ids:
+        fn(id)
+    return (time.perf_counter() - start) / len(ids) * 1e6
+
+
+def report(title: str, rows: list) -> None:
+    print(f"\n{title}")
+    print(f"{'':<34} {'full us':>10} {'projected us':>13} {'speedup':>8}")
+    for name, full, projected in rows:
+        print(f"{name:<34} {full:>10.1f} {projected:>13.1f} {full / projected:>7.1f}x")
+
+
+async def api_rows(ids: list) -> list:
+    from rngesus.app import app
+
+    async def per_request(client: httpx.AsyncClient, url: str) -> float:
+        start = time.perf_counter()
+        for id in ids:
+            (await client.get(url.format(id=id))).raise_for_status()
+        return (time.perf_counter() - start) / len(ids) * 1e6
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        start = time.perf_counter()
+        (await client.get("/api/campaigns")).raise_for_status()
+        full_list = (time.perf_counter() - start) * 1e6
+        start = time.perf_counter()
+        (await client.get("/api/campaigns?fields=id,title")).raise_for_status()
+        projected_list = (time.perf_counter() - start) * 1e6
+        return [
+            (
+                "GET /api/campaigns/{id}",
+                await per_request(client, "/api/campaigns/{id}"),
+                await per_request(client, "/api/campaigns/{id}?fields=id,title"),
+            ),
+            (
+                "GET /api/characters?campaign_id",
+                await per_request(client, "/api/characters?campaign_id={id}"),
+                await per_request(
+                    client, "/api/characters?campaign_id={id}&fields=id,name"
+                ),
+            ),
+            ("GET /api/campaigns (whole list)", full_list, projected_list),
+        ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--campaigns", type=int, default=10000)
+    parser.add_argument("--characters-per-campaign", type=int, default=4)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    database.main()
+    start = time.perf_counter()
+    seed(args.campaigns, args.characters_per_campaign)
+    size = os.path.getsize(database.engine.url.database) / 1024 / 1024
+    print(
+        f"seeded {args.campaigns} campaigns in {time.perf_counter() - start:.1f}s "
+        f"({size:.0f} MiB)"
+    )
+
+    rng = random.Random(1)
+    ids = [rng.randint(1, args.campaigns) for _ in range(args.lookups)]
+    character_ids = [
+        rng.randint(1, args.campaigns * args.characters_per_campaign)
+        for _ in range(args.lookups)
+    ]
+    campaign_columns = field_columns(Campaign, "id,title")
+    character_columns = field_columns(Character, "id,name,character_class")
+
+    start = time.perf_counter()
+    validated_summaries()
+    validated = (time.perf_counter() - start) * 1e6
+    start = time.perf_counter()
+    database.get_campaign_summaries()
+    constructed = (time.perf_counter() - start) * 1e6
+
+    report(
+        "database functions",
+        [
+            ("campaign summaries (whole list)", validated, constructed),
+            (
+                "campaign by id",
+                timed(database.get_campaign, ids),
+                timed(
+                    lambda id: database.get_campaign_fields(id, campaign_columns), ids
+                ),
+            ),
+            (
+                "character by id",
+                timed(database.get_character, character_ids),
+                timed(
+                    lambda id: database.get_character_fields(id, character_columns),
+                    character_ids,
+                ),
+            ),
+            (
+                "characters of a campaign",
+                timed(full_characters, ids),
+                timed(
+                    lambda id: database.get_characters_fields(id, character_columns),
+                    ids,
+                ),
+            ),
+            (
+                "active characters for a chat turn",
+                timed(database.get_active_characters_in_campaign, ids),
+                timed(database.get_active_character_prompts, ids),
+            ),
+        ],
+    )
+    report("through the API", asyncio.run(api_rows(ids[: args.lookups // 4])))
+
+
+if __name__ == "__main__":
+    main()
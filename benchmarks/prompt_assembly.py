@@ -0,0 +1,178 @@
+"""
+Time to assemble a chat prompt against the length of the chat history.
+
+    python -m benchmarks.prompt_assembly --turns 0 10 50 200 1000 --repeat 20
+
+For each history length (older turns are covered by a summary, as they are once a
+campaign has been running for a while) this times the context window, rendering the
+system prompt from scratch and fetching it from the cache, and guidance rendering the
+chat program up to its LLM call: before, with the system block rendered by handlebars
+on every turn, and now, with the cached system prompt. The last column checks that
+the prompt starts with the same bytes as the one for the previous history length,
+which is what provider-side prefix caching needs.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault("SILENT_GUIDANCE", "1")
+
+import guidance
+
+from rngesus import game, llm
+from rngesus.game import ChatState
+from rngesus.models import Campaign, CharacterPrompt, Chat, ChatSummary
+from rngesus.rngesus import (
+    CHARACTER_PROMPT,
+    SYSTEM_PROMPT,
+    build_window,
+    gen_chat,
+    prompt_messages,
+    render_system_prompt,
+)
+
+WORDS = "ancient bold crimson dragon ember fable goblin harbor iron jade keep".split()
+
+
+class Recorder(guidance.llms.Mock):
+    """Answers every call with nothing, remembering when it was called and with what."""
+
+    def __call__(self, prompt, *args, **kwargs):
+        self.called = time.perf_counter()
+        self.prompt = prompt
+        return super().__call__(prompt, *args, **kwargs)
+
+
+def handlebars_chat() -> llm.Program:
+    # the chat program as it was, with the system block filled in by handlebars
+    character = CHARACTER_PROMPT.replace("{number}", "{{add 1 @index}}")
+    for field in CharacterPrompt.__fields__:
+        character = character.replace(f"{{{field}}}", f"{{{{this.{field}}}}}")
+    system = SYSTEM_PROMPT.replace(
+        "{characters}", "{{#each characters}}" + character + "{{/each}}"
+    )
+    for name in ("title", "description", "character_count"):
+        system = system.replace(f"{{{name}}}", f"{{{{{name}}}}}")
+    return llm.Program(gen_chat.template.replace("{{system_prompt}}", system))
+
+
+def text(words: int, seed: int) -> str:
+    return " ".join(WORDS[(seed + i * 7) % len(WORDS)] for i in range(words))
+
+
+def state(turns: int) -> ChatState:
+    campaign = Campaign(
+        id=1, title="Skyward", description=text(1200, 1), summary=text(60, 2)
+    )
+    characters = [
+        CharacterPrompt(
+            id=n,
+            name=f"Hero {n}",
+            character_class="Thief",
+            character_type="Human",
+            attributes={w: 10 + n for w in WORDS[:6]},
+            backstory=text(200, n),
+            primary_goal=text(20, n),
+        )
+        for n in range(4)
+    ]
+    dialog = [
+        Chat(
+            id=i + 1,
+            campaign_id=1,
+            user_type="user" if i % 2 else "assistant",
+            message=text(80, i),
+        )
+        for i in range(turns)
+    ]
+    summary = None
+    if turns > 20:
+        summary = ChatSummary(
+            campaign_id=1, through_chat_id=turns - 20, summary=text(300, 3)
+        )
+    return ChatState(
+        campaign=campaign, characters=characters, dialog=dialog, summary=summary
+    )
+
+
+def per_call_ms(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+async def guidance_ms(program: llm.Program, repeat: int, **kwargs) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await program(async_mode=True, **kwargs)
+        times.append(guidance.llm.called - start)
+    return statistics.median(times) * 1000
+
+
+async def run(turn_counts, repeat: int) -> None:
+    llm.configure()
+    before = handlebars_chat()
+    print(
+        f"{'turns':>6} {'window ms':>10} {'system cold ms':>15} "
+        f"{'system cached ms':>17} {'guidance before ms':>19} {'guidance now ms':>16} "
+        f"{'prompt KiB':>11} {'same prefix':>12}"
+    )
+    previous = None
+    for turns in turn_counts:
+        chat = state(turns)
+        window = build_window(chat.dialog, chat.summary)
+        history = [m.dict() for m in prompt_messages(window)]
+        game.system_prompts.clear()
+        prompt = game.system_prompt(chat)
+        handlebars = await guidance_ms(
+            before,
+            repeat,
+            title=chat.campaign.title,
+            description=chat.campaign.description,
+            character_count=len(chat.characters),
+            characters=[c.dict() for c in chat.characters],
+            previous_messages=history,
+            history_summary=window.summary,
+            recalled_messages=[],
+            dice_tray="",
+        )
+        cached = await guidance_ms(
+            gen_chat,
+            repeat,
+            system_prompt=prompt,
+            previous_messages=history,
+            history_summary=window.summary,
+            recalled_messages=[],
+            dice_tray="",
+        )
+        system_end = guidance.llm.prompt.index(prompt) + len(prompt)
+        same = previous is None or guidance.llm.prompt[:system_end] == previous
+        previous = guidance.llm.prompt[:system_end]
+        assemble = lambda: prompt_messages(build_window(chat.dialog, chat.summary))
+        cold = lambda: render_system_prompt(chat.campaign, chat.characters)
+        print(
+            f"{turns:>6} {per_call_ms(assemble, repeat):>10.3f} "
+            f"{per_call_ms(cold, repeat):>15.3f} "
+            f"{per_call_ms(lambda: game.system_prompt(chat), repeat):>17.4f} "
+            f"{handlebars:>19.2f} {cached:>16.2f} "
+            f"{len(guidance.llm.prompt) / 1024:>11.1f} {'yes' if same else 'NO':>12}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[0, 10, 50, 200, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    guidance.llm = Recorder("")
+    asyncio.run(run(args.turns, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
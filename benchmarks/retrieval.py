@@ -0,0 +1,133 @@
+"""
+Query latency of the chat recall index against the size of a campaign's history.
+
+    python -m benchmarks.retrieval --messages 1000 10000 100000 --queries 200
+
+For each history length this builds a fresh index from synthetic messages (Zipf
+distributed words, with a planted phrase every 1000 messages), then times the first
+search (which loads the document frequencies from the memmapped files), warm searches,
+adding a message the way the database listener does, rewriting the latest message as
+a streamed reply does, and the whole `recall` for a chat turn. The last columns check
+that the planted phrases are found.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+directory = tempfile.mkdtemp()
+os.environ["RETRIEVAL_PATH"] = directory
+
+import numpy as np
+
+from rngesus import retrieval
+from rngesus.models import Chat
+
+
+def dialog(messages: int, rng: np.random.Generator) -> list:
+    vocabulary = np.array([f"w{i}" for i in range(20000)])
+    lengths = rng.integers(20, 150, messages)
+    words = vocabulary[np.minimum(rng.zipf(1.2, lengths.sum()), 20000) - 1]
+    chats, at = [], 0
+    for i, length in enumerate(lengths):
+        text = " ".join(words[at : at + length])
+        at += length
+        if i % 1000 == 0:
+            text += f" the planted relic {planted(i)}"
+        chats.append(
+            Chat(
+                id=i + 1,
+                campaign_id=0,
+                user_type="user" if i % 2 else "assistant",
+                message=text,
+            )
+        )
+    return chats
+
+
+def planted(i: int) -> str:
+    return f"sunstone{i} moonkey{i}"
+
+
+def ms(fn, repeat: int) -> tuple:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times) * 1000, times[int(len(times) * 0.95)] * 1000
+
+
+def run(campaign_id: int, messages: int, queries: int) -> None:
+    rng = np.random.default_rng(campaign_id)
+    chats = dialog(messages, rng)
+    index = retrieval.index(campaign_id)
+    start = time.perf_counter()
+    index.catch_up(chats)
+    build = time.perf_counter() - start
+    size = sum(
+        os.path.getsize(path) for path in (index.entries_path, index.chunks_path)
+    )
+    queries_text = [chats[i].message for i in rng.integers(0, messages, queries)]
+
+    start = time.perf_counter()
+    index.search(queries_text[0], 4, messages + 1)
+    cold = (time.perf_counter() - start) * 1000
+    texts = iter(queries_text * 2)
+    warm, warm95 = ms(lambda: index.search(next(texts), 4, messages + 1), queries)
+
+    ids = iter(range(messages + 1, messages + 1 + queries))
+    add, _ = ms(
+        lambda: index.add(
+            Chat(id=next(ids), campaign_id=campaign_id, user_type="user", message="hi")
+        ),
+        queries,
+    )
+    latest = Chat(
+        id=messages + queries + 1,
+        campaign_id=campaign_id,
+        user_type="assistant",
+        message="",
+    )
+    words = iter(chats[0].message.split() * queries)
+
+    def stream() -> None:
+        latest.message += " " + next(words)
+        index.add(latest)
+
+    rewrite, _ = ms(stream, queries)
+    chats += [latest]
+    recent = chats[-4:]
+    recall, _ = ms(lambda: retrieval.recall(campaign_id, chats, recent), 20)
+
+    planted_ids = range(0, messages, 1000)
+    found = sum(
+        any(hit[0] == i + 1 for hit in index.search(planted(i), 4, messages + 1))
+        for i in planted_ids
+    )
+    print(
+        f"{messages:>9} {build:>8.1f} {size / 1024 / 1024:>8.1f} {cold:>8.1f} "
+        f"{warm:>8.2f} {warm95:>8.2f} {add:>8.2f} {rewrite:>10.2f} {recall:>9.2f} "
+        f"{found:>5}/{len(planted_ids)}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--messages", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    print(
+        f"{'messages':>9} {'build s':>8} {'MiB':>8} {'cold ms':>8} {'warm ms':>8} "
+        f"{'p95 ms':>8} {'add ms':>8} {'rewrite ms':>10} {'recall ms':>9} {'found':>7}"
+    )
+    for campaign_id, messages in enumerate(args.messages, 1):
+        run(campaign_id, messages, args.queries)
+
+
+if __name__ == "__main__":
+    main()
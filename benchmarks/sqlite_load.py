@@ -0,0 +1,90 @@
+"""
+Campaign list reads while several chats stream into the same SQLite file.
+
+    python -m benchmarks.sqlite_load --writers 4 --readers 8 --seconds 5
+
+Writer threads append to and update chat rows the way a streaming reply does, while
+reader threads run the /api/campaigns query. The run is repeated with SQLAlchemy's
+default engine and with database.create_database_engine (WAL, pragmas, pooling).
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from sqlmodel import SQLModel, create_engine
+
+from rngesus import database
+from rngesus.models import Campaign, Chat
+
+
+def writer(stop: threading.Event, campaign_id: int, counts: list):
+    chat = None
+    while not stop.is_set():
+        if chat is None or len(chat.message) > 2000:
+            chat = Chat(campaign_id=campaign_id, user_type="assistant", message="")
+        chat.message += "more words "
+        chat = database.upsert_chat_message(chat)
+        counts.append(1)
+
+
+def reader(stop: threading.Event, latencies: list, errors: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            database.get_campaign_summaries()
+        except Exception as e:
+            errors.append(e)
+        latencies.append(time.perf_counter() - start)
+
+
+def run(engine, writers: int, readers: int, seconds: float) -> dict:
+    database.engine = engine
+    SQLModel.metadata.create_all(engine)
+    for i in range(50):
+        database.upsert_campaign(Campaign(title=f"Campaign {i}", summary="x" * 200))
+    stop = threading.Event()
+    writes, latencies, errors = [], [], []
+    threads = [
+        threading.Thread(target=writer, args=(stop, i, writes)) for i in range(writers)
+    ] + [
+        threading.Thread(target=reader, args=(stop, latencies, errors))
+        for _ in range(readers)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return {
+        "reads_per_s": round(len(latencies) / seconds),
+        "read_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "read_p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+        "writes_per_s": round(len(writes) / seconds),
+        "errors": len(errors),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engines = {
+            "default": create_engine(f"sqlite:///{tmp}/default.db"),
+            "tuned": database.create_database_engine(f"sqlite:///{tmp}/tuned.db"),
+        }
+        for name, engine in engines.items():
+            print(name, run(engine, args.writers, args.readers, args.seconds))
+
+
+if __name__ == "__main__":
+    main()
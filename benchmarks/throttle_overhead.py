@@ -0,0 +1,86 @@
+"""
+Per-item cost of the stream throttle and how it behaves with a slow consumer.
+
+    python -m benchmarks.throttle_overhead --items 200000
+
+The first table pushes --items snapshots through each policy as fast as possible and
+reports the overhead per item compared to iterating the source directly. The second
+feeds one snapshot every --token-ms to a consumer that needs --consumer-ms per update
+(a client on a slow connection) and reports how many updates it received and how long
+it took to see the final one.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from rngesus.rngesus.prompts import ThrottlePolicy, throttle
+
+POLICIES = {
+    "seconds=1": ThrottlePolicy(seconds=1),
+    "seconds=1,characters=400": ThrottlePolicy(seconds=1, characters=400),
+    "seconds=1,skip_when_slow": ThrottlePolicy(seconds=1, skip_when_slow=True),
+    "seconds=0,skip_when_slow": ThrottlePolicy(seconds=0, skip_when_slow=True),
+}
+
+
+async def source(items: int, token_seconds: float = 0):
+    text = "word " * items
+    for i in range(items):
+        if token_seconds:
+            await asyncio.sleep(token_seconds)
+        yield text[: (i + 1) * 5]
+
+
+async def drain(iterator, consumer_seconds: float = 0):
+    count = 0
+    last = ""
+    async for last in iterator:
+        count += 1
+        if consumer_seconds:
+            await asyncio.sleep(consumer_seconds)
+    return count, last
+
+
+async def overhead(items: int):
+    start = time.perf_counter()
+    await drain(source(items))
+    baseline = time.perf_counter() - start
+    print(f"{'policy':<28} {'updates':>8} {'us/item':>8}")
+    print(f"{'(none)':<28} {items:>8} {0:>8.2f}")
+    for name, policy in POLICIES.items():
+        start = time.perf_counter()
+        count, _ = await drain(throttle(source(items), policy=policy, size=len))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<28} {count:>8} {(elapsed - baseline) / items * 1e6:>8.2f}")
+
+
+async def slow_consumer(items: int, token_seconds: float, consumer_seconds: float):
+    print(f"\n{'policy':<28} {'updates':>8} {'seconds':>8}")
+    for name, policy in [("(none)", None)] + list(POLICIES.items()):
+        iterator = source(items, token_seconds)
+        if policy is not None:
+            iterator = throttle(iterator, policy=policy, size=len)
+        start = time.perf_counter()
+        count, _ = await drain(iterator, consumer_seconds)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<28} {count:>8} {elapsed:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=200_000)
+    parser.add_argument("--slow-items", type=int, default=300)
+    parser.add_argument("--token-ms", type=float, default=2)
+    parser.add_argument("--consumer-ms", type=float, default=20)
+    args = parser.parse_args()
+    asyncio.run(overhead(args.items))
+    asyncio.run(
+        slow_consumer(args.slow_items, args.token_ms / 1000, args.consumer_ms / 1000)
+    )
+
+
+if __name__ == "__main__":
+    main()
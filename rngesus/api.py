@@ -1,13 +1,14 @@
-from typing import AsyncIterator, List, TypeVar
+from typing import Any, List, TypeVar
 
-from fastapi import status
-from fastapi.responses import StreamingResponse
+from fastapi import Header, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from pydantic.generics import GenericModel, Generic
 
-from . import game
+from . import config, dice, game, generations, jobs, metrics, ndjson
 from .app import app
-from .models import Campaign, Character
+from .models import Campaign, Character, Chat, Job, SearchHit, field_columns
 
 DataT = TypeVar("DataT")
 
@@ -20,34 +21,111 @@ class ListResponse(GenericModel, Generic[DataT]):
     items: List[DataT]
 
 
+class ChatPage(BaseModel):
+    items: List[Chat]
+    has_more: bool
+
+
 class GenericResponse(BaseModel):
     status: str
 
 
+class CreateJob(BaseModel):
+    kind: str
+    # required for "characters", created from `description` for "campaign"
+    campaign_id: int | None = None
+    description: str = ""
+    count: int = 1
+    priority: int = config.JOB_PRIORITY_BACKGROUND
+
+
+def _owner(request: Request, client_id: str | None) -> str:
+    return client_id or (request.client.host if request.client else "")
+
+
+def _columns(table: type, fields: str) -> List[Any]:
+    # `?fields=id,title` returns just those columns, read with a narrower SELECT and
+    # sent as plain JSON rather than through the full response model
+    try:
+        return field_columns(table, fields)
+    except ValueError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
+
+
+GENERATION_ID_HEADER = "X-Generation-Id"
+
+
 ##########################
 ## Campaigns
 @app.get("/api/campaigns", response_model=ListResponse)
-def get_campaigns() -> ListResponse:
-    return ListResponse(items=game.get_campaign_summaries())
+async def get_campaigns(fields: str | None = None) -> ListResponse:
+    if fields is not None:
+        columns = _columns(Campaign, fields)
+        return JSONResponse({"items": await game.get_campaigns_fields(columns)})
+    return ListResponse(items=await game.get_campaign_summaries())
 
 
 @app.post("/api/campaigns", response_class=StreamingResponse)
-async def create_campaign(request: CreateCampaign) -> StreamingResponse:
-    return StreamingResponse(
-        content=generate_nd_json(game.generate_campaign(request.description)),
-        status_code=status.HTTP_200_OK,
-        media_type="application/ndjson",
+async def create_campaign(
+    request: CreateCampaign,
+    http_request: Request,
+    delta: bool = False,
+    accept: str | None = Header(None),
+    x_client_id: str | None = Header(None),
+) -> StreamingResponse:
+    job = await jobs.enqueue_campaign(
+        request.description,
+        owner=_owner(http_request, x_client_id),
+        priority=config.JOB_PRIORITY_INTERACTIVE,
+    )
+    # without workers of its own, the job is run by `python -m rngesus.jobs`
+    generation = await jobs.wait_for_generation(job.id) if config.JOB_WORKERS else None
+    if generation is not None:
+        return stream_nd_json(generation, ndjson.wants_delta(accept, delta))
+    job = await game.get_job(job.id) or job
+    if job.status == "failed":
+        return Response(job.error, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    # running in another process, or already done: the client follows the job
+    return JSONResponse(
+        jsonable_encoder(job),
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={"Location": f"/api/jobs/{job.id}"},
     )
 
 
-async def generate_nd_json(iterator: AsyncIterator[BaseModel]) -> AsyncIterator[str]:
-    async for c in iterator:
-        yield c.json() + "\n"
+def stream_nd_json(
+    generation: generations.Generation[BaseModel],
+    delta: bool = False,
+    offset: int | None = None,
+) -> StreamingResponse:
+    iterator = generation.subscribe(offset)
+    headers = {GENERATION_ID_HEADER: generation.id}
+    if delta:
+        return StreamingResponse(
+            content=ndjson.generate_nd_json_delta(iterator),
+            status_code=status.HTTP_200_OK,
+            media_type=ndjson.DELTA_MEDIA_TYPE,
+            headers=headers,
+        )
+    return StreamingResponse(
+        content=ndjson.generate_nd_json(iterator),
+        status_code=status.HTTP_200_OK,
+        media_type=ndjson.MEDIA_TYPE,
+        headers=headers,
+    )
 
 
 @app.get("/api/campaigns/{campaign_id}", response_model=Campaign)
-def get_campaign(campaign_id: int) -> Campaign:
-    camp = game.get_campaign(campaign_id)
+async def get_campaign(campaign_id: int, fields: str | None = None) -> Campaign:
+    if fields is not None:
+        columns = _columns(Campaign, fields)
+        found = await game.get_campaign_fields(campaign_id, columns)
+        if found is None:
+            return Response(
+                "Campaign not found", status_code=status.HTTP_404_NOT_FOUND
+            )
+        return JSONResponse(found)
+    camp = await game.get_campaign(campaign_id)
     if camp is None:
         return "Campaign not found", status.HTTP_404_NOT_FOUND
     return camp
@@ -56,33 +134,58 @@ def get_campaign(campaign_id: int) -> Campaign:
 ##########################
 ## Characters
 @app.get("/api/characters", response_model=ListResponse)
-def get_characters(campaign_id: int) -> ListResponse:
-    return ListResponse(items=game.get_character_summaries(campaign_id))
+async def get_characters(campaign_id: int, fields: str | None = None) -> ListResponse:
+    if fields is not None:
+        columns = _columns(Character, fields)
+        items = await game.get_characters_fields(campaign_id, columns)
+        return JSONResponse({"items": items})
+    return ListResponse(items=await game.get_character_summaries(campaign_id))
 
 
 @app.post("/api/characters", response_class=StreamingResponse)
-async def roll_character(campaign_id: int) -> StreamingResponse:
+async def roll_character(
+    campaign_id: int, delta: bool = False, accept: str | None = Header(None)
+) -> StreamingResponse:
     result = await game.add_character(campaign_id)
     if result is None:
         return "Campaign not found", status.HTTP_404_NOT_FOUND
-    return StreamingResponse(
-        content=generate_nd_json(result),
-        status_code=status.HTTP_200_OK,
-        media_type="application/ndjson",
-    )
+    generation = generations.start(None, lambda: result)
+    return stream_nd_json(generation, ndjson.wants_delta(accept, delta))
+
+
+@app.post("/api/characters/batch", response_class=StreamingResponse)
+async def roll_characters(campaign_id: int, count: int) -> StreamingResponse:
+    if count < 1 or count > config.CHARACTER_BATCH_MAX:
+        return Response(
+            f"count must be between 1 and {config.CHARACTER_BATCH_MAX}",
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+    result = await game.add_characters(campaign_id, count)
+    if result is None:
+        return "Campaign not found", status.HTTP_404_NOT_FOUND
+    # each item is one character's slot, so none may be skipped
+    return stream_nd_json(generations.start(None, lambda: result, snapshots=False))
 
 
 @app.get("/api/characters/{character_id}", response_model=Character)
-def get_character(character_id: int) -> Character:
-    char = game.get_character(character_id)
+async def get_character(character_id: int, fields: str | None = None) -> Character:
+    if fields is not None:
+        columns = _columns(Character, fields)
+        found = await game.get_character_fields(character_id, columns)
+        if found is None:
+            return Response(
+                "Character not found", status_code=status.HTTP_404_NOT_FOUND
+            )
+        return JSONResponse(found)
+    char = await game.get_character(character_id)
     if char is None:
         return "Character not found", status.HTTP_404_NOT_FOUND
     return char
 
 
 @app.delete("/api/characters/{character_id}", response_model=GenericResponse)
-def delete_character(character_id: int) -> GenericResponse:
-    deleted = game.delete_character(character_id)
+async def delete_character(character_id: int) -> GenericResponse:
+    deleted = await game.delete_character(character_id)
     return GenericResponse(status="deleted" if deleted else "no_match")
 
 
@@ -90,19 +193,186 @@ def delete_character(character_id: int) -> GenericResponse:
 ## Chat
 
 
-@app.get("/api/chats", response_model=ListResponse)
-def get_chats(campaign_id: int) -> ListResponse:
-    return ListResponse(items=game.load_chats(campaign_id))
+@app.get("/api/chats", response_model=ChatPage)
+async def get_chats(
+    campaign_id: int,
+    response: Response,
+    before_id: int | None = None,
+    after_id: int | None = None,
+    limit: int = Query(config.CHAT_PAGE_SIZE, ge=1, le=config.CHAT_PAGE_MAX_SIZE),
+    tail: bool = False,
+    fields: str | None = None,
+    if_none_match: str | None = Header(None),
+) -> ChatPage:
+    columns = _columns(Chat, fields) if fields is not None else None
+    etag = await game.chat_etag(campaign_id)
+    if if_none_match == etag:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    response.headers["ETag"] = etag
+    items = await game.load_chat_page(
+        campaign_id, before_id, after_id, limit + 1, tail, columns
+    )
+    has_more = len(items) > limit
+    if has_more:
+        # the extra row is the one furthest from the cursor
+        backwards = after_id is None and (before_id is not None or tail)
+        items = items[1:] if backwards else items[:-1]
+    if columns is not None:
+        return JSONResponse(
+            {"items": items, "has_more": has_more}, headers={"ETag": etag}
+        )
+    return ChatPage(items=items, has_more=has_more)
+
+
+@app.get("/api/campaigns/{campaign_id}/search", response_model=ListResponse[SearchHit])
+async def search_campaign(
+    campaign_id: int,
+    q: str,
+    limit: int = Query(config.SEARCH_LIMIT, ge=1, le=config.SEARCH_MAX_LIMIT),
+) -> ListResponse[SearchHit]:
+    items = await game.search_campaign(campaign_id, q, limit)
+    return ListResponse[SearchHit](items=items)
 
 
 @app.put("/api/campaigns/{campaign_id}/chat", response_class=StreamingResponse)
-def chat_resume(campaign_id: int, user_message: str | None = None) -> StreamingResponse:
-    return StreamingResponse(
-        content=generate_nd_json(
-            game.assistant_generate(campaign_id)
-            if user_message is None
-            else game.user_respond(campaign_id, user_message)
-        ),
-        status_code=status.HTTP_200_OK,
-        media_type="application/ndjson",
+async def chat_resume(
+    campaign_id: int,
+    user_message: str | None = None,
+    delta: bool = False,
+    accept: str | None = Header(None),
+) -> StreamingResponse:
+    if user_message is None:
+        generation = game.resume_chat(campaign_id)
+    else:
+        try:
+            generation = game.respond_to_chat(campaign_id, user_message)
+        except generations.GenerationInProgress:
+            return Response(
+                "A reply is already being generated for this campaign",
+                status_code=status.HTTP_409_CONFLICT,
+            )
+    return stream_nd_json(generation, ndjson.wants_delta(accept, delta))
+
+
+##########################
+## Generations
+
+
+@app.get("/api/generations/{generation_id}", response_class=StreamingResponse)
+async def follow_generation(
+    generation_id: str,
+    offset: int | None = None,
+    delta: bool = False,
+    accept: str | None = Header(None),
+    last_event_id: str | None = Header(None),
+) -> StreamingResponse:
+    # `offset` is the number of items already received, which for plain NDJSON is the
+    # number of lines. Last-Event-ID is the sequence number of the last one, counting
+    # from 0. Without either the stream starts at the latest item.
+    generation = generations.get(generation_id)
+    if generation is None:
+        return Response(
+            "Generation not found or expired", status_code=status.HTTP_404_NOT_FOUND
+        )
+    if offset is None and last_event_id is not None and last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+    return stream_nd_json(generation, ndjson.wants_delta(accept, delta), offset)
+
+
+##########################
+## Jobs
+
+
+@app.post("/api/jobs", response_model=Job)
+async def create_job(
+    request: CreateJob, http_request: Request, x_client_id: str | None = Header(None)
+) -> Job:
+    owner = _owner(http_request, x_client_id)
+    if request.kind == "campaign" and request.campaign_id is None:
+        return await jobs.enqueue_campaign(request.description, owner, request.priority)
+    if request.kind not in jobs.handlers or request.campaign_id is None:
+        return Response(
+            f"kind must be one of {', '.join(jobs.handlers)} with a campaign_id",
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+    if request.count < 1 or request.count > config.CHARACTER_BATCH_MAX:
+        return Response(
+            f"count must be between 1 and {config.CHARACTER_BATCH_MAX}",
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+    return await jobs.enqueue(
+        request.kind,
+        request.campaign_id,
+        owner,
+        request.priority,
+        count=request.count,
+    )
+
+
+@app.get("/api/jobs", response_model=ListResponse)
+async def get_jobs(owner: str | None = None) -> ListResponse:
+    return ListResponse(items=await game.get_jobs(owner))
+
+
+@app.get("/api/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: int) -> Job:
+    job = await game.get_job(job_id)
+    if job is None:
+        return Response("Job not found", status_code=status.HTTP_404_NOT_FOUND)
+    return job
+
+
+@app.get("/api/jobs/{job_id}/stream", response_class=StreamingResponse)
+async def follow_job(
+    job_id: int,
+    offset: int | None = None,
+    delta: bool = False,
+    accept: str | None = Header(None),
+) -> StreamingResponse:
+    # waits for a queued job to start; finished jobs are read through GET /api/jobs/{id}
+    generation = await jobs.wait_for_generation(job_id)
+    if generation is None:
+        return Response(
+            "Job is not running in this process", status_code=status.HTTP_404_NOT_FOUND
+        )
+    return stream_nd_json(generation, ndjson.wants_delta(accept, delta), offset)
+
+
+##########################
+## Dice
+
+
+# not async: rolling up to dice.MAX_ROLLED dice and building a model of each roll
+# takes milliseconds, so FastAPI runs this in its thread pool
+@app.get("/api/dice/roll", response_model=ListResponse[dice.Roll])
+def roll_dice(
+    expression: str, count: int = Query(1, ge=1, le=config.DICE_MAX_ROLLS)
+) -> ListResponse[dice.Roll]:
+    try:
+        return ListResponse[dice.Roll](items=dice.roll(expression, count))
+    except dice.DiceError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
+
+
+# not async either: a distribution that isn't cached yet can take a while to work out
+@app.get("/api/dice/distribution", response_model=dice.DiceDistribution)
+def dice_distribution(
+    expression: str, target: int | None = None
+) -> dice.DiceDistribution:
+    try:
+        return dice.distribution(expression, target)
+    except dice.DiceError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
+
+
+##########################
+## Metrics
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4"
     )
@@ -8,13 +8,23 @@ from . import database
 
 from fastapi.middleware.cors import CORSMiddleware
 
+from . import metrics
+
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"])
+app.add_middleware(metrics.TimingMiddleware)
 
 from . import views
 from . import api
+from . import jobs
 
 
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     database.main()
+    await jobs.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await jobs.stop()
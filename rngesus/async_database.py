@@ -0,0 +1,181 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from . import config, database, metrics
+from .database import RowT
+from .models import (
+    Campaign,
+    CampaignSummary,
+    Character,
+    CharacterPrompt,
+    CharacterSummary,
+    Chat,
+    ChatSummary,
+    Job,
+    SearchHit,
+)
+
+T = TypeVar("T")
+
+executor = ThreadPoolExecutor(
+    max_workers=config.DATABASE_THREADS, thread_name_prefix="database"
+)
+
+
+async def run(fn: Callable[..., T], *args) -> T:
+    # work handed to the executor runs to completion even if the awaiting task is
+    # cancelled, so a flush started during a client disconnect is still committed
+    with metrics.db_call_seconds.time(function=getattr(fn, "func", fn).__name__):
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+async def upsert_campaign(campaign: Campaign) -> Campaign:
+    return await run(database.upsert_campaign, campaign)
+
+
+async def get_campaign(id: int) -> Optional[Campaign]:
+    return await run(database.get_campaign, id)
+
+
+async def get_campaign_summaries() -> List[CampaignSummary]:
+    return await run(database.get_campaign_summaries)
+
+
+async def get_campaign_fields(id: int, columns: List[Any]) -> Optional[Dict[str, Any]]:
+    return await run(database.get_campaign_fields, id, columns)
+
+
+async def get_campaigns_fields(columns: List[Any]) -> List[Dict[str, Any]]:
+    return await run(database.get_campaigns_fields, columns)
+
+
+async def delete_campaign(id: int) -> None:
+    return await run(database.delete_campaign, id)
+
+
+async def upsert_character(character: Character) -> Character:
+    return await run(database.upsert_character, character)
+
+
+async def insert_characters(characters: List[Character]) -> List[Character]:
+    return await run(database.insert_characters, characters)
+
+
+async def get_character_summaries(campaign_id: int) -> List[CharacterSummary]:
+    return await run(database.get_character_summaries, campaign_id)
+
+
+async def get_characters_fields(
+    campaign_id: int, columns: List[Any]
+) -> List[Dict[str, Any]]:
+    return await run(database.get_characters_fields, campaign_id, columns)
+
+
+async def activate_character(character_id: int, time: int) -> None:
+    return await run(database.activate_character, character_id, time)
+
+
+async def deactivate_character(character_id: int) -> None:
+    return await run(database.deactivate_character, character_id)
+
+
+async def get_active_characters_in_campaign(campaign_id: int) -> List[Character]:
+    return await run(database.get_active_characters_in_campaign, campaign_id)
+
+
+async def get_active_character_prompts(campaign_id: int) -> List[CharacterPrompt]:
+    return await run(database.get_active_character_prompts, campaign_id)
+
+
+async def get_character(id: int) -> Optional[Character]:
+    return await run(database.get_character, id)
+
+
+async def get_character_fields(id: int, columns: List[Any]) -> Optional[Dict[str, Any]]:
+    return await run(database.get_character_fields, id, columns)
+
+
+async def delete_character(id: int) -> bool:
+    return await run(database.delete_character, id)
+
+
+async def upsert_chat_message(chat: Chat) -> Chat:
+    return await run(database.upsert_chat_message, chat)
+
+
+async def get_chat_history(campaign_id: int) -> List[Chat]:
+    return await run(database.get_chat_history, campaign_id)
+
+
+async def get_chat_page(
+    campaign_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = 100,
+    tail: bool = False,
+    columns: Optional[List[Any]] = None,
+) -> List[Chat] | List[Dict[str, Any]]:
+    return await run(
+        database.get_chat_page, campaign_id, before_id, after_id, limit, tail, columns
+    )
+
+
+async def get_latest_chat_version(campaign_id: int) -> Optional[Tuple[int, int]]:
+    return await run(database.get_latest_chat_version, campaign_id)
+
+
+async def get_chat_summary(campaign_id: int) -> Optional[ChatSummary]:
+    return await run(database.get_chat_summary, campaign_id)
+
+
+async def upsert_chat_summary(summary: ChatSummary) -> ChatSummary:
+    return await run(database.upsert_chat_summary, summary)
+
+
+async def search_campaign(
+    campaign_id: int, query: str, limit: int
+) -> List[SearchHit]:
+    return await run(database.search_campaign, campaign_id, query, limit)
+
+
+async def insert_job(job: Job) -> Job:
+    return await run(database.insert_job, job)
+
+
+async def get_job(id: int) -> Optional[Job]:
+    return await run(database.get_job, id)
+
+
+async def get_jobs(owner: Optional[str] = None, limit: int = 100) -> List[Job]:
+    return await run(database.get_jobs, owner, limit)
+
+
+async def claim_job(max_per_owner: int, time: int) -> Optional[Job]:
+    return await run(database.claim_job, max_per_owner, time)
+
+
+async def update_job(id: int, **values: Any) -> None:
+    return await run(functools.partial(database.update_job, id, **values))
+
+
+async def requeue_running_jobs() -> int:
+    return await run(database.requeue_running_jobs)
+
+
+class WriteBehind:
+    def __init__(self, **kwargs):
+        self.writes = database.WriteBehind(**kwargs)
+
+    async def __aenter__(self) -> "WriteBehind":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.flush()
+
+    async def upsert(self, row: RowT) -> RowT:
+        return await run(self.writes.upsert, row)
+
+    async def flush(self) -> None:
+        await run(self.writes.flush)
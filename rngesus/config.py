@@ -1,8 +1,93 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
+
+
+def _flag(name: str, default: bool) -> bool:
+    # "0", "false" and "no" turn a flag off as well as an empty value does
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
+
+
 SILENT_GUIDANCE=os.environ.get("SILENT_GUIDANCE", False)
 VERBOSE_DATABASE=os.environ.get("VERBOSE_DATABASE", False)
-OPENAI_API_KEY=os.environ["OPENAI_API_KEY"]
+OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY")
 OPENAI_MODEL=os.environ.get("OPENAI_MODEL", "gpt-4")
 # OPENAI_MODEL=os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+WRITE_BEHIND_FLUSH_SECONDS=float(os.environ.get("WRITE_BEHIND_FLUSH_SECONDS", 2))
+WRITE_BEHIND_MAX_PENDING=int(os.environ.get("WRITE_BEHIND_MAX_PENDING", 20))
+DATABASE_THREADS=int(os.environ.get("DATABASE_THREADS", 4))
+CHAT_CONTEXT_TURNS=int(os.environ.get("CHAT_CONTEXT_TURNS", 20))
+CHAT_CONTEXT_TOKENS=int(os.environ.get("CHAT_CONTEXT_TOKENS", 3000))
+# older turns are summarized once this many have fallen out of the context window,
+# a batch of at most this many turns and tokens per LLM call
+CHAT_SUMMARY_BATCH_TURNS=int(os.environ.get("CHAT_SUMMARY_BATCH_TURNS", 8))
+CHAT_SUMMARY_BATCH_TOKENS=int(os.environ.get("CHAT_SUMMARY_BATCH_TOKENS", 3000))
+CHAT_STATE_CACHE_SIZE=int(os.environ.get("CHAT_STATE_CACHE_SIZE", 64))
+CHAT_PAGE_SIZE=int(os.environ.get("CHAT_PAGE_SIZE", 100))
+CHAT_PAGE_MAX_SIZE=int(os.environ.get("CHAT_PAGE_MAX_SIZE", 500))
+SEARCH_LIMIT=int(os.environ.get("SEARCH_LIMIT", 10))
+SEARCH_MAX_LIMIT=int(os.environ.get("SEARCH_MAX_LIMIT", 100))
+SEARCH_SNIPPET_TOKENS=int(os.environ.get("SEARCH_SNIPPET_TOKENS", 16))
+DATABASE_URL=os.environ.get("DATABASE_URL", "sqlite:///rngesus.db")
+DATABASE_POOL_SIZE=int(os.environ.get("DATABASE_POOL_SIZE", 8))
+SQLITE_JOURNAL_MODE=os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS=os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE=int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+# negative values are in KiB
+SQLITE_CACHE_SIZE=int(os.environ.get("SQLITE_CACHE_SIZE", -64 * 1024))
+SQLITE_BUSY_TIMEOUT_MS=int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+CHARACTER_BATCH_MAX=int(os.environ.get("CHARACTER_BATCH_MAX", 8))
+CHARACTER_BATCH_CONCURRENCY=int(os.environ.get("CHARACTER_BATCH_CONCURRENCY", 3))
+CHARACTER_BATCH_RETRIES=int(os.environ.get("CHARACTER_BATCH_RETRIES", 1))
+PARALLEL_CAMPAIGN_GENERATION=_flag("PARALLEL_CAMPAIGN_GENERATION", False)
+LLM_CACHE=_flag("LLM_CACHE", True)
+LLM_CACHE_PATH=os.environ.get("LLM_CACHE_PATH", "llm_cache.db")
+LLM_CACHE_MAX_BYTES=int(os.environ.get("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+LLM_CACHE_TTL_SECONDS=float(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+LLM_CACHE_SAMPLED=_flag("LLM_CACHE_SAMPLED", False)
+# stream throttle policies, e.g. "seconds=0.5,characters=200,skip_when_slow=1"
+THROTTLE_CHAT=os.environ.get("THROTTLE_CHAT", "seconds=1,characters=400,skip_when_slow=1")
+THROTTLE_CAMPAIGN=os.environ.get("THROTTLE_CAMPAIGN", "seconds=1,skip_when_slow=1")
+THROTTLE_CHARACTER=os.environ.get("THROTTLE_CHARACTER", "seconds=1,skip_when_slow=1")
+GENERATION_BUFFER_SIZE=int(os.environ.get("GENERATION_BUFFER_SIZE", 256))
+GENERATION_TTL_SECONDS=float(os.environ.get("GENERATION_TTL_SECONDS", 300))
+# when the last client following a generation disconnects: "abort" it once nobody has
+# come back for GENERATION_ABORT_GRACE_SECONDS, or "finish" and persist it anyway
+GENERATION_ON_DISCONNECT=os.environ.get("GENERATION_ON_DISCONNECT", "abort")
+GENERATION_ABORT_GRACE_SECONDS=float(os.environ.get("GENERATION_ABORT_GRACE_SECONDS", 5))
+# generation jobs run by in-process workers; 0 leaves them to `python -m rngesus.jobs`
+JOB_WORKERS=int(os.environ.get("JOB_WORKERS", 2))
+JOB_MAX_PER_OWNER=int(os.environ.get("JOB_MAX_PER_OWNER", 1))
+JOB_POLL_SECONDS=float(os.environ.get("JOB_POLL_SECONDS", 5))
+JOB_PRIORITY_INTERACTIVE=int(os.environ.get("JOB_PRIORITY_INTERACTIVE", 10))
+JOB_PRIORITY_BACKGROUND=int(os.environ.get("JOB_PRIORITY_BACKGROUND", 0))
+LLM_REQUESTS_PER_MINUTE=float(os.environ.get("LLM_REQUESTS_PER_MINUTE", 200))
+LLM_TOKENS_PER_MINUTE=float(os.environ.get("LLM_TOKENS_PER_MINUTE", 40000))
+LLM_MAX_CONCURRENCY=int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_RETRIES=int(os.environ.get("LLM_MAX_RETRIES", 5))
+LLM_BACKOFF_SECONDS=float(os.environ.get("LLM_BACKOFF_SECONDS", 1))
+LLM_BACKOFF_MAX_SECONDS=float(os.environ.get("LLM_BACKOFF_MAX_SECONDS", 30))
+# "openai", or "mock" for a local stand-in that streams synthetic text
+LLM_BACKEND=os.environ.get("LLM_BACKEND", "openai")
+MOCK_LLM_TOKENS_PER_SECOND=float(os.environ.get("MOCK_LLM_TOKENS_PER_SECOND", 40))
+MOCK_LLM_LATENCY_SECONDS=float(os.environ.get("MOCK_LLM_LATENCY_SECONDS", 0.5))
+MOCK_LLM_MAX_TOKENS=int(os.environ.get("MOCK_LLM_MAX_TOKENS", 120))
+# text file whose words the mock repeats instead of synthetic ones
+MOCK_LLM_SCRIPT=os.environ.get("MOCK_LLM_SCRIPT", None)
+# log requests that take longer than this; 0 disables the slow-request log
+SLOW_REQUEST_SECONDS=float(os.environ.get("SLOW_REQUEST_SECONDS", 0))
+# past turns recalled into the chat prompt from a hashed TF-IDF index kept in
+# RETRIEVAL_PATH (default: next to the database file); RETRIEVAL_TOP_K=0 turns it off
+RETRIEVAL_PATH=os.environ.get("RETRIEVAL_PATH")
+RETRIEVAL_TOP_K=int(os.environ.get("RETRIEVAL_TOP_K", 4))
+RETRIEVAL_TOKENS=int(os.environ.get("RETRIEVAL_TOKENS", 800))
+RETRIEVAL_CHUNK_WORDS=int(os.environ.get("RETRIEVAL_CHUNK_WORDS", 120))
+RETRIEVAL_QUERY_TURNS=int(os.environ.get("RETRIEVAL_QUERY_TURNS", 2))
+RETRIEVAL_MIN_SCORE=float(os.environ.get("RETRIEVAL_MIN_SCORE", 0.02))
+# dice rolled ahead of each chat reply for the DM to take results from, as
+# "<expression>:<count>,..."; empty leaves them out
+DICE_TRAY=os.environ.get("DICE_TRAY", "d20:6,d12:2,d10:2,d8:3,d6:6,d4:3,d100:2")
+DICE_MAX_ROLLS=int(os.environ.get("DICE_MAX_ROLLS", 1000))
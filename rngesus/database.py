@@ -1,6 +1,11 @@
-from typing import Dict, List, Optional
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
 
 from pydantic import BaseModel
+from sqlalchemy import event, func, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from sqlmodel import JSON, Column, Field, Session, SQLModel, create_engine, select
 
 from .models import (
@@ -9,15 +14,90 @@ from .models import (
     CampaignSummaryTuple,
     Character,
     CharacterSummary,
+    CharacterPrompt,
+    CharacterPromptTuple,
     CharacterSummaryTuple,
     Chat,
+    ChatSummary,
+    Job,
+    SearchHit,
+    campaign_sections,
     campaign_summary,
+    character_prompt,
     character_summary,
 )
 
-from . import config
+from . import config, metrics, migrations
 
-engine = create_engine("sqlite:///rngesus.db", echo=config.VERBOSE_DATABASE)
+
+def create_database_engine(url: str = config.DATABASE_URL) -> Engine:
+    engine = create_engine(
+        url,
+        echo=config.VERBOSE_DATABASE,
+        poolclass=QueuePool,
+        pool_size=config.DATABASE_POOL_SIZE,
+        max_overflow=config.DATABASE_POOL_SIZE,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": config.SQLITE_BUSY_TIMEOUT_MS / 1000,
+        },
+    )
+
+    @event.listens_for(engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={config.SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+        started = conn.info["statement_started"].pop()
+        metrics.db_statement_seconds.observe(
+            time.perf_counter() - started,
+            statement=statement.lstrip().split(" ", 1)[0].upper(),
+        )
+
+    return engine
+
+
+engine = create_database_engine()
+
+RowT = TypeVar("RowT", Campaign, Character, Chat)
+
+# called with every row after it has been committed, and whether it was deleted
+listeners: List[Callable[[SQLModel, bool], None]] = []
+
+
+def _notify(row: SQLModel, deleted: bool = False) -> None:
+    for listener in listeners:
+        listener(row, deleted)
+
+
+def _fields(columns: List[Any], row: Tuple) -> Dict[str, Any]:
+    return {column.key: value for column, value in zip(columns, row)}
+
+
+def index_campaign(session: Session, id: int, description: Optional[str]) -> None:
+    """Replace the campaign's description sections in the search index."""
+    session.execute(
+        text("DELETE FROM campaign_fts WHERE campaign_id = :id"), {"id": id}
+    )
+    for section, part in campaign_sections(description):
+        session.execute(
+            text(
+                "INSERT INTO campaign_fts(text, campaign_id, section) "
+                "VALUES (:text, :id, :section)"
+            ),
+            {"text": part, "id": id, "section": section},
+        )
 
 
 def upsert_campaign(campaign: Campaign) -> Campaign:
@@ -26,11 +106,15 @@ def upsert_campaign(campaign: Campaign) -> Campaign:
             session.query(Campaign).filter(Campaign.id == campaign.id).update(
                 campaign.dict()
             )
+            index_campaign(session, campaign.id, campaign.description)
             session.commit()
         else:
             session.add(campaign)
+            session.flush()
+            index_campaign(session, campaign.id, campaign.description)
             session.commit()
             session.refresh(campaign)
+    _notify(campaign)
     return campaign
 
 
@@ -46,11 +130,24 @@ def get_campaign_summaries() -> List[CampaignSummary]:
         return [campaign_summary(tuple) for tuple in campaigns]
 
 
-def delete_campaign(id: int) -> None:
+def get_campaign_fields(id: int, columns: List[Any]) -> Optional[Dict[str, Any]]:
+    with Session(engine) as session:
+        row = session.query(*columns).filter(Campaign.id == id).first()
+        return None if row is None else _fields(columns, row)
+
+
+def get_campaigns_fields(columns: List[Any]) -> List[Dict[str, Any]]:
     with Session(engine) as session:
+        return [_fields(columns, row) for row in session.query(*columns).all()]
+
+
+def delete_campaign(id: int) -> None:
+    with Session(engine, expire_on_commit=False) as session:
         campaign = session.get(Campaign, id)
         session.delete(campaign)
+        index_campaign(session, id, None)
         session.commit()
+    _notify(campaign, deleted=True)
 
 
 def upsert_character(character: Character) -> Character:
@@ -64,9 +161,21 @@ def upsert_character(character: Character) -> Character:
             session.add(character)
             session.commit()
             session.refresh(character)
+    _notify(character)
     return character
 
 
+def insert_characters(characters: List[Character]) -> List[Character]:
+    with Session(engine) as session:
+        session.add_all(characters)
+        session.commit()
+        for character in characters:
+            session.refresh(character)
+    for character in characters:
+        _notify(character)
+    return characters
+
+
 def get_character_summaries(campaign_id: int) -> List[CharacterSummary]:
     with Session(engine) as session:
         tuples = (
@@ -77,17 +186,25 @@ def get_character_summaries(campaign_id: int) -> List[CharacterSummary]:
         return [character_summary(tuple) for tuple in tuples]
 
 
-def activate_character(character_id: int, time: int) -> None:
+def get_characters_fields(campaign_id: int, columns: List[Any]) -> List[Dict[str, Any]]:
     with Session(engine) as session:
+        rows = session.query(*columns).filter(Character.campaign_id == campaign_id)
+        return [_fields(columns, row) for row in rows.all()]
+
+
+def activate_character(character_id: int, time: int) -> None:
+    with Session(engine, expire_on_commit=False) as session:
         character = session.get(Character, character_id)
         character.activated = time
         session.commit()
+    _notify(character)
 
 def deactivate_character(character_id: int) -> None:
-    with Session(engine) as session:
+    with Session(engine, expire_on_commit=False) as session:
         character = session.get(Character, character_id)
         character.activated = None
         session.commit()
+    _notify(character)
 
 def get_active_characters_in_campaign(campaign_id: int) -> List[Character]:
     with Session(engine) as session:
@@ -100,17 +217,38 @@ def get_active_characters_in_campaign(campaign_id: int) -> List[Character]:
         return characters
 
 
+def get_active_character_prompts(campaign_id: int) -> List[CharacterPrompt]:
+    with Session(engine) as session:
+        tuples = (
+            session.query(*CharacterPromptTuple)
+            .filter(Character.campaign_id == campaign_id)
+            .where(Character.activated != None)
+            .all()
+        )
+        return [character_prompt(tuple) for tuple in tuples]
+
+
 def get_character(id: int) -> Optional[Character]:
     with Session(engine) as session:
         character = session.get(Character, id)
         return character
 
 
-def delete_character(id: int) -> bool:
+def get_character_fields(id: int, columns: List[Any]) -> Optional[Dict[str, Any]]:
     with Session(engine) as session:
-        count = session.query(Character).filter(Character.id == id).delete()
+        row = session.query(*columns).filter(Character.id == id).first()
+        return None if row is None else _fields(columns, row)
+
+
+def delete_character(id: int) -> bool:
+    with Session(engine, expire_on_commit=False) as session:
+        character = session.get(Character, id)
+        if character is None:
+            return False
+        session.delete(character)
         session.commit()
-        return count > 0
+    _notify(character, deleted=True)
+    return True
 
 
 def upsert_chat_message(chat: Chat) -> Chat:
@@ -122,6 +260,7 @@ def upsert_chat_message(chat: Chat) -> Chat:
             session.add(chat)
             session.commit()
             session.refresh(chat)
+    _notify(chat)
     return chat
 
 
@@ -136,5 +275,234 @@ def get_chat_history(campaign_id: int) -> List[Chat]:
         return chat_messages
 
 
+def get_chat_page(
+    campaign_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = 100,
+    tail: bool = False,
+    columns: Optional[List[Any]] = None,
+) -> List[Chat] | List[Dict[str, Any]]:
+    """Chat rows, or dicts of just `columns` when those are given."""
+    with Session(engine) as session:
+        query = session.query(*columns) if columns else session.query(Chat)
+        query = query.filter(Chat.campaign_id == campaign_id)
+        if after_id is not None:
+            query = query.filter(Chat.id > after_id)
+        if before_id is not None:
+            query = query.filter(Chat.id < before_id)
+        if after_id is None and (before_id is not None or tail):
+            # page backwards from the cursor (or the end) and return in chat order
+            chat_messages = query.order_by(Chat.id.desc()).limit(limit).all()
+            chat_messages.reverse()
+        else:
+            chat_messages = query.order_by(Chat.id).limit(limit).all()
+        if columns:
+            return [_fields(columns, row) for row in chat_messages]
+        return chat_messages
+
+
+def get_latest_chat_version(campaign_id: int) -> Optional[Tuple[int, int]]:
+    with Session(engine) as session:
+        return (
+            session.query(Chat.id, func.length(Chat.message))
+            .filter(Chat.campaign_id == campaign_id)
+            .order_by(Chat.id.desc())
+            .first()
+        )
+
+
+def get_chat_summary(campaign_id: int) -> Optional[ChatSummary]:
+    with Session(engine) as session:
+        return session.get(ChatSummary, campaign_id)
+
+
+def upsert_chat_summary(summary: ChatSummary) -> ChatSummary:
+    with Session(engine) as session:
+        session.merge(summary)
+        session.commit()
+    _notify(summary)
+    return summary
+
+
+def _match_query(query: str) -> str:
+    # each word is quoted so that user input is never read as FTS5 syntax; any of
+    # them may match and bm25 ranks rows matching more of them higher
+    return " OR ".join(f'"{word}"' for word in re.findall(r"\w+", query.lower()))
+
+
+def search_campaign(campaign_id: int, query: str, limit: int) -> List[SearchHit]:
+    """The chat messages and description sections of a campaign best matching
+    `query`, best first."""
+    match = _match_query(query)
+    if not match:
+        return []
+    params = {"match": match, "campaign_id": campaign_id, "limit": limit}
+    with Session(engine) as session:
+        chats = session.execute(
+            text(
+                "SELECT chat.id, chat.user_type, "
+                "snippet(chat_fts, 0, '**', '**', '…', :tokens), bm25(chat_fts) "
+                "FROM chat_fts JOIN chat ON chat.id = chat_fts.rowid "
+                "WHERE chat_fts MATCH :match AND chat.campaign_id = :campaign_id "
+                "ORDER BY rank LIMIT :limit"
+            ),
+            {**params, "tokens": config.SEARCH_SNIPPET_TOKENS},
+        ).all()
+        sections = session.execute(
+            text(
+                "SELECT section, "
+                "snippet(campaign_fts, 0, '**', '**', '…', :tokens), "
+                "bm25(campaign_fts) FROM campaign_fts "
+                "WHERE campaign_fts MATCH :match AND campaign_id = :campaign_id "
+                "ORDER BY rank LIMIT :limit"
+            ),
+            {**params, "tokens": config.SEARCH_SNIPPET_TOKENS},
+        ).all()
+    # bm25 is negative, lower is better
+    hits = [
+        SearchHit(source="chat", id=id, user_type=type, snippet=snippet, score=-rank)
+        for id, type, snippet, rank in chats
+    ] + [
+        SearchHit(source=section, id=None, user_type=None, snippet=snippet, score=-rank)
+        for section, snippet, rank in sections
+    ]
+    hits.sort(key=lambda hit: hit.score, reverse=True)
+    return hits[:limit]
+
+
+def insert_job(job: Job) -> Job:
+    with Session(engine, expire_on_commit=False) as session:
+        session.add(job)
+        session.commit()
+    return job
+
+
+def get_job(id: int) -> Optional[Job]:
+    with Session(engine) as session:
+        return session.get(Job, id)
+
+
+def get_jobs(owner: Optional[str] = None, limit: int = 100) -> List[Job]:
+    with Session(engine) as session:
+        query = session.query(Job)
+        if owner is not None:
+            query = query.filter(Job.owner == owner)
+        return query.order_by(Job.id.desc()).limit(limit).all()
+
+
+def claim_job(max_per_owner: int, time: int) -> Optional[Job]:
+    """
+    Marks the next queued job as running and returns it: highest priority first, then
+    oldest, skipping owners that already have `max_per_owner` jobs running. The claim
+    only succeeds if the job is still queued, so several workers (or processes) can
+    race for the same row.
+    """
+    with Session(engine, expire_on_commit=False) as session:
+        busy = (
+            select(Job.owner)
+            .where(Job.status == "running")
+            .group_by(Job.owner)
+            .having(func.count() >= max_per_owner)
+        )
+        candidates = session.exec(
+            select(Job)
+            .where(Job.status == "queued", Job.owner.not_in(busy))
+            .order_by(Job.priority.desc(), Job.id)
+            .limit(5)
+        ).all()
+        for job in candidates:
+            claimed = session.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.status == "queued")
+                .values(status="running", started=time)
+            ).rowcount
+            session.commit()
+            if claimed:
+                job.status = "running"
+                job.started = time
+                return job
+    return None
+
+
+def update_job(id: int, **values: Any) -> None:
+    with Session(engine) as session:
+        session.execute(update(Job).where(Job.id == id).values(**values))
+        session.commit()
+
+
+def requeue_running_jobs() -> int:
+    # jobs that were running when the process stopped start over
+    with Session(engine) as session:
+        requeued = session.execute(
+            update(Job)
+            .where(Job.status == "running")
+            .values(status="queued", started=None, progress=0)
+        ).rowcount
+        session.commit()
+    return requeued
+
+
+class WriteBehind:
+    """
+    Coalesces updates to already-inserted rows in memory and writes them in a single
+    transaction once `flush_interval_seconds` have passed or `max_pending` updates have
+    been buffered. New rows are inserted immediately so that they get an id. Leaving the
+    `with` block (including on cancellation) flushes whatever is still pending.
+    """
+
+    def __init__(
+        self,
+        flush_interval_seconds: float = config.WRITE_BEHIND_FLUSH_SECONDS,
+        max_pending: int = config.WRITE_BEHIND_MAX_PENDING,
+    ):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending = max_pending
+        self.pending: Dict[Tuple[Type[SQLModel], int], Dict[str, Any]] = {}
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def __enter__(self) -> "WriteBehind":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def upsert(self, row: RowT) -> RowT:
+        if not row.id:
+            with Session(engine) as session:
+                session.add(row)
+                if isinstance(row, Campaign):
+                    session.flush()
+                    index_campaign(session, row.id, row.description)
+                session.commit()
+                session.refresh(row)
+            _notify(row)
+            return row
+        self.pending[(type(row), row.id)] = row.dict()
+        self.buffered += 1
+        if (
+            self.buffered >= self.max_pending
+            or time.monotonic() - self.last_flush >= self.flush_interval_seconds
+        ):
+            self.flush()
+        return row
+
+    def flush(self) -> None:
+        if self.pending:
+            with Session(engine) as session:
+                for (model, id), values in self.pending.items():
+                    session.query(model).filter(model.id == id).update(values)
+                    if model is Campaign:
+                        index_campaign(session, id, values.get("description"))
+                session.commit()
+            for (model, id), values in self.pending.items():
+                _notify(model(**values))
+            self.pending = {}
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+
 def main() -> None:
     SQLModel.metadata.create_all(engine)
+    migrations.migrate(engine)
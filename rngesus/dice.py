@@ -0,0 +1,376 @@
+"""
+Dice expressions such as "3d6+2", "4d6kh3", "d20adv", "2d10!-1" or "d%": rolled in
+numpy batches, and turned into exact outcome distributions.
+
+A term is NdM, optionally followed by modifiers: khK / kK keeps the K highest dice,
+klK the K lowest, dhK / dlK drop the K highest / lowest, adv and dis roll a second die
+and keep the higher / lower one, and ! explodes a die that shows its highest face into
+another roll of it (at most MAX_EXPLOSIONS times per die). Terms and whole numbers are
+joined with + and -.
+
+Every call is bounded: `roll` returns each die it rolls and rolls at most MAX_ROLLED,
+`totals` only sums them and rolls at most MAX_BATCH, and exact distributions stop at
+MAX_OUTCOMES outcomes and MAX_KEEP_STEPS steps of keeping or dropping dice.
+"""
+import math
+import re
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+MAX_DICE = 1000
+MAX_SIDES = 1000
+MAX_EXPLOSIONS = 20
+# outcomes of an exact distribution
+MAX_OUTCOMES = 100_000
+# dice rolled by one call of `roll`, and of `totals`
+MAX_ROLLED = 10_000
+MAX_BATCH = 10_000_000
+# face value by dice placed steps of the keep/drop recurrence, about 4us each
+MAX_KEEP_STEPS = 50_000
+
+
+class DiceError(ValueError):
+    pass
+
+
+class Dice(NamedTuple):
+    count: int
+    sides: int
+    # how many of the dice count, the highest ones or the lowest ones
+    keep: int
+    highest: bool
+    explode: bool
+    # 1 or -1
+    sign: int
+
+
+class Expression(NamedTuple):
+    dice: Tuple[Dice, ...]
+    constant: int
+
+
+TERM = re.compile(r"([+-])?(?:(\d*)d(\d+|%)((?:[kd][hl]?\d+|adv|dis|!)*)|(\d+))")
+MODIFIER = re.compile(r"([kd][hl]?)(\d+)|(adv|dis)|(!)")
+
+
+@lru_cache(maxsize=1024)
+def parse(expression: str) -> Expression:
+    text = expression.lower().strip()
+    if not text:
+        raise DiceError("empty dice expression")
+    if re.search(r"[\w%!]\s+[\w%!]", text):
+        raise DiceError(f"can't read {expression!r}: missing + or -")
+    text = re.sub(r"\s+", "", text)
+    dice: List[Dice] = []
+    constant = 0
+    at = 0
+    while at < len(text):
+        match = TERM.match(text, at)
+        if not match or match.end() == at or (at > 0 and not match.group(1)):
+            raise DiceError(f"can't read {expression!r} at {text[at:]!r}")
+        at = match.end()
+        sign = -1 if match.group(1) == "-" else 1
+        if match.group(5) is not None:
+            constant += sign * int(match.group(5))
+            continue
+        count = int(match.group(2) or 1)
+        sides = 100 if match.group(3) == "%" else int(match.group(3))
+        keep, highest, explode = count, True, False
+        for kind, number, advantage, bang in MODIFIER.findall(match.group(4)):
+            if bang:
+                explode = True
+            elif advantage:
+                if count != 1:
+                    raise DiceError(f"{advantage} takes a single die: {expression!r}")
+                count, keep, highest = 2, 1, advantage == "adv"
+            elif kind in ("k", "kh", "kl"):
+                keep, highest = int(number), kind != "kl"
+            else:
+                keep, highest = count - int(number), kind != "dh"
+        if not 1 <= count <= MAX_DICE or not 1 <= sides <= MAX_SIDES:
+            raise DiceError(
+                f"at most {MAX_DICE} dice of at most {MAX_SIDES} sides per term"
+            )
+        if not 0 <= keep <= count:
+            raise DiceError(f"can't keep {keep} of {count} dice in {expression!r}")
+        if explode and sides < 2:
+            raise DiceError("a die needs two sides to explode")
+        dice.append(Dice(count, sides, keep, highest, explode, sign))
+    return Expression(tuple(dice), constant)
+
+
+## Distributions ##
+# (lowest outcome, probability of each outcome from the lowest up)
+Distribution = Tuple[int, np.ndarray]
+
+
+def _frozen(array: np.ndarray) -> np.ndarray:
+    array.setflags(write=False)
+    return array
+
+
+def _convolve(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    if min(len(a), len(b)) < 64:
+        return np.convolve(a, b)
+    size = len(a) + len(b) - 1
+    result = np.fft.irfft(np.fft.rfft(a, size) * np.fft.rfft(b, size), size)
+    # rounding leaves tiny negative probabilities where the exact ones are zero
+    return np.clip(result, 0, None)
+
+
+@lru_cache(maxsize=256)
+def _die(sides: int, explode: bool) -> np.ndarray:
+    """Probabilities of one die's total from 1 up."""
+    if not explode:
+        return _frozen(np.full(sides, 1 / sides))
+    probabilities = np.zeros(sides * (MAX_EXPLOSIONS + 1))
+    for explosions in range(MAX_EXPLOSIONS):
+        start = explosions * sides
+        probabilities[start : start + sides - 1] = sides ** -(explosions + 1)
+    # the last reroll counts whatever it shows
+    probabilities[MAX_EXPLOSIONS * sides :] = sides ** -(MAX_EXPLOSIONS + 1)
+    return _frozen(probabilities)
+
+
+@lru_cache(maxsize=256)
+def _sum(count: int, sides: int, explode: bool) -> np.ndarray:
+    """Probabilities of the total of `count` dice from `count` up."""
+    if count == 1:
+        return _die(sides, explode)
+    half = count // 2
+    return _frozen(
+        _convolve(_sum(half, sides, explode), _sum(count - half, sides, explode))
+    )
+
+
+@lru_cache(maxsize=256)
+def _kept(
+    count: int, sides: int, explode: bool, keep: int, highest: bool
+) -> Distribution:
+    if keep == count:
+        return count, _sum(count, sides, explode)
+    if keep == 0:
+        return 0, _frozen(np.ones(1))
+    die = _die(sides, explode)
+    faces = [
+        (value, probability)
+        for value, probability in enumerate(die, 1)
+        if probability > 0
+    ]
+    if len(faces) * (count + 1) * (count + 2) // 2 > MAX_KEEP_STEPS:
+        raise DiceError("too many dice to keep or drop exactly")
+    # placing the dice face by face, best face first: how many are placed so far
+    # and the distribution of the total of the kept ones among them
+    placed = np.zeros((count + 1, keep * len(die) + 1))
+    placed[0, 0] = 1
+    for value, probability in reversed(faces) if highest else faces:
+        log_probability = math.log(probability)
+        after = np.zeros_like(placed)
+        for done in range(count + 1):
+            totals = placed[done]
+            if not totals.any():
+                continue
+            left = count - done
+            for showing in range(left + 1):
+                # ways to pick which of the dice left show this face, times the
+                # probability that they do
+                weight = math.exp(
+                    math.lgamma(left + 1)
+                    - math.lgamma(showing + 1)
+                    - math.lgamma(left - showing + 1)
+                    + showing * log_probability
+                )
+                if weight == 0:
+                    break
+                shift = min(showing, max(keep - done, 0)) * value
+                after[done + showing, shift:] += weight * totals[: len(totals) - shift]
+        placed = after
+    totals = placed[count]
+    low = int(np.flatnonzero(totals)[0])
+    return low, _frozen(totals[low:] / totals.sum())
+
+
+def outcomes(expression: str) -> Distribution:
+    parsed = parse(expression)
+    span = sum(dice.keep * len(_die(dice.sides, dice.explode)) for dice in parsed.dice)
+    if span > MAX_OUTCOMES:
+        raise DiceError(f"{expression!r} has too many outcomes to list")
+    low, probabilities = parsed.constant, np.ones(1)
+    for dice in parsed.dice:
+        offset, term = _kept(
+            dice.count, dice.sides, dice.explode, dice.keep, dice.highest
+        )
+        if dice.sign < 0:
+            offset, term = -(offset + len(term) - 1), term[::-1]
+        low += offset
+        probabilities = _convolve(probabilities, term)
+    return low, probabilities / probabilities.sum()
+
+
+class DiceDistribution(BaseModel):
+    expression: str
+    minimum: int
+    maximum: int
+    mean: float
+    stdev: float
+    # outcomes with a chance of at least 1e-15
+    probabilities: Dict[int, float]
+    # chance of rolling at least `target`, when one was given
+    target: Optional[int] = None
+    at_least: Optional[float] = None
+
+
+def distribution(expression: str, target: Optional[int] = None) -> DiceDistribution:
+    low, probabilities = outcomes(expression)
+    values = np.arange(low, low + len(probabilities))
+    mean = float(values @ probabilities)
+    possible = np.flatnonzero(probabilities > 1e-15)
+    return DiceDistribution(
+        expression=expression,
+        minimum=int(values[possible[0]]),
+        maximum=int(values[possible[-1]]),
+        mean=mean,
+        stdev=math.sqrt(max(float((values - mean) ** 2 @ probabilities), 0)),
+        probabilities={int(values[i]): float(probabilities[i]) for i in possible},
+        target=target,
+        at_least=None
+        if target is None
+        else float(probabilities[max(target - low, 0) :].sum()),
+    )
+
+
+## Rolling ##
+
+
+def _roll_dice(dice: Dice, times: int, rng: np.random.Generator) -> np.ndarray:
+    """Each die's total, one row per roll."""
+    rolled = rng.integers(1, dice.sides + 1, (times, dice.count))
+    if dice.explode:
+        exploding = rolled == dice.sides
+        for _ in range(MAX_EXPLOSIONS):
+            if not exploding.any():
+                break
+            again = rng.integers(1, dice.sides + 1, int(exploding.sum()))
+            rolled[exploding] += again
+            exploding[exploding] = again == dice.sides
+    return rolled
+
+
+def _kept_mask(rolled: np.ndarray, dice: Dice) -> np.ndarray:
+    if dice.keep == dice.count:
+        return np.ones(rolled.shape, bool)
+    order = np.argsort(-rolled if dice.highest else rolled, axis=1, kind="stable")
+    kept = np.zeros(rolled.shape, bool)
+    np.put_along_axis(kept, order[:, : dice.keep], True, axis=1)
+    return kept
+
+
+def _rolled(
+    expression: str, times: int, rng: Optional[np.random.Generator], limit: int
+) -> Tuple[np.ndarray, List[Tuple[np.ndarray, np.ndarray]]]:
+    """The totals, and every term's dice and which of them were kept."""
+    parsed = parse(expression)
+    if times * sum(dice.count for dice in parsed.dice) > limit:
+        raise DiceError(f"at most {limit} dice per call")
+    rng = rng or np.random.default_rng()
+    total = np.full(times, parsed.constant, np.int64)
+    rolls = []
+    for dice in parsed.dice:
+        rolled = _roll_dice(dice, times, rng)
+        kept = _kept_mask(rolled, dice)
+        total += dice.sign * np.where(kept, rolled, 0).sum(axis=1)
+        rolls.append((rolled, kept))
+    return total, rolls
+
+
+def totals(
+    expression: str, times: int, rng: Optional[np.random.Generator] = None
+) -> np.ndarray:
+    return _rolled(expression, times, rng, MAX_BATCH)[0]
+
+
+class Roll(BaseModel):
+    expression: str
+    total: int
+    # every die of every term, in the order they were rolled
+    dice: List[List[int]]
+    # whether each of them counts towards the total
+    kept: List[List[bool]]
+
+    def marker(self) -> str:
+        """e.g. "[roll: 4d6kh3+2 = 16 (6, ~~1~~, 5, 3)]" """
+        shown = [
+            str(value) if kept else f"~~{value}~~"
+            for values, keeps in zip(self.dice, self.kept)
+            for value, kept in zip(values, keeps)
+        ]
+        return f"[roll: {self.expression} = {self.total} ({', '.join(shown)})]"
+
+
+def roll(
+    expression: str, times: int = 1, rng: Optional[np.random.Generator] = None
+) -> List[Roll]:
+    total, rolls = _rolled(expression, times, rng, MAX_ROLLED)
+    return [
+        Roll(
+            expression=expression.strip(),
+            total=int(total[i]),
+            dice=[rolled[i].tolist() for rolled, _ in rolls],
+            kept=[kept[i].tolist() for _, kept in rolls],
+        )
+        for i in range(times)
+    ]
+
+
+## Chat ##
+
+# written by players or the DM, e.g. "[roll: 1d20+3]"; a rolled marker has an "="
+MARKER = re.compile(r"\[roll:\s*([^\]=]+?)\s*\]", re.IGNORECASE)
+
+
+class Markers:
+    """
+    Replaces roll markers with their rolls. A reply is streamed as ever longer
+    versions of its text, so each marker is rolled once and the same roll is shown in
+    every later version.
+    """
+
+    def __init__(self, rng: Optional[np.random.Generator] = None):
+        self.rng = rng
+        self.rolled: List[Tuple[str, str]] = []
+
+    def resolve(self, text: str) -> str:
+        seen = 0
+
+        def replace(match: re.Match) -> str:
+            nonlocal seen
+            if seen < len(self.rolled) and self.rolled[seen][0] == match.group(0):
+                result = self.rolled[seen][1]
+            else:
+                try:
+                    result = roll(match.group(1), rng=self.rng)[0].marker()
+                except DiceError:
+                    result = match.group(0)
+                self.rolled[seen:] = [(match.group(0), result)]
+            seen += 1
+            return result
+
+        return MARKER.sub(replace, text)
+
+
+def tray(spec: str, rng: Optional[np.random.Generator] = None) -> str:
+    """
+    Rolls for the DM to use during a turn, from a spec like "d20:6,d6:4": one line per
+    die, e.g. "- d20: 14, 3, 19, 8, 11, 6".
+    """
+    lines = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        die, _, times = part.partition(":")
+        rolled = totals(die.strip(), int(times or 1), rng)
+        lines.append(f"- {die.strip()}: {', '.join(map(str, rolled))}")
+    return "\n".join(lines)
@@ -1,134 +1,497 @@
+import asyncio
 import datetime
+import logging
+import threading
 import time
-from typing import AsyncIterator, List
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Set, Tuple
 
 from fastapi import status
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from . import database, rngesus
+from . import async_database, config, database, dice, generations, llm_scheduler, metrics, retrieval, rngesus
 from .app import app
-from .models import Campaign, CampaignSummary, Character, CharacterSummary, Chat
+from .models import (
+    Campaign,
+    CampaignSummary,
+    Character,
+    CharacterPrompt,
+    CharacterSummary,
+    Chat,
+    ChatSummary,
+    Job,
+    SearchHit,
+)
+
+logger = logging.getLogger(__name__)
 
 
 ## Campaign CRUD ##
-def get_campaign_summaries() -> List[CampaignSummary]:
-    return database.get_campaign_summaries()
+async def get_campaign_summaries() -> List[CampaignSummary]:
+    return await async_database.get_campaign_summaries()
+
+async def get_active_characters(campaign_id: int) -> List[Character]:
+    return await async_database.get_active_characters_in_campaign(campaign_id)
+
+
+async def get_campaign(campaign_id: int) -> Campaign | None:
+    return await async_database.get_campaign(campaign_id)
+
 
-def get_active_characters(campaign_id: int) -> List[Character]:
-    return database.get_active_characters_in_campaign(campaign_id)
+async def get_campaign_fields(
+    campaign_id: int, columns: List[Any]
+) -> Dict[str, Any] | None:
+    return await async_database.get_campaign_fields(campaign_id, columns)
 
 
-def get_campaign(campaign_id: int) -> Campaign | None:
-    return database.get_campaign(campaign_id)
+async def get_campaigns_fields(columns: List[Any]) -> List[Dict[str, Any]]:
+    return await async_database.get_campaigns_fields(columns)
 
 
 async def regenerate_campaign(campaign: Campaign) -> AsyncIterator[Campaign]:
-    program = rngesus.generate_campaign(campaign, update_frequency_seconds=1)
-    async for generated in program:
-        database.upsert_campaign(generated)
-        yield campaign
+    llm_scheduler.schedule_as(llm_scheduler.BACKGROUND, campaign.id)
+    program = rngesus.generate_campaign(campaign)
+    async with async_database.WriteBehind() as writes:
+        async for generated in program:
+            campaign = await writes.upsert(generated)
+            yield campaign
+        await writes.flush()
+    yield campaign
 
 
-async def generate_campaign(description: str) -> AsyncIterator[Campaign]:
-    campaign = None
-    program = rngesus.generate_new_campaign(description, update_frequency_seconds=1)
-    async for generated in program:
-        if campaign is None:
-            campaign = database.upsert_campaign(generated)
-        else:
-            generated.id = campaign.id
-            database.upsert_campaign(generated)
-            campaign = generated
-        yield campaign
+## Jobs ##
+
+
+async def get_job(job_id: int) -> Job | None:
+    return await async_database.get_job(job_id)
+
+
+async def get_jobs(owner: str | None = None) -> List[Job]:
+    return await async_database.get_jobs(owner)
 
 
 ## Character CRUD ##
 
 
-def get_character_summaries(campaign_id: int) -> List[CharacterSummary]:
-    return database.get_character_summaries(campaign_id)
+async def get_character_summaries(campaign_id: int) -> List[CharacterSummary]:
+    return await async_database.get_character_summaries(campaign_id)
 
 
 async def add_character(campaign_id: int) -> None | AsyncIterator[Character]:
-    campaign = database.get_campaign(campaign_id)
-    characters = database.get_character_summaries(campaign_id)
+    campaign = await async_database.get_campaign(campaign_id)
+    characters = await async_database.get_character_summaries(campaign_id)
     if campaign is None:
         return None
     else:
         return _generate_character(campaign, characters)
     
-def activate_character(character_id: int) -> None:
-    database.activate_character(character_id, time.time_ns() // 1000000)
+async def activate_character(character_id: int) -> None:
+    await async_database.activate_character(character_id, time.time_ns() // 1000000)
+
+async def deactivate_character(character_id: int) -> None:
+    await async_database.deactivate_character(character_id)
 
-def deactivate_character(character_id: int) -> None:
-    database.deactivate_character(character_id)
+async def get_character(character_id: int) -> Character | None:
+    return await async_database.get_character(character_id)
 
-def get_character(character_id: int) -> Character | None:
-    return database.get_character(character_id)
 
+async def get_character_fields(
+    character_id: int, columns: List[Any]
+) -> Dict[str, Any] | None:
+    return await async_database.get_character_fields(character_id, columns)
 
-def delete_character(character_id: int) -> bool:
-    return database.delete_character(character_id)
+
+async def get_characters_fields(
+    campaign_id: int, columns: List[Any]
+) -> List[Dict[str, Any]]:
+    return await async_database.get_characters_fields(campaign_id, columns)
+
+
+async def delete_character(character_id: int) -> bool:
+    return await async_database.delete_character(character_id)
 
 
 async def _generate_character(campaign: Campaign, characters: List[CharacterSummary]) -> AsyncIterator[Character]:
+    llm_scheduler.schedule_as(llm_scheduler.BACKGROUND, campaign.id)
     char = None
     async for c in rngesus.roll_character(campaign, characters):
         char = c
         yield char
     if char is not None:
-        char = database.upsert_character(char)
+        char = await async_database.upsert_character(char)
         yield char
 
 
+class CharacterSlot(BaseModel):
+    slot: int
+    character: Character
+
+
+async def add_characters(
+    campaign_id: int, count: int
+) -> None | AsyncIterator[CharacterSlot]:
+    campaign = await async_database.get_campaign(campaign_id)
+    characters = await async_database.get_character_summaries(campaign_id)
+    if campaign is None:
+        return None
+    else:
+        return _generate_characters(campaign, characters, count)
+
+
+def _character_summary(character: Character) -> CharacterSummary:
+    return CharacterSummary(
+        id=character.id or 0,
+        name=character.name or "",
+        character_class=character.character_class,
+        character_type=character.character_type,
+    )
+
+
+async def _generate_characters(
+    campaign: Campaign, characters: List[CharacterSummary], count: int
+) -> AsyncIterator[CharacterSlot]:
+    llm_scheduler.schedule_as(llm_scheduler.BACKGROUND, campaign.id)
+    roles = rngesus.assign_roles(campaign, characters, count)
+    updates: asyncio.Queue[CharacterSlot | None] = asyncio.Queue()
+    limit = asyncio.Semaphore(config.CHARACTER_BATCH_CONCURRENCY)
+    rolled: Dict[int, Character] = {}
+
+    async def roll(slot: int) -> None:
+        character_class, character_type = roles[slot]
+        async with limit:
+            for _ in range(config.CHARACTER_BATCH_RETRIES + 1):
+                # characters finished earlier in the batch count towards uniqueness too
+                party = characters + [_character_summary(c) for c in rolled.values()]
+                char = None
+                async for char in rngesus.roll_character(
+                    campaign,
+                    party,
+                    character_class=character_class,
+                    character_type=character_type,
+                ):
+                    await updates.put(CharacterSlot(slot=slot, character=char))
+                names = {(c.name or "").strip().lower() for c in party}
+                if char is not None and (char.name or "").strip().lower() not in names:
+                    break
+            if char is not None:
+                rolled[slot] = char
+
+    # once one slot fails, gather returns without cancelling the others
+    tasks = [asyncio.create_task(roll(slot)) for slot in range(count)]
+
+    async def roll_all() -> None:
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await updates.put(None)
+
+    rolling = asyncio.create_task(roll_all())
+    try:
+        while (update := await updates.get()) is not None:
+            yield update
+        await rolling
+    finally:
+        for task in [rolling, *tasks]:
+            task.cancel()
+        await asyncio.gather(rolling, *tasks, return_exceptions=True)
+    slots = sorted(rolled)
+    saved = await async_database.insert_characters([rolled[slot] for slot in slots])
+    for slot, char in zip(slots, saved):
+        yield CharacterSlot(slot=slot, character=char)
+
+
 ## Chat ##
 
 
 class ChatState(BaseModel):
     campaign: Campaign
-    characters: List[Character]
+    characters: List[CharacterPrompt]
     dialog: List[Chat]
+    summary: ChatSummary | None
+    # (campaign version, party version) of what the system prompt shows
+    prompt_version: Tuple[int, int] = (0, 0)
+
+
+class ChatStateCache:
+    """
+    Per-campaign ChatState kept up to date from database change notifications, so that a
+    new turn only appends to the cached dialog instead of reloading the whole history.
+    """
+
+    def __init__(self, max_campaigns: int = config.CHAT_STATE_CACHE_SIZE):
+        self.max_campaigns = max_campaigns
+        self.states: OrderedDict[int, ChatState] = OrderedDict()
+        self.stale_characters: Set[int] = set()
+        # bumped on every change, so a load that raced with a write is not cached
+        self.versions: Dict[int, int] = {}
+        # bumped when the campaign's title or description, or any of its characters,
+        # changes; only those end up in the system prompt
+        self.campaign_versions: Dict[int, int] = {}
+        self.party_versions: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def version(self, campaign_id: int) -> int:
+        with self.lock:
+            return self.versions.get(campaign_id, 0)
+
+    def prompt_version(self, campaign_id: int) -> Tuple[int, int]:
+        with self.lock:
+            return (
+                self.campaign_versions.get(campaign_id, 0),
+                self.party_versions.get(campaign_id, 0),
+            )
+
+    def get(self, campaign_id: int) -> ChatState | None:
+        with self.lock:
+            state = self.states.get(campaign_id)
+            if state is None:
+                return None
+            self.states.move_to_end(campaign_id)
+            return ChatState.construct(
+                campaign=state.campaign.copy(),
+                characters=None
+                if campaign_id in self.stale_characters
+                else list(state.characters),
+                dialog=list(state.dialog),
+                summary=state.summary,
+                prompt_version=state.prompt_version,
+            )
+
+    def put(self, campaign_id: int, state: ChatState, version: int) -> None:
+        with self.lock:
+            if self.versions.get(campaign_id, 0) != version:
+                return
+            self.states[campaign_id] = state
+            self.states.move_to_end(campaign_id)
+            self.stale_characters.discard(campaign_id)
+            while len(self.states) > self.max_campaigns:
+                evicted, _ = self.states.popitem(last=False)
+                self.stale_characters.discard(evicted)
+
+    def on_change(self, row, deleted: bool) -> None:
+        campaign_id = row.id if isinstance(row, Campaign) else row.campaign_id
+        with self.lock:
+            self.versions[campaign_id] = self.versions.get(campaign_id, 0) + 1
+            state = self.states.get(campaign_id)
+            if isinstance(row, Character):
+                self.party_versions[campaign_id] = (
+                    self.party_versions.get(campaign_id, 0) + 1
+                )
+            elif isinstance(row, Campaign) and (
+                state is None
+                or deleted
+                or (row.title, row.description)
+                != (state.campaign.title, state.campaign.description)
+            ):
+                self.campaign_versions[campaign_id] = (
+                    self.campaign_versions.get(campaign_id, 0) + 1
+                )
+            if state is None:
+                return
+            if isinstance(row, (Campaign, Character)):
+                state.prompt_version = (
+                    self.campaign_versions.get(campaign_id, 0),
+                    self.party_versions.get(campaign_id, 0),
+                )
+            if deleted and isinstance(row, Campaign):
+                del self.states[campaign_id]
+            elif isinstance(row, Campaign):
+                state.campaign = row.copy()
+            elif isinstance(row, Character):
+                self.stale_characters.add(campaign_id)
+            elif isinstance(row, ChatSummary):
+                state.summary = row.copy()
+            elif isinstance(row, Chat):
+                chat = Chat(**row.dict())
+                if not state.dialog or state.dialog[-1].id < chat.id:
+                    state.dialog.append(chat)
+                else:
+                    for i in range(len(state.dialog) - 1, -1, -1):
+                        if state.dialog[i].id == chat.id:
+                            state.dialog[i] = chat
+                            break
+
+
+chat_states = ChatStateCache()
+database.listeners.append(chat_states.on_change)
+database.listeners.append(retrieval.on_change)
+
+# rendered system prompts by (campaign id, campaign version, party version)
+system_prompts: OrderedDict[Tuple[int, int, int], str] = OrderedDict()
+
+
+def system_prompt(state: ChatState) -> str:
+    key = (state.campaign.id, *state.prompt_version)
+    rendered = system_prompts.get(key)
+    if rendered is None:
+        rendered = rngesus.render_system_prompt(state.campaign, state.characters)
+        system_prompts[key] = rendered
+        while len(system_prompts) > config.CHAT_STATE_CACHE_SIZE:
+            system_prompts.popitem(last=False)
+    system_prompts.move_to_end(key)
+    return rendered
+
+
+async def load_chats(campaign_id: int) -> List[Chat]:
+    return await async_database.get_chat_history(campaign_id)
+
+
+async def load_chat_page(
+    campaign_id: int,
+    before_id: int | None = None,
+    after_id: int | None = None,
+    limit: int = config.CHAT_PAGE_SIZE,
+    tail: bool = False,
+    columns: List[Any] | None = None,
+) -> List[Chat] | List[Dict[str, Any]]:
+    return await async_database.get_chat_page(
+        campaign_id, before_id, after_id, limit, tail, columns
+    )
 
 
-def load_chats(campaign_id: int) -> List[Chat]:
-    return database.get_chat_history(campaign_id)
+async def chat_etag(campaign_id: int) -> str:
+    latest = await async_database.get_latest_chat_version(campaign_id)
+    id, length = latest or (0, 0)
+    return f'W/"{campaign_id}-{id}-{length}"'
 
 
-def load_chat_state(campaign_id: int) -> ChatState:
-    camp = database.get_campaign(campaign_id)
-    characters = database.get_active_characters_in_campaign(campaign_id)
-    dialog = database.get_chat_history(campaign_id)
-    return ChatState(campaign=camp, characters=characters, dialog=dialog)
+async def search_campaign(
+    campaign_id: int, query: str, limit: int = config.SEARCH_LIMIT
+) -> List[SearchHit]:
+    return await async_database.search_campaign(campaign_id, query, limit)
+
+
+async def load_chat_state(campaign_id: int) -> ChatState:
+    cached = chat_states.get(campaign_id)
+    if cached is not None and cached.characters is not None:
+        return cached
+    version = chat_states.version(campaign_id)
+    # read before loading, so that what is loaded is at least as new as the version
+    prompt_version = chat_states.prompt_version(campaign_id)
+    characters = await async_database.get_active_character_prompts(campaign_id)
+    if cached is not None:
+        cached.characters = characters
+        # the cached campaign may predate the campaign version read above
+        cached.prompt_version = (cached.prompt_version[0], prompt_version[1])
+        state = cached
+    else:
+        camp = await async_database.get_campaign(campaign_id)
+        dialog = await async_database.get_chat_history(campaign_id)
+        summary = await async_database.get_chat_summary(campaign_id)
+        state = ChatState(
+            campaign=camp,
+            characters=characters,
+            dialog=dialog,
+            summary=summary,
+            prompt_version=prompt_version,
+        )
+    chat_states.put(campaign_id, state, version)
+    return chat_states.get(campaign_id) or state
 
 
 async def assistant_generate(campaign_id: int) -> AsyncIterator[Chat]:
-    state = load_chat_state(campaign_id)
+    # generators run in their own generation task, so this does not leak to callers
+    llm_scheduler.schedule_as(llm_scheduler.INTERACTIVE, campaign_id)
+    state = await load_chat_state(campaign_id)
+    with metrics.prompt_assembly_seconds.time(program="chat"):
+        prompt = system_prompt(state)
+        window = rngesus.build_window(state.dialog, state.summary)
+        messages = rngesus.prompt_messages(window)
+        # the DM takes its roll results from these instead of making them up
+        dice_tray = dice.tray(config.DICE_TRAY)
+    with metrics.prompt_assembly_seconds.time(program="recall"):
+        recalled = await async_database.run(
+            retrieval.recall, campaign_id, state.dialog, messages
+        )
     assistant: Chat | None = None
-    async for resp in rngesus.generate_chat(
-        state.campaign, state.characters, state.dialog
-    ):
-        if state.campaign.scenario != resp.scenario and resp.scenario:
-            print(f"resp.scenario '{resp.scenario}' {type(resp.scenario)}")
-            state.campaign.scenario = resp.scenario
-            print("camp " + str(state.campaign))
-            print(state.campaign.scenario)
-            database.upsert_campaign(state.campaign)
-        print(resp.scenario, resp.assistant)
-        if resp.assistant:
-            if not assistant:
-                assistant = Chat(
+    markers = dice.Markers()
+    async with async_database.WriteBehind() as writes:
+        async for resp in rngesus.generate_chat(
+            prompt, messages, window.summary, recalled, dice_tray
+        ):
+            if state.campaign.scenario != resp.scenario and resp.scenario:
+                logger.debug("campaign %s scenario is now %r", campaign_id, resp.scenario)
+                state.campaign.scenario = resp.scenario
+                await writes.upsert(state.campaign)
+            if resp.assistant:
+                text = markers.resolve(resp.assistant)
+                if not assistant:
+                    assistant = Chat(
+                        campaign_id=campaign_id,
+                        user_type="assistant",
+                        message=text,
+                    )
+                assistant.message = text
+                await writes.upsert(assistant)
+                yield assistant
+        # the final frame is only sent once its text has been committed
+        await writes.flush()
+    if assistant is not None:
+        yield assistant
+        # not part of the reply: the generation ends here, and its stream with it
+        _summarize_later(campaign_id)
+
+
+# campaign id -> the summary being written for it, at most one at a time
+summarizing: Dict[int, "asyncio.Task[None]"] = {}
+
+
+def _summarize_later(campaign_id: int) -> None:
+    if campaign_id in summarizing:
+        return
+    task = asyncio.create_task(_summarize_history(campaign_id))
+    summarizing[campaign_id] = task
+    task.add_done_callback(lambda _: summarizing.pop(campaign_id, None))
+
+
+async def _summarize_history(campaign_id: int) -> None:
+    try:
+        state = await load_chat_state(campaign_id)
+        window = rngesus.build_window(state.dialog, state.summary)
+        llm_scheduler.schedule_as(llm_scheduler.BACKGROUND, campaign_id)
+        summary = window.summary
+        # a batch at a time rather than an LLM call after every reply; a long history
+        # takes several, each saved as it is done so a failure doesn't lose them
+        for batch in rngesus.summary_batches(window.unsummarized):
+            summary = await rngesus.summarize_history(state.campaign, summary, batch)
+            await async_database.upsert_chat_summary(
+                ChatSummary(
                     campaign_id=campaign_id,
-                    user_type="assistant",
-                    message=resp.assistant,
+                    through_chat_id=batch[-1].id,
+                    summary=summary,
                 )
-            assistant.message = resp.assistant
-            database.upsert_chat_message(assistant)
-            yield assistant
+            )
+    except Exception:
+        logger.exception("summarizing the history of campaign %s failed", campaign_id)
+
+
+async def user_respond(campaign_id: int, message: str) -> AsyncIterator[Chat]:
+    await async_database.upsert_chat_message(
+        Chat(
+            campaign_id=campaign_id,
+            user_type="user",
+            message=dice.Markers().resolve(message),
+        )
+    )
+    async for chat in assistant_generate(campaign_id):
+        yield chat
+
+
+def _chat_generation(campaign_id: int) -> str:
+    return f"chat-{campaign_id}"
+
+
+def resume_chat(campaign_id: int) -> generations.Generation[Chat]:
+    # a second tab or a reconnecting client follows the reply that is already being
+    # written instead of paying for another one
+    return generations.single_flight(
+        _chat_generation(campaign_id), lambda: assistant_generate(campaign_id)
+    )
 
 
-def user_respond(campaign_id: int, message: str) -> AsyncIterator[Chat]:
-    database.upsert_chat_message(
-        Chat(campaign_id=campaign_id, user_type="user", message=message)
+def respond_to_chat(campaign_id: int, message: str) -> generations.Generation[Chat]:
+    """raises generations.GenerationInProgress while a reply is being written"""
+    return generations.start(
+        _chat_generation(campaign_id), lambda: user_respond(campaign_id, message)
     )
-    return assistant_generate(campaign_id)
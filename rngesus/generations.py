@@ -0,0 +1,181 @@
+import asyncio
+import time
+import uuid
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Hashable,
+    TypeVar,
+)
+
+from pydantic import BaseModel
+
+from . import config
+
+T = TypeVar("T")
+
+
+class GenerationInProgress(Exception):
+    pass
+
+
+class Generation(Generic[T]):
+    """
+    A stream that runs in its own task and can be followed by any number of
+    subscribers, who may disconnect and come back. Items are numbered from 0 and the
+    most recent ones are kept in a bounded buffer, so a subscriber can resume from the
+    number of items it has already received. Once the last subscriber has gone, the
+    generation is cancelled after a grace period if `on_disconnect` is "abort", and
+    keeps going if it is "finish".
+
+    Items are `snapshots` of the whole result by default, so a subscriber that falls
+    behind skips to the latest one. Otherwise every item is delivered.
+    """
+
+    def __init__(
+        self,
+        key: Hashable | None,
+        source: AsyncIterator[T],
+        on_disconnect: str = config.GENERATION_ON_DISCONNECT,
+        snapshots: bool = True,
+    ):
+        if on_disconnect not in ("abort", "finish"):
+            raise ValueError(f"unknown on_disconnect policy {on_disconnect!r}")
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.on_disconnect = on_disconnect
+        self.snapshots = snapshots
+        self.items: Deque[T] = deque(maxlen=config.GENERATION_BUFFER_SIZE)
+        # number of items produced so far, which is also the sequence number of the next
+        self.count = 0
+        self.done = False
+        self.aborted = False
+        self.finished_at: float | None = None
+        self.error: Exception | None = None
+        self.subscribers = 0
+        self._abort_timer: asyncio.TimerHandle | None = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(source))
+
+    async def _run(self, source: AsyncIterator[T]) -> None:
+        try:
+            async for item in source:
+                # generators may keep mutating the item they yielded, so buffer a copy
+                self.items.append(
+                    item.copy(deep=True) if isinstance(item, BaseModel) else item
+                )
+                self.count += 1
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.finished_at = time.monotonic()
+            if self._abort_timer is not None:
+                self._abort_timer.cancel()
+            if running.get(self.key) is self:
+                del running[self.key]
+            self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, offset: int | None = None) -> AsyncIterator[T]:
+        """
+        Without an offset the subscriber starts at the latest item. With one, the
+        items produced since then are replayed, except those that have already
+        dropped out of the buffer.
+        """
+        position = max(self.count - 1, 0) if offset is None else offset
+        replayed = self.count if offset is not None else 0
+        self._subscribed()
+        try:
+            while True:
+                changed = self._changed
+                if position < self.count:
+                    if self.snapshots and position >= replayed:
+                        # behind a live stream: only the latest snapshot matters
+                        position = self.count - 1
+                    first = self.count - len(self.items)
+                    position = max(position, first)
+                    yield self.items[position - first]
+                    position += 1
+                elif self.done:
+                    break
+                else:
+                    await changed.wait()
+        finally:
+            self._unsubscribed()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self) -> None:
+        # cancels the source, which stops its LLM calls and closes their streams
+        if not self.done:
+            self.aborted = True
+            self.task.cancel()
+
+    def _subscribed(self) -> None:
+        self.subscribers += 1
+        if self._abort_timer is not None:
+            self._abort_timer.cancel()
+            self._abort_timer = None
+
+    def _unsubscribed(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers or self.done or self.on_disconnect != "abort":
+            return
+        self._abort_timer = asyncio.get_running_loop().call_later(
+            config.GENERATION_ABORT_GRACE_SECONDS, self._abandoned
+        )
+
+    def _abandoned(self) -> None:
+        self._abort_timer = None
+        if not self.subscribers:
+            self.abort()
+
+
+# generations by id, kept for GENERATION_TTL_SECONDS after they finish
+generations: Dict[str, Generation] = {}
+# unfinished generations by key, to coalesce requests for the same work
+running: Dict[Hashable, Generation] = {}
+
+
+def _evict_finished() -> None:
+    expired = time.monotonic() - config.GENERATION_TTL_SECONDS
+    for id, generation in list(generations.items()):
+        if generation.finished_at is not None and generation.finished_at < expired:
+            del generations[id]
+
+
+def get(id: str) -> Generation | None:
+    _evict_finished()
+    return generations.get(id)
+
+
+def start(
+    key: Hashable | None,
+    source: Callable[[], AsyncIterator[T]],
+    on_disconnect: str = config.GENERATION_ON_DISCONNECT,
+    snapshots: bool = True,
+) -> Generation[T]:
+    _evict_finished()
+    if key is not None and key in running:
+        raise GenerationInProgress(key)
+    generation = Generation(key, source(), on_disconnect, snapshots)
+    generations[generation.id] = generation
+    if key is not None:
+        running[key] = generation
+    return generation
+
+
+def single_flight(
+    key: Hashable, source: Callable[[], AsyncIterator[T]]
+) -> Generation[T]:
+    # attach to the generation for `key` if there is one, otherwise start it
+    return running.get(key) or start(key, source)
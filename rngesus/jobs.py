@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Set
+
+from pydantic import BaseModel
+
+from . import async_database, config, database, game, generations
+from .models import Campaign, Job
+
+logger = logging.getLogger(__name__)
+
+
+async def _campaign(job: Job) -> AsyncIterator[BaseModel] | None:
+    campaign = await async_database.get_campaign(job.campaign_id)
+    if campaign is None:
+        return None
+    return game.regenerate_campaign(campaign)
+
+
+async def _characters(job: Job) -> AsyncIterator[BaseModel] | None:
+    return await game.add_characters(job.campaign_id, job.params.get("count", 1))
+
+
+handlers: Dict[str, Callable[[Job], Awaitable[AsyncIterator[BaseModel] | None]]] = {
+    "campaign": _campaign,
+    "characters": _characters,
+}
+# kinds that stream one update per character rather than snapshots of the result, so
+# followers are sent every item
+_updates = {"characters"}
+
+# generation ids of jobs that were started by this process
+_generations: Dict[int, str] = {}
+# jobs claimed by this process whose generation may not have started yet
+_claimed: Set[int] = set()
+_wake = asyncio.Event()
+_started = asyncio.Event()
+_workers: List[asyncio.Task] = []
+
+
+def _now() -> int:
+    return time.time_ns() // 1000000
+
+
+async def enqueue(
+    kind: str,
+    campaign_id: int,
+    owner: str = "",
+    priority: int = config.JOB_PRIORITY_BACKGROUND,
+    **params,
+) -> Job:
+    if kind not in handlers:
+        raise ValueError(f"unknown job kind {kind!r}")
+    job = await async_database.insert_job(
+        Job(
+            kind=kind,
+            owner=owner,
+            priority=priority,
+            campaign_id=campaign_id,
+            params=params,
+            created=_now(),
+        )
+    )
+    _wake.set()
+    return job
+
+
+async def enqueue_campaign(
+    description: str, owner: str = "", priority: int = config.JOB_PRIORITY_BACKGROUND
+) -> Job:
+    # the row exists straight away so that clients have a campaign id to follow
+    campaign = await async_database.upsert_campaign(Campaign(prompt=description))
+    return await enqueue("campaign", campaign.id, owner, priority)
+
+
+def generation(job_id: int) -> generations.Generation | None:
+    id = _generations.get(job_id)
+    if id is None:
+        return None
+    found = generations.get(id)
+    if found is None:
+        del _generations[job_id]
+    return found
+
+
+async def wait_for_generation(job_id: int) -> generations.Generation | None:
+    """
+    The live stream of a job, waiting for a worker to pick it up if it is still queued.
+    None once the job has finished and its stream has expired, or if it runs elsewhere.
+    """
+    while True:
+        started = _started
+        found = generation(job_id)
+        if found is not None:
+            return found
+        job = await async_database.get_job(job_id)
+        # checked after reading the row, since claims are recorded right after commit
+        if job_id not in _claimed and (job is None or job.status != "queued"):
+            return None
+        try:
+            await asyncio.wait_for(started.wait(), config.JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _run(job: Job) -> None:
+    try:
+        source = await handlers[job.kind](job)
+        if source is None:
+            raise ValueError(f"campaign {job.campaign_id} not found")
+        # a job is finished even if whoever asked for it has gone, e.g. the form
+        # that creates a campaign redirects before the campaign is generated
+        running = generations.start(
+            f"job-{job.id}",
+            lambda: source,
+            on_disconnect="finish",
+            snapshots=job.kind not in _updates,
+        )
+        _generations[job.id] = running.id
+        _announce_start()
+        last = 0
+        async for _ in running.subscribe(0):
+            if running.count != last:
+                last = running.count
+                await async_database.update_job(job.id, progress=last)
+        await async_database.update_job(job.id, status="done", finished=_now())
+    except Exception as e:
+        logger.exception("job %s failed", job.id)
+        await async_database.update_job(
+            job.id, status="failed", error=str(e), finished=_now()
+        )
+        _announce_start()
+
+
+def _announce_start() -> None:
+    global _started
+    _started.set()
+    _started = asyncio.Event()
+
+
+def _claim() -> Job | None:
+    job = database.claim_job(config.JOB_MAX_PER_OWNER, _now())
+    if job is not None:
+        _claimed.add(job.id)
+    return job
+
+
+async def _worker() -> None:
+    while True:
+        job = await async_database.run(_claim)
+        if job is None:
+            try:
+                await asyncio.wait_for(_wake.wait(), config.JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            _wake.clear()
+            continue
+        # another worker may be able to take the next job
+        _wake.set()
+        try:
+            await _run(job)
+        finally:
+            _claimed.discard(job.id)
+
+
+async def start(workers: int = config.JOB_WORKERS) -> None:
+    if workers <= 0:
+        return
+    await async_database.requeue_running_jobs()
+    for _ in range(workers):
+        _workers.append(asyncio.create_task(_worker()))
+
+
+async def stop() -> None:
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+async def _serve(workers: int) -> None:
+    await start(workers)
+    await asyncio.gather(*_workers)
+
+
+def main() -> None:
+    # workers without the web app; their progress is visible through the database
+    logging.basicConfig(level=logging.INFO)
+    database.main()
+    asyncio.run(_serve(max(config.JOB_WORKERS, 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import threading
+from typing import Any, AsyncIterator
+
+from . import config, llm_cache, metrics
+
+# guidance and openai take most of a second to import, so they are only imported once
+# something actually generates text; processes that just serve stored campaigns never do
+_lock = threading.RLock()
+_configured = False
+
+
+def configure() -> None:
+    """Installs the LLM backend picked by LLM_BACKEND as `guidance.llm`, once."""
+    global _configured
+    if _configured:
+        return
+    with _lock:
+        if _configured:
+            return
+        import guidance
+
+        if guidance.llm is not None:
+            # one installed by hand, e.g. from a notebook, is left alone
+            pass
+        elif config.LLM_BACKEND == "mock":
+            from . import mock_llm
+
+            script = None
+            if config.MOCK_LLM_SCRIPT:
+                with open(config.MOCK_LLM_SCRIPT) as f:
+                    script = f.read()
+            guidance.llm = mock_llm.SyntheticLLM(script=script)
+        elif config.LLM_BACKEND == "openai":
+            if not config.OPENAI_API_KEY:
+                raise RuntimeError("OPENAI_API_KEY must be set to use the openai backend")
+            import openai
+
+            from . import openai_llm
+
+            openai.api_key = config.OPENAI_API_KEY
+            if config.LLM_CACHE:
+                # on the class: guidance saves streamed responses to `cls.cache`
+                cache = llm_cache.LLMCache()
+                openai_llm.ScheduledOpenAI.cache = cache
+                metrics.collectors.append(cache.metric_samples)
+            guidance.llm = openai_llm.ScheduledOpenAI(config.OPENAI_MODEL)
+        else:
+            raise ValueError(f"unknown LLM_BACKEND {config.LLM_BACKEND!r}")
+        _configured = True
+
+
+class Program:
+    """
+    A guidance program that is only parsed, and the LLM only set up, when it is first
+    called. Calling it returns a new program run like calling the guidance program does,
+    so one instance is shared by every request.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self._program = None
+
+    def __call__(self, **kwargs) -> Any:
+        if self._program is None:
+            with _lock:
+                if self._program is None:
+                    configure()
+                    import guidance
+
+                    self._program = guidance(self.template)
+        return self._program(**kwargs)
+
+    def stream(self, **kwargs) -> AsyncIterator[Any]:
+        """Runs the program asynchronously, yielding it as it is partially filled in."""
+        return _stop_when_closed(
+            self(async_mode=True, stream=True, silent=config.SILENT_GUIDANCE, **kwargs)
+        )
+
+
+async def _stop_when_closed(program: Any) -> AsyncIterator[Any]:
+    # guidance executes the program in a task of its own that carries on when whoever
+    # was reading it is cancelled, so it is told to stop: the running `gen` breaks at
+    # its next chunk and closes the LLM stream, which ends the upstream request
+    try:
+        async for partial in program:
+            yield partial
+    finally:
+        executor = program._executor
+        if executor is not None:
+            executor.stop()
+            executor.executing = False
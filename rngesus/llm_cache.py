@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from . import config
+
+NO_CACHE_PREFIX = "nocache:"
+
+
+class LLMCache:
+    """
+    Disk-backed cache for guidance's LLM calls, shared by every process that points at
+    the same file. It implements the interface of `guidance.llms.caches.Cache` and is
+    installed with `guidance.llms.OpenAI.cache = LLMCache()`.
+
+    Keys hash the rendered prompt together with the model and sampling parameters.
+    Calls with temperature > 0 are not cached unless `allow_sampled` is set, since a
+    retry or a re-roll is expected to come back different.
+    """
+
+    def __init__(
+        self,
+        path: str = config.LLM_CACHE_PATH,
+        max_bytes: int = config.LLM_CACHE_MAX_BYTES,
+        ttl_seconds: float = config.LLM_CACHE_TTL_SECONDS,
+        allow_sampled: bool = config.LLM_CACHE_SAMPLED,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.allow_sampled = allow_sampled
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "evicted": 0}
+        self._local = threading.local()
+        # guidance reads the same key several times in a row
+        self._last: Tuple[str, Any] | None = None
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL, "
+                "hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed ON llm_cache (accessed)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def create_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        if "cache_key" in kwargs:
+            return str(kwargs["cache_key"])
+        options = json.dumps(kwargs, sort_keys=True, default=str)
+        key = hashlib.sha256(f"{llm}{options}".encode("utf-8")).hexdigest()
+        if (kwargs.get("temperature") or 0) > 0 and not self.allow_sampled:
+            return NO_CACHE_PREFIX + key
+        return key
+
+    def __contains__(self, key: str) -> bool:
+        if key.startswith(NO_CACHE_PREFIX):
+            return False
+        if self._last is not None and self._last[0] == key:
+            return True
+        row = (
+            self._connection()
+            .execute(
+                "SELECT 1 FROM llm_cache WHERE key = ? AND created > ?",
+                (key, time.time() - self.ttl_seconds),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def __getitem__(self, key: str) -> Any:
+        if self._last is not None and self._last[0] == key:
+            return self._last[1]
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND created > ?",
+                (key, time.time() - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                raise KeyError(key)
+            connection.execute(
+                "UPDATE llm_cache SET accessed = ?, hits = hits + 1 WHERE key = ?",
+                (time.time(), key),
+            )
+        self.stats["hits"] += 1
+        value = json.loads(row[0])
+        self._last = (key, value)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        # guidance makes several keys and membership checks for one call, but stores
+        # its response once, so calls are counted here
+        self.stats["misses"] += 1
+        if key.startswith(NO_CACHE_PREFIX):
+            self.stats["bypassed"] += 1
+            # not stored, but guidance reads a response back right after setting it
+            self._last = (key, value)
+            return
+        encoded = json.dumps(value)
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, len(encoded), now, now),
+            )
+        self.evict()
+
+    def evict(self) -> int:
+        with self._connection() as connection:
+            evicted = connection.execute(
+                "DELETE FROM llm_cache WHERE created <= ?",
+                (time.time() - self.ttl_seconds,),
+            ).rowcount
+            total = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM llm_cache"
+            ).fetchone()[0]
+            # least recently used entries go first
+            rows = connection.execute(
+                "SELECT key, size FROM llm_cache ORDER BY accessed"
+            )
+            doomed = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                doomed.append((key,))
+                total -= size
+            connection.executemany("DELETE FROM llm_cache WHERE key = ?", doomed)
+        self._last = None
+        self.stats["evicted"] += evicted + len(doomed)
+        return evicted + len(doomed)
+
+    def clear(self) -> None:
+        with self._connection() as connection:
+            connection.execute("DELETE FROM llm_cache")
+        self._last = None
+
+    def metric_samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [
+            (f"rngesus_llm_cache_{name}_total", {}, value)
+            for name, value in self.stats.items()
+        ]
+
+    def summary(self) -> Dict[str, Any]:
+        entries, size, hits, oldest = (
+            self._connection()
+            .execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0), "
+                "MIN(created) FROM llm_cache"
+            )
+            .fetchone()
+        )
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "stored_hits": hits,
+            "oldest_age_seconds": round(time.time() - oldest) if oldest else None,
+            **self.stats,
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m rngesus.llm_cache", description="Inspect or purge the LLM cache"
+    )
+    parser.add_argument("--path", default=config.LLM_CACHE_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="show size and hit counts")
+    purge = commands.add_parser("purge", help="delete cached responses")
+    purge.add_argument(
+        "--expired", action="store_true", help="only expired or over-budget entries"
+    )
+    args = parser.parse_args()
+
+    cache = LLMCache(path=args.path)
+    if args.command == "stats":
+        print(json.dumps(cache.summary(), indent=2))
+    elif args.expired:
+        print(f"evicted {cache.evict()} entries")
+    else:
+        cache.clear()
+        print("cleared")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, List, Tuple
+
+from . import config, metrics
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# set by whoever starts a generation and inherited by the tasks guidance creates
+priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "llm_priority", default=BACKGROUND
+)
+fairness_key: contextvars.ContextVar[Hashable] = contextvars.ContextVar(
+    "llm_fairness_key", default=None
+)
+
+
+def schedule_as(level: int, key: Hashable = None) -> None:
+    """
+    Tags LLM calls made from the current task (and tasks it starts) with a priority and
+    a key, e.g. the campaign id, that queued calls are shared out fairly between.
+    """
+    priority.set(level)
+    fairness_key.set(key)
+
+
+class RateLimited(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait_seconds(self, amount: float) -> float:
+        # requests bigger than the whole bucket go through once it is full
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(missing / self.rate, 0)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.available -= amount
+
+    def drain(self) -> None:
+        self._refill()
+        self.available = min(self.available, 0)
+
+
+class LLMScheduler:
+    """
+    Admits LLM calls within a requests-per-minute and a tokens-per-minute budget and a
+    limit on concurrent calls. Waiting calls are served by priority, and round robin
+    between fairness keys within a priority.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = config.LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = config.LLM_TOKENS_PER_MINUTE,
+        max_concurrency: int = config.LLM_MAX_CONCURRENCY,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.queues: Dict[int, OrderedDict[Hashable, Deque]] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self.stats = {
+            "requests": 0,
+            "rate_limited": 0,
+            "retries": 0,
+            "queue_wait_seconds_total": 0.0,
+        }
+        self.waits: Dict[int, Deque[float]] = {}
+
+    def waiting(self) -> int:
+        return sum(len(w) for q in self.queues.values() for w in q.values())
+
+    async def acquire(self, tokens: int, level: int, key: Hashable) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        queued = time.monotonic()
+        self.queues.setdefault(level, OrderedDict()).setdefault(key, deque()).append(
+            (waiter, tokens)
+        )
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        waited = time.monotonic() - queued
+        self.stats["queue_wait_seconds_total"] += waited
+        self.waits.setdefault(level, deque(maxlen=1000)).append(waited)
+        metrics.llm_queue_wait_seconds.observe(
+            waited, priority="interactive" if level == INTERACTIVE else "background"
+        )
+
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def rate_limited(self) -> None:
+        # the provider disagrees with our budget, so everyone waits for a refill
+        self.stats["rate_limited"] += 1
+        self.requests.drain()
+
+    def _next(self) -> Tuple[Deque, OrderedDict, Hashable] | None:
+        for level in sorted(self.queues):
+            queue = self.queues[level]
+            for key, waiters in list(queue.items()):
+                while waiters and waiters[0][0].done():
+                    waiters.popleft()
+                if waiters:
+                    return waiters, queue, key
+                del queue[key]
+        return None
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrency:
+            found = self._next()
+            if found is None:
+                return
+            waiters, queue, key = found
+            waiter, tokens = waiters[0]
+            delay = max(self.requests.wait_seconds(1), self.tokens.wait_seconds(tokens))
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(
+                        delay, self._wake
+                    )
+                return
+            waiters.popleft()
+            # the next call from this key goes to the back of the line
+            queue.move_to_end(key)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.active += 1
+            self.stats["requests"] += 1
+            waiter.set_result(None)
+
+    def _wake(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def summary(self) -> Dict[str, Any]:
+        waits = {}
+        for level, recent in self.waits.items():
+            ordered = sorted(recent)
+            waits[level] = {
+                "p50": ordered[len(ordered) // 2],
+                "p99": ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)],
+            }
+        return {
+            **self.stats,
+            "active": self.active,
+            "waiting": self.waiting(),
+            "queue_wait_seconds": waits,
+        }
+
+
+    def metric_samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [
+            ("rngesus_llm_requests_total", {}, self.stats["requests"]),
+            ("rngesus_llm_rate_limited_total", {}, self.stats["rate_limited"]),
+            ("rngesus_llm_retries_total", {}, self.stats["retries"]),
+            ("rngesus_llm_active_calls", {}, self.active),
+            ("rngesus_llm_waiting_calls", {}, self.waiting()),
+        ]
+
+
+scheduler = LLMScheduler()
+metrics.collectors.append(scheduler.metric_samples)
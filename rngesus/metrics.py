@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+    TypeVar,
+)
+
+from . import config
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+LabelsT = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _labels(labels: Dict[str, str]) -> LabelsT:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(name: str, labels: LabelsT, value: float) -> str:
+    if labels:
+        rendered = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+        return f"{name}{{{rendered}}} {value}"
+    return f"{name} {value}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[LabelsT, float] = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            lines += [_format(self.name, k, v) for k, v in self.values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # per label set: bucket counts, sum, count
+        self.values: Dict[LabelsT, Tuple[List[int], float, int]] = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append(_format(f"{self.name}_bucket", key + (("le", str(bound)),), bucket))
+                lines.append(_format(f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+                lines.append(_format(f"{self.name}_sum", key, total))
+                lines.append(_format(f"{self.name}_count", key, count))
+        return lines
+
+
+metrics: List[Counter | Histogram] = []
+# called on every scrape for values that live elsewhere, returning (name, labels, value)
+collectors: List[Callable[[], List[Tuple[str, Dict[str, str], float]]]] = []
+
+
+def render() -> str:
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    for collect in collectors:
+        try:
+            samples = collect()
+        except Exception:
+            logger.exception("metrics collector failed")
+            continue
+        for name, labels, value in samples:
+            lines.append(_format(name, _labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+db_call_seconds = Histogram(
+    "rngesus_db_call_seconds",
+    "Database function time including the wait for a database thread",
+)
+db_statement_seconds = Histogram(
+    "rngesus_db_statement_seconds", "Time spent executing SQL statements"
+)
+prompt_assembly_seconds = Histogram(
+    "rngesus_prompt_assembly_seconds", "Time spent building prompt inputs"
+)
+time_to_first_token_seconds = Histogram(
+    "rngesus_time_to_first_token_seconds",
+    "Time from starting a guidance program to its first generated text",
+)
+generation_seconds = Histogram(
+    "rngesus_generation_seconds", "Total run time of a guidance program"
+)
+throttle_updates = Counter(
+    "rngesus_throttle_updates_total", "Streamed updates received by the throttle"
+)
+throttle_dropped = Counter(
+    "rngesus_throttle_dropped_total", "Streamed updates the throttle did not send on"
+)
+ndjson_bytes = Counter("rngesus_ndjson_bytes_total", "NDJSON bytes streamed to clients")
+llm_queue_wait_seconds = Histogram(
+    "rngesus_llm_queue_wait_seconds", "Time LLM calls waited for the scheduler"
+)
+http_request_seconds = Histogram(
+    "rngesus_http_request_seconds", "Time until the last byte of a response was sent"
+)
+
+
+async def track_generation(
+    program: str, iterator: AsyncIterator[T], size: Callable[[T], int] | None = None
+) -> AsyncIterator[T]:
+    # the first item that has any generated text (by `size`) counts as the first token
+    start = time.perf_counter()
+    first = False
+    try:
+        async for item in iterator:
+            if not first and (size is None or size(item) > 0):
+                first = True
+                time_to_first_token_seconds.observe(
+                    time.perf_counter() - start, program=program
+                )
+            yield item
+    finally:
+        generation_seconds.observe(time.perf_counter() - start, program=program)
+
+
+class TimingMiddleware:
+    """
+    Records how long each request took until its last byte was sent, labelled by
+    endpoint, and logs requests slower than SLOW_REQUEST_SECONDS when that is set.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        first_byte = None
+
+        async def timed_send(message):
+            nonlocal first_byte
+            if message["type"] == "http.response.body" and first_byte is None:
+                first_byte = time.perf_counter() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            http_request_seconds.observe(
+                elapsed, method=scope["method"], endpoint=endpoint
+            )
+            if config.SLOW_REQUEST_SECONDS and elapsed > config.SLOW_REQUEST_SECONDS:
+                logger.warning(
+                    "slow request %s %s took %.3fs (first byte after %s)",
+                    scope["method"],
+                    scope["path"],
+                    elapsed,
+                    "%.3fs" % first_byte if first_byte is not None else "-",
+                )
@@ -0,0 +1,132 @@
+from typing import Callable, List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from .models import campaign_sections
+
+
+def _add_missing_columns(
+    connection: Connection, table: str, columns: List[str]
+) -> None:
+    existing = {
+        row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))
+    }
+    for column in columns:
+        if column.split()[0] not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column}"))
+
+
+def _campaign_columns(connection: Connection) -> None:
+    # these were added by hand to databases created before the columns existed
+    _add_missing_columns(
+        connection,
+        "campaign",
+        ["prompt VARCHAR", "summary VARCHAR", "scenario VARCHAR"],
+    )
+    _add_missing_columns(connection, "character", ["activated INTEGER"])
+
+
+def _campaign_indexes(connection: Connection) -> None:
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_chat_campaign_id_id "
+            "ON chat (campaign_id, id)"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_character_campaign_id_activated "
+            "ON character (campaign_id, activated)"
+        )
+    )
+
+
+def _job_queue_index(connection: Connection) -> None:
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_job_status_priority_id "
+            "ON job (status, priority, id)"
+        )
+    )
+
+
+def _search_index(connection: Connection) -> None:
+    # chat messages are indexed by triggers, so that the streaming write-behind
+    # updates keep the index current without going through the ORM
+    connection.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5("
+            "message, content='chat', content_rowid='id', "
+            "tokenize='porter unicode61')"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat BEGIN "
+            "INSERT INTO chat_fts(rowid, message) VALUES (new.id, new.message); END"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat BEGIN "
+            "INSERT INTO chat_fts(chat_fts, rowid, message) "
+            "VALUES ('delete', old.id, old.message); END"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER IF NOT EXISTS chat_fts_update "
+            "AFTER UPDATE OF message ON chat BEGIN "
+            "INSERT INTO chat_fts(chat_fts, rowid, message) "
+            "VALUES ('delete', old.id, old.message); "
+            "INSERT INTO chat_fts(rowid, message) VALUES (new.id, new.message); END"
+        )
+    )
+    connection.execute(text("INSERT INTO chat_fts(chat_fts) VALUES ('rebuild')"))
+    # campaign descriptions are split into sections in python, see
+    # database.index_campaign
+    connection.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS campaign_fts USING fts5("
+            "text, campaign_id UNINDEXED, section UNINDEXED, "
+            "tokenize='porter unicode61')"
+        )
+    )
+    connection.execute(text("DELETE FROM campaign_fts"))
+    for id, description in connection.execute(
+        text("SELECT id, description FROM campaign")
+    ).all():
+        for section, part in campaign_sections(description):
+            connection.execute(
+                text(
+                    "INSERT INTO campaign_fts(text, campaign_id, section) "
+                    "VALUES (:text, :campaign_id, :section)"
+                ),
+                {"text": part, "campaign_id": id, "section": section},
+            )
+
+
+# append only: each migration runs once, in order, and its number is stored in
+# sqlite's user_version once it has been applied
+MIGRATIONS: List[Tuple[int, Callable[[Connection], None]]] = [
+    (1, _campaign_columns),
+    (2, _campaign_indexes),
+    (3, _job_queue_index),
+    (4, _search_index),
+]
+
+
+def current_version(connection: Connection) -> int:
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def migrate(engine: Engine) -> int:
+    with engine.begin() as connection:
+        version = current_version(connection)
+        for number, migration in MIGRATIONS:
+            if number > version:
+                migration(connection)
+                connection.execute(text(f"PRAGMA user_version = {number}"))
+                version = number
+    return version
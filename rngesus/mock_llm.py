@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import random
+import time
+from typing import Dict, Iterator, List
+
+import guidance
+from guidance.llms._llm import LLMSession
+
+from . import config
+
+WORDS = (
+    "ancient bold crimson dragon ember fable goblin harbor iron jade keep lantern "
+    "moon northern oath portal quest raven silver tower umber vale warden yonder"
+).split()
+
+
+class SyntheticLLM(guidance.llms.Mock):
+    """
+    Local stand-in for the OpenAI backend, selected with LLM_BACKEND=mock. Every `gen`
+    waits `latency_seconds` (without blocking the event loop) and then streams up to
+    `max_tokens` tokens at `tokens_per_second`. The text comes from `script` if given,
+    otherwise it is made of words picked from a seed derived from the prompt, with
+    commas in between so that the list-valued fields of our programs parse.
+    """
+
+    def __init__(
+        self,
+        tokens_per_second: float = config.MOCK_LLM_TOKENS_PER_SECOND,
+        latency_seconds: float = config.MOCK_LLM_LATENCY_SECONDS,
+        max_tokens: int = config.MOCK_LLM_MAX_TOKENS,
+        script: str | None = None,
+    ):
+        super().__init__("")
+        self.model_name = "mock"
+        self.tokens_per_second = tokens_per_second
+        self.latency_seconds = latency_seconds
+        self.max_tokens = max_tokens
+        self.script = script.split() if script else None
+        self.calls = 0
+        self.tokens = 0
+        # streams that have been started and not yet read to the end or closed
+        self.streaming = 0
+
+    def session(self, asynchronous=False):
+        if asynchronous:
+            return SyntheticSession(self)
+        return super().session(asynchronous)
+
+    def words(self, prompt: str, count: int) -> List[str]:
+        if self.script:
+            start = self.calls % len(self.script)
+            return [
+                self.script[(start + i) % len(self.script)] for i in range(count)
+            ]
+        seed = int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [
+            rng.choice(WORDS) + ("," if i % 3 == 2 else "") for i in range(count)
+        ]
+
+
+class SyntheticSession(LLMSession):
+    async def __call__(
+        self, prompt, stop=None, stop_regex=None, n=1, max_tokens=1000, stream=None, **kwargs
+    ):
+        llm: SyntheticLLM = self.llm
+        llm.calls += 1
+        words = llm.words(prompt, min(max_tokens or llm.max_tokens, llm.max_tokens))
+        llm.tokens += len(words)
+        await asyncio.sleep(llm.latency_seconds)
+        if stream or stop_regex is not None:
+            return _paced(words, llm)
+        if llm.tokens_per_second:
+            await asyncio.sleep(len(words) / llm.tokens_per_second)
+        text = "".join(" " + w for w in words)
+        return {"choices": [{"text": text, "finish_reason": "stop"}] * n}
+
+
+def _paced(words: List[str], llm: SyntheticLLM) -> Iterator[Dict]:
+    """
+    guidance reads streams synchronously and only yields to the event loop between
+    chunks, so pacing cannot await. Until the next word is due this hands back empty
+    chunks, sleeping at most half a millisecond each so other tasks and the database
+    threads keep running.
+    """
+    tokens_per_second = llm.tokens_per_second
+    start = time.monotonic()
+    sent = 0
+    llm.streaming += 1
+    try:
+        while sent < len(words):
+            due = len(words) if not tokens_per_second else int(
+                (time.monotonic() - start) * tokens_per_second
+            ) + 1
+            if due <= sent:
+                time.sleep(0.0005)
+                yield {"choices": [{"text": "", "finish_reason": None}]}
+                continue
+            text = "".join(" " + w for w in words[sent:due])
+            sent = min(due, len(words))
+            yield {"choices": [{"text": text, "finish_reason": None}]}
+    finally:
+        llm.streaming -= 1
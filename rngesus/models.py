@@ -1,10 +1,29 @@
 import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar
 from pydantic import BaseModel
 
 from sqlmodel import JSON, Column, Field, SQLModel
 
 
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def from_row(model: Type[ModelT], columns: List[Any], row: Tuple) -> ModelT:
+    # rows come from our own tables, so they are not validated again
+    return model.construct(**{column.key: value for column, value in zip(columns, row)})
+
+
+def field_columns(table: Type[SQLModel], fields: str) -> List[Any]:
+    """The columns named in a comma-separated `fields` parameter, e.g. "id,title"."""
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in table.__fields__]
+    if not names:
+        raise ValueError("no fields given")
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return [getattr(table, name) for name in dict.fromkeys(names)]
+
+
 class Campaign(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     prompt: str = ''
@@ -25,7 +44,16 @@ class CampaignSummary(BaseModel):
     summary: Optional[str] = ''
 
 def campaign_summary(tuple: Tuple[int, str, str]) -> CampaignSummary:
-    return CampaignSummary(id=tuple[0], title=tuple[1], summary=tuple[2])
+    return from_row(CampaignSummary, CampaignSummaryTuple, tuple)
+
+
+# the generated description is these sections joined by "\n---\n"
+CAMPAIGN_SECTIONS = ["pitch", "story", "mechanics"]
+
+
+def campaign_sections(description: Optional[str]) -> List[Tuple[str, str]]:
+    parts = (description or "").split("\n---\n")
+    return [(name, part) for name, part in zip(CAMPAIGN_SECTIONS, parts) if part]
 
 
 class Character(SQLModel, table=True):
@@ -58,9 +86,33 @@ class CharacterSummary(BaseModel):
 
 
 def character_summary(tuple: Tuple[int, str, str, str]) -> CharacterSummary:
-    return CharacterSummary(
-        id=tuple[0], name=tuple[1], character_class=tuple[2], character_type=tuple[3]
-    )
+    return from_row(CharacterSummary, CharacterSummaryTuple, tuple)
+
+
+# what the DM prompt needs of each active character
+CharacterPromptTuple = [
+    Character.id,
+    Character.name,
+    Character.character_class,
+    Character.character_type,
+    Character.attributes,
+    Character.backstory,
+    Character.primary_goal,
+]
+
+
+class CharacterPrompt(BaseModel):
+    id: int
+    name: Optional[str]
+    character_class: str
+    character_type: str
+    attributes: Dict[str, int]
+    backstory: str
+    primary_goal: str
+
+
+def character_prompt(tuple: Tuple) -> CharacterPrompt:
+    return from_row(CharacterPrompt, CharacterPromptTuple, tuple)
 
 
 class Chat(SQLModel, table=True):
@@ -68,3 +120,41 @@ class Chat(SQLModel, table=True):
     campaign_id: int
     user_type: str
     message: str
+
+
+class ChatSummary(SQLModel, table=True):
+    campaign_id: int = Field(primary_key=True)
+    through_chat_id: int
+    summary: str
+
+
+# a search result: a chat message or a section of the campaign description
+class SearchHit(BaseModel):
+    # "chat" or one of CAMPAIGN_SECTIONS
+    source: str
+    # the chat message's id, None for campaign sections
+    id: Optional[int]
+    user_type: Optional[str]
+    snippet: str
+    # bm25 relevance, higher is better
+    score: float
+
+
+class Job(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # "campaign" or "characters"
+    kind: str
+    owner: str = ""
+    # higher runs first
+    priority: int = 0
+    # queued, running, done or failed
+    status: str = "queued"
+    campaign_id: Optional[int]
+    params: Dict[str, Any] = Field(sa_column=Column(JSON), default={})
+    # number of updates the generation has produced so far
+    progress: int = 0
+    error: Optional[str]
+    # times are in milliseconds
+    created: int
+    started: Optional[int]
+    finished: Optional[int]
@@ -0,0 +1,86 @@
+import hashlib
+import json
+from typing import Any, AsyncIterator, Dict, List
+
+from pydantic import BaseModel
+
+from . import metrics
+
+MEDIA_TYPE = "application/ndjson"
+DELTA_MEDIA_TYPE = "application/x-ndjson-delta"
+
+
+def wants_delta(accept: str | None, delta: bool = False) -> bool:
+    return delta or (accept is not None and DELTA_MEDIA_TYPE in accept)
+
+
+async def generate_nd_json(iterator: AsyncIterator[BaseModel]) -> AsyncIterator[str]:
+    async for c in iterator:
+        line = c.json() + "\n"
+        metrics.ndjson_bytes.inc(len(line), format="full")
+        yield line
+
+
+async def generate_nd_json_delta(
+    iterator: AsyncIterator[BaseModel],
+) -> AsyncIterator[str]:
+    """
+    Streams a model as one snapshot frame followed by patch frames, then a checksum frame:
+
+        {"snapshot": {...}}
+        {"patch": [{"op": "append", "field": "message", "value": " and then"}]}
+        {"checksum": "<sha256>", "frames": 12}
+
+    "append" extends a string or list field with `value`, "replace" sets the field to `value`.
+    The checksum is the sha256 of the final state encoded with sorted keys, no whitespace and
+    no ascii escaping, so clients can verify that they rebuilt the same object.
+    """
+    state = None
+    frames = 0
+    async for c in iterator:
+        current = c.dict()
+        if state is None:
+            frame = {"snapshot": current}
+        else:
+            ops = diff(state, current)
+            if not ops:
+                continue
+            frame = {"patch": ops}
+        state = current
+        frames += 1
+        line = _dumps(frame) + "\n"
+        metrics.ndjson_bytes.inc(len(line), format="delta")
+        yield line
+    if state is not None:
+        line = _dumps({"checksum": checksum(state), "frames": frames}) + "\n"
+        metrics.ndjson_bytes.inc(len(line), format="delta")
+        yield line
+
+
+def diff(previous: Dict[str, Any], current: Dict[str, Any]) -> List[Dict[str, Any]]:
+    ops = []
+    for field, value in current.items():
+        old = previous.get(field)
+        if field in previous and old == value:
+            continue
+        if (
+            isinstance(value, (str, list))
+            and type(old) is type(value)
+            and len(value) > len(old)
+            and value[: len(old)] == old
+        ):
+            ops.append({"op": "append", "field": field, "value": value[len(old) :]})
+        else:
+            ops.append({"op": "replace", "field": field, "value": value})
+    return ops
+
+
+def checksum(state: Dict[str, Any]) -> str:
+    canonical = json.dumps(
+        state, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _dumps(frame: Dict[str, Any]) -> str:
+    return json.dumps(frame, default=str)
@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+import random
+from typing import Any, Iterator
+
+import guidance
+import openai
+from guidance.llms._openai import OpenAISession
+
+from . import config
+from .llm_scheduler import RateLimited, fairness_key, priority, scheduler
+
+# the scheduler slot held by the current call, if it holds one
+_slot: contextvars.ContextVar[Any] = contextvars.ContextVar("llm_slot", default=None)
+
+
+class _SlotRequired(Exception):
+    pass
+
+
+class _Slot:
+    def __init__(self):
+        self.released = False
+        # streamed calls hold their slot until the stream has been read or dropped
+        self.streaming = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            scheduler.release()
+
+
+def _release_when_done(stream: Iterator, slot: _Slot) -> Iterator:
+    try:
+        yield from stream
+    finally:
+        slot.release()
+
+
+class ScheduledSession(OpenAISession):
+    async def __call__(self, prompt, *args, **kwargs):
+        counts = dict(self._call_counts)
+        try:
+            # cached responses are answered without waiting for a slot
+            return await super().__call__(prompt, *args, **kwargs)
+        except _SlotRequired:
+            self._call_counts = counts
+        tokens = len(self.llm.encode(prompt)) + (kwargs.get("max_tokens") or 1000) * (
+            kwargs.get("n") or 1
+        )
+        for attempt in range(config.LLM_MAX_RETRIES + 1):
+            await scheduler.acquire(tokens, priority.get(), fairness_key.get())
+            slot = _Slot()
+            token = _slot.set(slot)
+            try:
+                return await super().__call__(prompt, *args, **kwargs)
+            except RateLimited:
+                scheduler.rate_limited()
+                if attempt == config.LLM_MAX_RETRIES:
+                    raise
+            finally:
+                _slot.reset(token)
+                if not slot.streaming:
+                    slot.release()
+            self._call_counts = dict(counts)
+            scheduler.stats["retries"] += 1
+            backoff = min(
+                config.LLM_BACKOFF_SECONDS * 2**attempt, config.LLM_BACKOFF_MAX_SECONDS
+            )
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+
+
+class ScheduledOpenAI(guidance.llms.OpenAI):
+    """
+    guidance's OpenAI backend with every uncached call going through `scheduler`.
+    guidance's own retry loop sleeps for a fixed 3 seconds on a 429, so those are
+    raised as RateLimited instead and retried here with jittered backoff.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # the scheduler enforces the request budget
+        kwargs.setdefault("max_calls_per_min", 1_000_000)
+        super().__init__(*args, **kwargs)
+        self._unscheduled_caller = self.caller
+        self.caller = self._scheduled_call
+
+    def _scheduled_call(self, **kwargs):
+        slot = _slot.get()
+        if slot is None:
+            raise _SlotRequired()
+        try:
+            out = self._unscheduled_caller(**kwargs)
+        except openai.error.RateLimitError as e:
+            raise RateLimited(str(e)) from e
+        if kwargs.get("stream"):
+            slot.streaming = True
+            return _release_when_done(out, slot)
+        return out
+
+    def session(self, asynchronous=False):
+        if asynchronous:
+            return ScheduledSession(self)
+        return super().session(asynchronous)
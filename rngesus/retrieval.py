@@ -0,0 +1,333 @@
+"""
+Recall of older chat turns for the DM prompt, without leaving the machine.
+
+Every message is split into chunks of RETRIEVAL_CHUNK_WORDS words and each chunk is
+stored as a sparse hashed term-frequency vector: the words are hashed into BUCKETS
+buckets and every bucket the chunk uses is one (bucket, weight) entry. A campaign's
+entries and chunks are two append-only files in the retrieval directory, read through
+numpy memmaps. Inverse document frequencies are applied to the query, so adding a
+message never rewrites what is already stored.
+
+The first search of a campaign sorts its entries by bucket in memory so that a query
+only reads the entries of its own terms; whatever is appended afterwards is scanned
+until there is enough of it to sort again.
+"""
+import bisect
+import logging
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import config, database
+from .models import Campaign, Chat
+from .rngesus import count_tokens
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = 1 << 16
+ENTRY = np.dtype([("bucket", "<u2"), ("weight", "<f2")])
+# entries[start:end] are the chunk's terms; chat_id is -1 once the message has been
+# rewritten or deleted
+CHUNK = np.dtype(
+    [("chat_id", "<i8"), ("chunk", "<i4"), ("start", "<i8"), ("end", "<i8")]
+)
+# query terms weighing less than this share of the heaviest one are left out, as the
+# words most chunks share would otherwise make a search read most of the index
+QUERY_TERM_CUTOFF = 0.05
+# entries appended since the last sort that a search scans before sorting again
+UNSORTED_ENTRIES = 100_000
+
+
+def directory() -> str:
+    if config.RETRIEVAL_PATH:
+        return config.RETRIEVAL_PATH
+    db = database.engine.url.database or "rngesus.db"
+    return os.path.splitext(db)[0] + ".retrieval"
+
+
+def chunks(message: str, words: int = config.RETRIEVAL_CHUNK_WORDS) -> List[str]:
+    split = message.split()
+    return [" ".join(split[i : i + words]) for i in range(0, len(split), words)]
+
+
+def terms(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """The buckets `text` hashes into and their sublinear term frequencies."""
+    words = re.findall(r"\w+", text.lower())
+    hashed = np.fromiter(
+        (zlib.crc32(word.encode()) for word in words), np.uint32, len(words)
+    )
+    buckets, counts = np.unique(hashed % BUCKETS, return_counts=True)
+    return buckets.astype(np.uint16), 1 + np.log(counts)
+
+
+def _size(path: str, dtype: np.dtype) -> int:
+    return os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+
+
+def _read(path: str, dtype: np.dtype) -> np.ndarray:
+    size = _size(path, dtype)
+    if size == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(size,))
+
+
+def _owners(rows: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """The chunk each entry position belongs to, -1 for entries no chunk points at."""
+    owners = np.searchsorted(rows["start"], positions, side="right") - 1
+    inside = (owners >= 0) & (positions < rows["end"][np.maximum(owners, 0)])
+    return np.where(inside, owners, -1)
+
+
+class Postings:
+    """A campaign's first `sorted` entries ordered by bucket, held in memory."""
+
+    def __init__(self, rows: np.ndarray, entries: np.ndarray):
+        starts, ends = rows["start"], rows["end"]
+        if starts[0] == 0 and np.array_equal(starts[1:], ends[:-1]):
+            # as written: every chunk starts where the one before it ended
+            owners = np.repeat(np.arange(len(rows), dtype=np.int32), ends - starts)
+            buckets = np.array(entries["bucket"][: len(owners)])
+            weights = np.array(entries["weight"][: len(owners)])
+        else:
+            owners = _owners(rows, np.arange(len(entries)))
+            used = np.flatnonzero(owners >= 0)
+            owners = owners[used].astype(np.int32)
+            buckets = entries["bucket"][used]
+            weights = entries["weight"][used]
+        order = np.argsort(buckets, kind="stable")
+        self.owners = owners[order]
+        self.weights = weights[order]
+        counts = np.bincount(buckets, minlength=BUCKETS)
+        self.offsets = np.zeros(BUCKETS + 1, np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.sorted = len(entries)
+        # live chunks per bucket and in all, for the inverse document frequencies
+        for i in np.flatnonzero(rows["chat_id"] < 0):
+            np.subtract.at(counts, entries["bucket"][starts[i] : ends[i]], 1)
+        self.df = counts
+        self.live = int(np.count_nonzero(rows["chat_id"] >= 0))
+
+
+class CampaignIndex:
+    def __init__(self, campaign_id: int):
+        self.campaign_id = campaign_id
+        self.entries_path = os.path.join(directory(), f"{campaign_id}.entries")
+        self.chunks_path = os.path.join(directory(), f"{campaign_id}.chunks")
+        # memmaps are only held under the lock, as truncating a mapped file under a
+        # reader would crash it
+        self.lock = threading.Lock()
+        # built by the first search, dropped when too many campaigns have one
+        self.postings: Optional[Postings] = None
+
+    def _count(self, buckets: np.ndarray, by: int) -> None:
+        postings = self.postings
+        if postings is not None:
+            np.add.at(postings.df, buckets, by)
+            postings.live += by
+
+    def _append(self, chats: List[Chat]) -> None:
+        offset = _size(self.entries_path, ENTRY)
+        entries, rows = [], []
+        for chat in chats:
+            for number, text in enumerate(chunks(chat.message)):
+                buckets, tf = terms(text)
+                if not len(buckets):
+                    continue
+                entry = np.empty(len(buckets), ENTRY)
+                entry["bucket"] = buckets
+                entry["weight"] = tf / np.linalg.norm(tf)
+                entries.append(entry)
+                rows.append((chat.id, number, offset, offset + len(entry)))
+                offset += len(entry)
+                self._count(buckets, 1)
+        if not rows:
+            return
+        os.makedirs(os.path.dirname(self.entries_path), exist_ok=True)
+        # entries first, so that a chunk never points past the end of the entries
+        with open(self.entries_path, "ab") as f:
+            f.write(np.concatenate(entries).tobytes())
+        with open(self.chunks_path, "ab") as f:
+            f.write(np.array(rows, CHUNK).tobytes())
+
+    def _forget(self, chat_id: int) -> None:
+        rows = _read(self.chunks_path, CHUNK)
+        entries = _read(self.entries_path, ENTRY)
+        old = np.flatnonzero(rows["chat_id"] == chat_id)
+        for i in old:
+            self._count(entries["bucket"][rows["start"][i] : rows["end"][i]], -1)
+        if len(old) and old[0] == len(rows) - len(old):
+            # the latest message, rewritten every flush while it streams: cut it off
+            # rather than leave its old versions behind
+            cut = int(rows["start"][old[0]])
+            del rows, entries
+            os.truncate(self.chunks_path, int(old[0]) * CHUNK.itemsize)
+            os.truncate(self.entries_path, cut * ENTRY.itemsize)
+            postings = self.postings
+            if postings is not None and cut < postings.sorted:
+                self.postings = None
+        elif len(old):
+            del rows, entries
+            with open(self.chunks_path, "r+b") as f:
+                for i in old:
+                    f.seek(int(i) * CHUNK.itemsize)
+                    f.write(np.array(-1, "<i8").tobytes())
+
+    def add(self, chat: Chat) -> None:
+        with self.lock:
+            # until the first catch_up has indexed the history there is nothing to
+            # add to, and adding would hide the older messages from it
+            if os.path.exists(self.chunks_path):
+                self._forget(chat.id)
+                self._append([chat])
+
+    def remove(self, chat_id: int) -> None:
+        with self.lock:
+            self._forget(chat_id)
+
+    def catch_up(self, dialog: List[Chat]) -> None:
+        """Indexes whatever of `dialog` was written while nobody was listening."""
+        with self.lock:
+            rows = _read(self.chunks_path, CHUNK)
+            last = int(rows["chat_id"].max()) if len(rows) else 0
+            del rows
+            if dialog and dialog[-1].id > last:
+                start = bisect.bisect_right(dialog, last, key=lambda chat: chat.id)
+                self._append(dialog[start:])
+
+    def drop(self) -> None:
+        with self.lock:
+            for path in (self.entries_path, self.chunks_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.postings = None
+
+    def search(
+        self, query: str, k: int, before_id: int
+    ) -> List[Tuple[int, int, float]]:
+        """(chat id, chunk, score) of the best chunks of messages before `before_id`."""
+        buckets, tf = terms(query)
+        if not len(buckets):
+            return []
+        with self.lock:
+            rows = _read(self.chunks_path, CHUNK)
+            entries = _read(self.entries_path, ENTRY)
+            if not len(rows):
+                return []
+            postings = self.postings
+            if postings is None or len(entries) - postings.sorted > UNSORTED_ENTRIES:
+                postings = self.postings = Postings(rows, entries)
+                _loaded(self)
+            idf = np.log((1 + postings.live) / (1 + postings.df[buckets])) + 1
+            weights = tf * idf * idf
+            weights /= np.linalg.norm(weights)
+            kept = weights >= weights.max() * QUERY_TERM_CUTOFF
+            buckets, weights = buckets[kept].astype(np.int64), weights[kept]
+            starts, ends = postings.offsets[buckets], postings.offsets[buckets + 1]
+            owners = [postings.owners[s:e] for s, e in zip(starts, ends)]
+            scores = [
+                postings.weights[s:e] * w for s, e, w in zip(starts, ends, weights)
+            ]
+            # entries appended since the postings were sorted
+            unsorted = entries[postings.sorted :]
+            lookup = np.zeros(BUCKETS, np.float32)
+            lookup[buckets] = weights
+            scored = lookup[unsorted["bucket"]]
+            hits = np.flatnonzero(scored)
+            owner = _owners(rows, hits + postings.sorted)
+            owners.append(owner[owner >= 0])
+            scores.append((scored[hits] * unsorted["weight"][hits])[owner >= 0])
+            totals = np.bincount(
+                np.concatenate(owners),
+                weights=np.concatenate(scores),
+                minlength=len(rows),
+            )
+            ids = np.array(rows["chat_id"])
+            numbers = np.array(rows["chunk"])
+            del rows, entries, unsorted
+        totals[(ids < 0) | (ids >= before_id)] = 0
+        best = np.argpartition(-totals, min(k, len(totals) - 1))[:k]
+        return sorted(
+            (
+                (int(ids[i]), int(numbers[i]), float(totals[i]))
+                for i in best
+                if totals[i] >= config.RETRIEVAL_MIN_SCORE
+            ),
+            key=lambda hit: -hit[2],
+        )
+
+
+indexes: Dict[int, CampaignIndex] = {}
+# campaigns with postings in memory, least recently built first
+loaded: OrderedDict[int, CampaignIndex] = OrderedDict()
+_lock = threading.Lock()
+
+
+def _loaded(index: CampaignIndex) -> None:
+    with _lock:
+        loaded[index.campaign_id] = index
+        loaded.move_to_end(index.campaign_id)
+        while len(loaded) > config.CHAT_STATE_CACHE_SIZE:
+            _, evicted = loaded.popitem(last=False)
+            # rebuilt by its next search
+            evicted.postings = None
+
+
+def index(campaign_id: int) -> CampaignIndex:
+    with _lock:
+        found = indexes.get(campaign_id)
+        if found is None:
+            found = indexes[campaign_id] = CampaignIndex(campaign_id)
+        return found
+
+
+def recall(
+    campaign_id: int,
+    dialog: List[Chat],
+    recent: List[Chat],
+    k: int = config.RETRIEVAL_TOP_K,
+    token_budget: int = config.RETRIEVAL_TOKENS,
+) -> List[Chat]:
+    """
+    The chunks of turns older than `recent` that are most relevant to its last few
+    turns, oldest first, as Chats holding just the chunk.
+    """
+    if not k or not recent or not dialog or recent[0].id <= dialog[0].id:
+        return []
+    found = index(campaign_id)
+    found.catch_up(dialog)
+    query = " ".join(c.message for c in recent[-config.RETRIEVAL_QUERY_TURNS :])
+    picked, tokens = [], 0
+    for chat_id, number, _ in found.search(query, k, recent[0].id):
+        at = bisect.bisect_left(dialog, chat_id, key=lambda chat: chat.id)
+        chat = dialog[at] if at < len(dialog) else None
+        parts = chunks(chat.message) if chat and chat.id == chat_id else []
+        if number >= len(parts):
+            continue
+        tokens += count_tokens(parts[number])
+        if tokens > token_budget:
+            break
+        picked.append((chat_id, number, chat.user_type, parts[number]))
+    return [
+        Chat(id=id, campaign_id=campaign_id, user_type=user_type, message=text)
+        for id, _, user_type, text in sorted(picked)
+    ]
+
+
+def on_change(row, deleted: bool) -> None:
+    # the index can be rebuilt from the database, so a failure here must not fail the
+    # write that has already been committed
+    try:
+        if isinstance(row, Chat):
+            if deleted:
+                index(row.campaign_id).remove(row.id)
+            else:
+                index(row.campaign_id).add(row)
+        elif isinstance(row, Campaign) and deleted:
+            index(row.id).drop()
+    except Exception:
+        logger.exception("could not index %r", row)
@@ -1,13 +1,13 @@
-from typing import AsyncIterator, Dict
+import asyncio
+from typing import AsyncIterator, Dict, NamedTuple, Set, Tuple
 
-import guidance
-
-from .. import config
+from .. import config, metrics
+from ..llm import Program
 from ..database import Campaign
-from .prompts import parse_comma_delimited_list, throttle
+from .prompts import ThrottlePolicy, parse_comma_delimited_list, throttle
 
 
-gen_campaign = guidance(
+gen_campaign = Program(
     '''
 {{#system~}}
 You are an author of RPG games.
@@ -92,19 +92,195 @@ Write a reminder that can later be referred to in order to remember this game. N
 )
 
 
+gen_campaign_section = Program(
+    '''
+{{#system~}}
+You are an author of RPG games.
+
+You love doing this! You think deeply about games.
+You love imagining new game worlds to explore, inventing story intrigue. You have limitless imagination!
+
+You love coming up with new game mechanics! Who wants to play the same game again? You like to re-invent the genre.
+{{/system~}}
+{{#user~}}
+Create a game according to this premise:
+
+"""
+{{prompt}}
+"""
+{{~/user~}}
+{{#each context~}}
+{{#user~}}
+{{this.question}}
+{{~/user~}}
+{{#assistant~}}
+{{this.answer}}
+{{~/assistant~}}
+{{/each~}}
+{{#user~}}
+{{question}}
+{{~/user~}}
+{{#assistant~}}
+{{gen 'answer' temperature=temperature max_tokens=max_tokens}}
+{{~/assistant~}}
+'''
+)
+
+
+class Section(NamedTuple):
+    question: str
+    depends: Tuple[str, ...]
+    temperature: float
+    max_tokens: int
+
+
+# the same questions as gen_campaign, but each section only sees the sections it
+# depends on, so that independent ones can be generated at the same time
+SECTIONS: Dict[str, Section] = {
+    "title": Section("First, give the game an exciting title!", (), 1, 20),
+    "description": Section("Give us a quick elevator pitch!", ("title",), 1, 500),
+    "character_classes": Section(
+        '''Does the game have any character classes?
+Respond with ONLY a comma delimited list of the the character class names. 
+Respond with between 1 and 8 classes.
+For example: "Attorney, Designer, Janitor"''',
+        ("title", "description"),
+        0.3,
+        30,
+    ),
+    "character_types": Section(
+        '''Who are the types of people in this story and where do they come from? Describe the socio-ethnic types in the game. Whatever fits the story. 
+Think outside of the box!
+Respond with between 1 and 8 types.
+Respond with ONLY a comma delimited list of the types. 
+For example: "Human, Half-Alien, Sentient Printer"''',
+        ("title", "description"),
+        0.3,
+        30,
+    ),
+    "character_attributes": Section(
+        '''What are the attributes in the game? Whatever fits the story.
+Respond with only a comma delimited list of attribute names.
+Respond with between 1 and 8 attributes.
+For example: "Power, Influence, Magic, Luck, Flexibility"''',
+        ("title", "description"),
+        0.3,
+        30,
+    ),
+    "story": Section(
+        """What's the hook. Tell me about the game world, and the story intrigue.
+Get specific. Tell me details about how the story starts: an intriguing scene or incident.""",
+        ("title", "description"),
+        0.9,
+        500,
+    ),
+    "mechanics": Section(
+        """What are the mechanics? I want to know what makes this game unique from other RPGs! 
+
+- Get specific. How do players affect the game?
+- Feel free to make up new rules that go beyond the standards of the genre.
+- The game can only use standard tools available at a table-top: attributes, scores, dice, and a big imagination.
+- You have as many dice as you want available to you: D4, D6, D8, D10, D12, D20, D100.
+- For each mechanic, give an example. Include any calculations, such as dice roles, modifiers, etc.""",
+        ("title", "description", "character_attributes", "story"),
+        0.9,
+        500,
+    ),
+    "summary": Section(
+        """Write a reminder that can later be referred to in order to remember this game. No more than a paragraph, and focus on things that are unique to this game: title, setting, story, mechanics.""",
+        (
+            "title",
+            "description",
+            "character_classes",
+            "character_types",
+            "character_attributes",
+            "story",
+            "mechanics",
+        ),
+        0.3,
+        500,
+    ),
+}
+
+
+async def generate_sections_raw(
+    prompt: str, values: Dict[str, str]
+) -> AsyncIterator[Dict[str, str]]:
+    values = dict(values)
+    # set once a section has finished, whether it succeeded or not
+    done = {name: asyncio.Event() for name in SECTIONS}
+    failed: Set[str] = set()
+    changed = asyncio.Event()
+
+    async def generate_section(name: str) -> None:
+        section = SECTIONS[name]
+        try:
+            if not values.get(name):
+                for d in section.depends:
+                    await done[d].wait()
+                if failed.intersection(section.depends):
+                    # the section it needs raises the error
+                    failed.add(name)
+                    return
+                program = gen_campaign_section.stream(
+                    prompt=prompt,
+                    context=[
+                        {"question": SECTIONS[d].question, "answer": values[d]}
+                        for d in section.depends
+                    ],
+                    question=section.question,
+                    temperature=section.temperature,
+                    max_tokens=section.max_tokens,
+                )
+                async for generated in program:
+                    values[name] = generated.get("answer") or ""
+                    changed.set()
+        except BaseException:
+            failed.add(name)
+            raise
+        finally:
+            done[name].set()
+            changed.set()
+
+    tasks = [asyncio.create_task(generate_section(name)) for name in SECTIONS]
+    try:
+        while True:
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception():
+                    raise task.exception()
+            if all(task.done() for task in tasks):
+                break
+            waiter = asyncio.ensure_future(changed.wait())
+            await asyncio.wait(
+                [task for task in tasks if not task.done()] + [waiter],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            waiter.cancel()
+            changed.clear()
+            yield dict(values)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    yield dict(values)
+
+
 def generate_campaign_raw(**kwargs) -> AsyncIterator[Dict[str, any]]:
-    return gen_campaign(async_mode=True, stream=True, silent=config.SILENT_GUIDANCE, **kwargs)
+    return gen_campaign.stream(**kwargs)
 
 
 def generate_new_campaign(
     prompt: str,
-    update_frequency_seconds: int = 5,
+    policy: ThrottlePolicy | None = None,
+    parallel: bool = config.PARALLEL_CAMPAIGN_GENERATION,
 ) -> AsyncIterator[Campaign]:
-    return generate_campaign(Campaign(prompt=prompt), update_frequency_seconds)
+    return generate_campaign(Campaign(prompt=prompt), policy, parallel)
 
 
 async def generate_campaign(
-    campaign: Campaign, update_frequency_seconds: int = 5
+    campaign: Campaign,
+    policy: ThrottlePolicy | None = None,
+    parallel: bool = config.PARALLEL_CAMPAIGN_GENERATION,
 ) -> AsyncIterator[Campaign]:
     description_parts = campaign.description.split("\n---\n")
     kwargs = {
@@ -118,7 +294,18 @@ async def generate_campaign(
         "mechanics": "".join(description_parts[2:3]),
         "summary": campaign.summary,
     }
-    async for generated in throttle(generate_campaign_raw(**kwargs)):
+    if parallel:
+        raw = generate_sections_raw(campaign.prompt, kwargs)
+    else:
+        raw = generate_campaign_raw(**kwargs)
+    size = lambda generated: sum(len(generated.get(k) or "") for k in kwargs)
+    throttled = throttle(
+        metrics.track_generation("campaign", raw, size),
+        policy=policy or ThrottlePolicy.parse(config.THROTTLE_CAMPAIGN),
+        size=size,
+        name="campaign",
+    )
+    async for generated in throttled:
         merged = {k: v if v else generated.get(k) or "" for k, v in kwargs.items()}
         yield Campaign(
             id=campaign.id,
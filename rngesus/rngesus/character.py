@@ -1,18 +1,23 @@
+import itertools
 import random
 import re
 
-from typing import AsyncIterator, Dict, List
-
-import guidance
+from typing import AsyncIterator, Dict, List, Tuple
 
 from ..models import CharacterSummary
 
-from .prompts import parse_comma_delimited_list, parse_int_kv_dict, throttle
+from .prompts import (
+    ThrottlePolicy,
+    parse_comma_delimited_list,
+    parse_int_kv_dict,
+    throttle,
+)
 
 from ..database import Campaign, Character
-from .. import config
+from .. import config, metrics
+from ..llm import Program
 
-gen_char = guidance(
+gen_char = Program(
     '''
 {{#system~}}
 You are the dungeon master of an RPG game.
@@ -71,24 +76,36 @@ Respond with just the items separated by commas. For example: "Water pouch, Swor
 async def roll_character(
     campaign: Campaign, 
     characters: List[CharacterSummary],
-    update_frequency_seconds: int = 1
+    policy: ThrottlePolicy | None = None,
+    character_class: str | None = None,
+    character_type: str | None = None,
 ) -> AsyncIterator[Character]:
-    character_class = random.choice(campaign.character_classes)
-    character_type = random.choice(campaign.character_types)
-    program = gen_char(
+    character_class = character_class or random.choice(campaign.character_classes)
+    character_type = character_type or random.choice(campaign.character_types)
+    program = gen_char.stream(
         description=campaign.summary,
         attributes=", ".join(campaign.attributes),
         characters=[x.dict() for x in characters[-5:]],
         character_class=character_class,
         character_type=character_type,
-        async_mode=True,
-        stream=True,
-        silent=config.SILENT_GUIDANCE,
     )
-    async for state in throttle(program, update_frequency_seconds):
+    policy = policy or ThrottlePolicy.parse(config.THROTTLE_CHARACTER)
+    tracked = metrics.track_generation("character", program)
+    async for state in throttle(tracked, policy=policy, name="character"):
         yield result_to_character(campaign.id, state)
 
 
+def assign_roles(
+    campaign: Campaign, characters: List[CharacterSummary], count: int
+) -> List[Tuple[str, str]]:
+    taken = {(c.character_class, c.character_type) for c in characters}
+    roles = list(itertools.product(campaign.character_classes, campaign.character_types))
+    random.shuffle(roles)
+    # roles nobody in the party has yet come first, then repeat as needed
+    roles.sort(key=lambda role: role in taken)
+    return [roles[i % len(roles)] for i in range(count)]
+
+
 def result_to_character(campaign_id: int, program: Dict[str, any]) -> Character:
     attributes = parse_int_kv_dict(program.get("attribute_results") or "")
     return Character(
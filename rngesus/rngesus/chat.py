@@ -1,53 +1,34 @@
 from typing import AsyncIterator, List, TypeVar
 
-import guidance
 from pydantic import BaseModel
 
 from rngesus.models import Chat
 
-from ..database import Campaign, Character
-from .. import config
-from .prompts import throttle
+from ..database import Campaign
+from ..models import CharacterPrompt
+from .. import config, metrics
+from ..llm import Program
+from .prompts import ThrottlePolicy, throttle
 
 
-gen_chat = guidance(
-    """
-{{#system~}}
-# RPG Game
+SYSTEM_PROMPT = """# RPG Game
 
-You are a dungeon master running a campaign for a table-top RPG game called "{{title}}" 
+You are a dungeon master running a campaign for a table-top RPG game called "{title}" 
 
 The following is a detailed description of the game and its rules:
 
 '''
-{{description}}
+{description}
 '''
 
 ## Campaign
 
-You will come up with a unique campaign for the players. There are {{character_count}} players. They have chosen the following characters:
-
-{{#each characters}}
----
-
-## Character {{add 1 @index}}
-
-- Name: {{this.name}}
-- Class: {{this.character_class}}
-- Type: {{this.character_type}}
-- Attributes: {{this.attributes}}
-
-### Backstory:
-
-{{this.backstory}}
-
-### Character Goal:
-
-{{this.primary_goal}}
-{{/each}}
+You will come up with a unique campaign for the players. There are {character_count} players. They have chosen the following characters:
 
+{characters}
 Remember, as Dungeon master:
-- If a scene requires resolution, use the character's attributes and die rolls to resolve it. Vary the size and quantity of the dice depending on the situation, and modify the results based on the size of the characters attributes. Include the math and the result of the roll in your response.
+- If a scene requires resolution, use the character's attributes and die rolls to resolve it. Vary the size and quantity of the dice depending on the situation, and modify the results based on the size of the characters attributes. Don't make up roll results: take them in order from the dice rolled for this turn, and include the math and the result of the roll in your response.
+- To have a player roll, write the roll as [roll: 1d20+3] with the dice and the modifier from their attributes. It is rolled for them and the result shown in its place; narrate what it means once you see it.
 - NPCs have attributes too. Use their attributes in any equations, but don't reveal their rolls or attributes to the players.
 - If a scenario comes up where the rules are not documented here, then make up a new rule. Make sure to explain the new rule to the players, and be consistent with any previous rules.
 - Work with the characters, a game that grows organically with the player's curiosity and interests is more exciting. You can make new things up.
@@ -57,8 +38,68 @@ Remember, as Dungeon master:
 - Be consistent
 Now briefly introduce the story to the players. Set the scene, and ask what they'd like to do!
 
-You start as dungeon master now:
+You start as dungeon master now:"""
+
+CHARACTER_PROMPT = """---
+
+## Character {number}
+
+- Name: {name}
+- Class: {character_class}
+- Type: {character_type}
+- Attributes: {attributes}
+
+### Backstory:
+
+{backstory}
+
+### Character Goal:
+
+{primary_goal}
+"""
+
+
+def render_system_prompt(campaign: Campaign, characters: List[CharacterPrompt]) -> str:
+    """
+    The part of the chat prompt that only changes with the campaign or its party. It
+    comes first and is rendered the same way every time, so that providers which cache
+    prompt prefixes can reuse it from one turn to the next.
+    """
+    party = sorted(characters, key=lambda c: c.id)
+    return SYSTEM_PROMPT.format(
+        title=campaign.title,
+        description=campaign.description,
+        character_count=len(party),
+        characters="".join(
+            CHARACTER_PROMPT.format(number=number, **character.dict())
+            for number, character in enumerate(party, 1)
+        ),
+    )
+
+
+# the story summary and the recalled turns are messages of their own so that the
+# system prompt before them stays the same while they change; the dice change every
+# turn, so they come last
+gen_chat = Program(
+    """
+{{#system~}}
+{{system_prompt}}
+{{~/system~}}
+{{#if history_summary}}
+{{#system~}}
+## The story so far
+
+{{history_summary}}
 {{~/system~}}
+{{/if~}}
+{{#if recalled_messages}}
+{{#system~}}
+## Earlier moments that may matter now
+{{#each recalled_messages}}
+{{this.user_type}}: {{this.message}}
+{{/each~}}
+{{~/system~}}
+{{/if~}}
 {{#each previous_messages~}}
 {{#if (equal this.user_type "assistant")}}
 {{#assistant~}}
@@ -71,6 +112,13 @@ You start as dungeon master now:
 {{/user~}}
 {{/if~}}
 {{/each~}}
+{{#if dice_tray}}
+{{#system~}}
+## Dice rolled for this turn
+
+{{dice_tray}}
+{{~/system~}}
+{{/if~}}
 {{#assistant~}}
 {{gen 'next' temperature=1}}
 {{/assistant}}
@@ -98,25 +146,51 @@ Start by making a short plan for the game
 {{~#system~}}
 """
 
+gen_summary = Program(
+    """
+{{#system~}}
+You keep the notes for a table-top RPG campaign called "{{title}}".
+{{~/system}}
+{{#user~}}
+{{#if summary}}These are your notes on the story so far:
+
+{{summary}}
+
+{{/if~}}
+Here is what happened next:
+{{#each messages}}
+{{this.user_type}}: {{this.message}}
+{{/each}}
+Rewrite your notes so that they include what happened next. Keep every detail that may matter later: names, places, items, promises, open threads and the outcome of rolls. Be concise, no more than a few paragraphs.
+{{~/user}}
+{{#assistant~}}
+{{gen 'summary' temperature=0 max_tokens=600}}
+{{~/assistant}}
+"""
+)
+
+
 class ChatResult(BaseModel):
     scenario: str
     assistant: str
 
 
 async def generate_chat_unthrottled(
-    campaign: Campaign, characters: List[Character], history: List[Chat]
+    system_prompt: str,
+    history: List[Chat],
+    history_summary: str = "",
+    recalled: List[Chat] = [],
+    dice_tray: str = "",
 ) -> AsyncIterator[ChatResult]:
     # guidance.llms.OpenAI.cache.clear()
     kwargs = {
-        "description": campaign.description,
-        "summary": campaign.summary,
-        "title": campaign.title,
-        "scenario": campaign.scenario,
-        "characters": [c.dict() for c in characters],
-        "character_count": len(characters),
+        "system_prompt": system_prompt,
         "previous_messages": [x.dict() for x in history],
+        "history_summary": history_summary,
+        "recalled_messages": [x.dict() for x in recalled],
+        "dice_tray": dice_tray,
     }
-    program = gen_chat(async_mode=True, stream=True, silent=config.SILENT_GUIDANCE, **kwargs)
+    program = gen_chat.stream(**kwargs)
     # return ChatResult(scenario=generated["scenario"] or "", assistant=generated["next"] or "")
     async for generated in program:
         yield ChatResult(
@@ -126,9 +200,40 @@ async def generate_chat_unthrottled(
 
 
 def generate_chat(
-    campaign: Campaign, characters: List[Character], history: List[Chat]
+    system_prompt: str,
+    history: List[Chat],
+    history_summary: str = "",
+    recalled: List[Chat] = [],
+    dice_tray: str = "",
+    policy: ThrottlePolicy | None = None,
 ) -> AsyncIterator[ChatResult]:
-    return throttle(generate_chat_unthrottled(campaign, characters, history))
+    size = lambda result: len(result.assistant)
+    return throttle(
+        metrics.track_generation(
+            "chat",
+            generate_chat_unthrottled(
+                system_prompt, history, history_summary, recalled, dice_tray
+            ),
+            size,
+        ),
+        policy=policy or ThrottlePolicy.parse(config.THROTTLE_CHAT),
+        size=size,
+        name="chat",
+    )
+
+
+async def summarize_history(
+    campaign: Campaign, summary: str, messages: List[Chat]
+) -> str:
+    with metrics.generation_seconds.time(program="summary"):
+        program = await gen_summary(
+            async_mode=True,
+            silent=config.SILENT_GUIDANCE,
+            title=campaign.title,
+            summary=summary,
+            messages=[x.dict() for x in messages],
+        )
+    return (program.get("summary") or summary).strip()
 
 
 T = TypeVar("T")
@@ -0,0 +1,93 @@
+from functools import lru_cache
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from .. import config
+from ..models import Chat, ChatSummary
+
+
+class ContextWindow(BaseModel):
+    summary: str
+    # turns rendered verbatim, oldest first
+    recent: List[Chat]
+    # turns that fell out of the window but are not part of the summary yet
+    unsummarized: List[Chat]
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(config.OPENAI_MODEL)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def build_window(
+    history: List[Chat],
+    summary: Optional[ChatSummary],
+    max_turns: int = config.CHAT_CONTEXT_TURNS,
+    token_budget: int = config.CHAT_CONTEXT_TOKENS,
+) -> ContextWindow:
+    start = len(history)
+    tokens = 0
+    while start > 0 and len(history) - start < max_turns:
+        tokens += count_tokens(history[start - 1].message)
+        if tokens > token_budget and start < len(history):
+            break
+        start -= 1
+    through = summary.through_chat_id if summary else 0
+    older = history[:start]
+    return ContextWindow(
+        summary=summary.summary if summary else "",
+        recent=history[start:],
+        unsummarized=[c for c in older if c.id > through],
+    )
+
+
+def summary_batches(
+    unsummarized: List[Chat],
+    max_turns: int = config.CHAT_SUMMARY_BATCH_TURNS,
+    token_budget: int = config.CHAT_SUMMARY_BATCH_TOKENS,
+) -> List[List[Chat]]:
+    """
+    The turns to fold into the summary, oldest first, in batches of at most
+    `max_turns` turns and `token_budget` tokens (a longer turn is a batch of its own).
+    Turns that don't fill a batch yet are left for later.
+    """
+    batches: List[List[Chat]] = []
+    batch: List[Chat] = []
+    tokens = 0
+    for chat in unsummarized:
+        size = count_tokens(chat.message)
+        if batch and tokens + size > token_budget:
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(chat)
+        tokens += size
+        if len(batch) == max_turns:
+            batches.append(batch)
+            batch, tokens = [], 0
+    return batches
+
+
+def prompt_messages(window: ContextWindow) -> List[Chat]:
+    # turns that are waiting to be summarized are still sent verbatim so nothing is
+    # lost, except that a long backlog is cut to one summary batch of the newest ones
+    pending: List[Chat] = []
+    tokens = 0
+    for chat in reversed(window.unsummarized[-config.CHAT_SUMMARY_BATCH_TURNS :]):
+        tokens += count_tokens(chat.message)
+        if tokens > config.CHAT_SUMMARY_BATCH_TOKENS and pending:
+            break
+        pending.append(chat)
+    return pending[::-1] + window.recent
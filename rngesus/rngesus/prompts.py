@@ -1,7 +1,10 @@
+import asyncio
 import os
 import re
 import time
-from typing import AsyncIterator, Dict, List, TypeVar
+from typing import AsyncIterator, Callable, Dict, List, TypeVar
+
+from .. import metrics
 
 T = TypeVar("T")
 
@@ -20,16 +23,109 @@ def parse_comma_delimited_list(s: str) -> List[str]:
     return [re.sub("\.$", "", x.strip()) for x in s.split(",")]
 
 
+class ThrottlePolicy:
+    """
+    Decides when a streamed update is sent: once `seconds` have passed or the output
+    grew by `characters` since the last update, whichever comes first. With
+    `skip_when_slow` the source is read in the background and a slow consumer only
+    gets the most recent item instead of every intermediate one.
+    """
+
+    def __init__(
+        self,
+        seconds: float | None = 1,
+        characters: int | None = None,
+        skip_when_slow: bool = False,
+    ):
+        self.seconds = seconds
+        self.characters = characters
+        self.skip_when_slow = skip_when_slow
+
+    @classmethod
+    def parse(cls, spec: str) -> "ThrottlePolicy":
+        # e.g. "seconds=0.5,characters=200,skip_when_slow=1"
+        options = dict(part.split("=", 1) for part in spec.split(",") if part)
+        return cls(
+            seconds=float(options["seconds"]) if "seconds" in options else None,
+            characters=int(options["characters"]) if "characters" in options else None,
+            skip_when_slow=options.get("skip_when_slow", "0") not in ("0", "false", ""),
+        )
+
+    def should_emit(self, elapsed: float, grown: int) -> bool:
+        return (self.seconds is not None and elapsed >= self.seconds) or (
+            self.characters is not None and grown >= self.characters
+        )
+
+
 async def throttle(
-    iterator: AsyncIterator[T], update_frequency_seconds: int = 1
+    iterator: AsyncIterator[T],
+    update_frequency_seconds: float = 1,
+    policy: ThrottlePolicy | None = None,
+    size: Callable[[T], int] | None = None,
+    name: str = "stream",
 ) -> AsyncIterator[T]:
+    policy = policy or ThrottlePolicy(seconds=update_frequency_seconds)
+    iterator = _counted(iterator, name)
+    if policy.skip_when_slow:
+        iterator = latest(iterator, name)
     last = None
+    last_size = 0
     result = None
+    pending = False
     async for generated in iterator:
+        if pending:
+            metrics.throttle_dropped.inc(stream=name)
         result = generated
-        now = time.time()
-        if last is None or (now - last > update_frequency_seconds):
+        pending = True
+        now = time.monotonic()
+        current_size = size(generated) if size else 0
+        if last is None or policy.should_emit(now - last, current_size - last_size):
             last = now
+            last_size = current_size
+            pending = False
             yield result
-    if result:
+    if pending:
         yield result
+
+
+async def _counted(iterator: AsyncIterator[T], name: str) -> AsyncIterator[T]:
+    async for item in iterator:
+        metrics.throttle_updates.inc(stream=name)
+        yield item
+
+
+async def latest(iterator: AsyncIterator[T], name: str = "stream") -> AsyncIterator[T]:
+    # reads ahead so that items which arrive while the consumer is busy replace each
+    # other instead of queueing up
+    ready = asyncio.Event()
+    state = {"item": None, "fresh": False, "done": False, "error": None}
+
+    async def pump() -> None:
+        try:
+            async for item in iterator:
+                if state["fresh"]:
+                    metrics.throttle_dropped.inc(stream=name)
+                state["item"] = item
+                state["fresh"] = True
+                ready.set()
+        except Exception as e:
+            state["error"] = e
+        finally:
+            state["done"] = True
+            ready.set()
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            if not state["fresh"] and not state["done"]:
+                await ready.wait()
+            ready.clear()
+            if state["fresh"]:
+                state["fresh"] = False
+                yield state["item"]
+            elif state["done"]:
+                break
+        if state["error"] is not None:
+            raise state["error"]
+    finally:
+        task.cancel()
@@ -11,7 +11,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from . import rngesus
 
-from . import database
+from . import async_database, config, jobs
 from .app import app
 
 
@@ -28,19 +28,19 @@ async def landing_page(request: Request) -> str:
 
 @app.get("/game", response_class=HTMLResponse)
 async def game_screen(request: Request) -> str:
-    campaigns = database.get_campaign_summaries()
+    campaigns = await async_database.get_campaign_summaries()
     return templates.TemplateResponse(
         "game_screen.html", {"request": request, "campaigns": campaigns}
     )
 
 
 @app.post("/new_campaign", response_class=responses.RedirectResponse)
-async def new_campaign(campaign_description: Annotated[str, Form()]) -> str:
-    print(campaign_description)
-    create = rngesus.generate_campaign(campaign_description)
-    campaign = database.upsert_campaign(create)
+async def new_campaign(
+    request: Request, campaign_description: Annotated[str, Form()]
+) -> str:
+    job = await jobs.enqueue_campaign(campaign_description, owner=request.client.host)
     return RedirectResponse(
-        f"/character_list/{campaign.id}", status_code=status.HTTP_302_FOUND
+        f"/character_list/{job.campaign_id}", status_code=status.HTTP_302_FOUND
     )
 
 
@@ -51,8 +51,8 @@ async def create_campaign(request: Request) -> str:
 
 @app.get("/character_list/{campaign_id}", response_class=HTMLResponse)
 async def character_list(request: Request, campaign_id: int) -> str:
-    campaign = database.get_campaign(campaign_id)
-    characters = database.get_campaign_summaries(campaign_id)
+    campaign = await async_database.get_campaign(campaign_id)
+    characters = await async_database.get_campaign_summaries(campaign_id)
     return templates.TemplateResponse(
         "character_list.html",
         {"request": request, "characters": characters, "campaign": campaign},
@@ -61,7 +61,7 @@ async def character_list(request: Request, campaign_id: int) -> str:
 
 @app.get("/api/roll_character/{campaign_id}", response_class=Character)
 async def roll_character(campaign_id: int) -> str:
-    camp = database.get_campaign(campaign_id)
+    camp = await async_database.get_campaign(campaign_id)
     if camp is None:
         return "Campaign not found", status.HTTP_404_NOT_FOUND
     return rngesus.roll_character(camp)
@@ -77,13 +77,15 @@ async def character_creation(request: Request, campaign_id: int) -> str:
 )
 async def create_character(campaign_id: int, character: str = Form(...)) -> str:
     character = rngesus.CreateCharacter.parse_raw(character)
-    database.upsert_character(character)
+    await async_database.upsert_character(character)
     return f"/character_list/{campaign_id}"
 
 
 @app.get("/play/{campaign_id}", response_class=HTMLResponse)
 async def play_screen(request: Request, campaign_id: int) -> str:
-    chat_history = database.get_chat_history(campaign_id)
+    chat_history = await async_database.get_chat_page(
+        campaign_id, limit=config.CHAT_PAGE_SIZE, tail=True
+    )
     return templates.TemplateResponse(
         "play_screen.html", {"request": request, "chat_history": chat_history}
     )
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from rngesus.rngesus import campaign
+
+
+class FakeSection:
+    """Answers every section at once, except `failing`, which raises."""
+
+    def __init__(self, failing: str):
+        self.failing = failing
+
+    async def _answer(self, question: str):
+        await asyncio.sleep(0)
+        if question == campaign.SECTIONS[self.failing].question:
+            raise RuntimeError("section failed")
+        yield {"answer": "an answer"}
+
+    def stream(self, question: str, **kwargs):
+        return self._answer(question)
+
+
+async def generate() -> None:
+    async for _ in campaign.generate_sections_raw("a game", {}):
+        pass
+
+
+@pytest.mark.parametrize("failing", ["title", "story", "summary"])
+def test_failed_section_raises_and_leaves_no_tasks(monkeypatch, failing):
+    monkeypatch.setattr(campaign, "gen_campaign_section", FakeSection(failing))
+
+    async def run() -> set:
+        with pytest.raises(RuntimeError, match="section failed"):
+            await asyncio.wait_for(generate(), 5)
+        return asyncio.all_tasks() - {asyncio.current_task()}
+
+    assert asyncio.run(run()) == set()
+
+
+def test_given_sections_are_kept_and_the_rest_generated(monkeypatch):
+    # the title is given, so the section that would fail is never generated
+    monkeypatch.setattr(campaign, "gen_campaign_section", FakeSection("title"))
+
+    async def run() -> dict:
+        async for values in campaign.generate_sections_raw(
+            "a game", {"title": "Skyward"}
+        ):
+            pass
+        return values
+
+    values = asyncio.run(run())
+    assert values.pop("title") == "Skyward"
+    assert set(values.values()) == {"an answer"}
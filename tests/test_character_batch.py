@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from rngesus import config, game
+from rngesus.models import Campaign, Character
+
+ROLES = [("Fighter", "Human"), ("Wizard", "Elf"), ("Rogue", "Halfling")]
+
+
+class FakeRoller:
+    """Rolls every class slowly, except `failing`, which raises."""
+
+    def __init__(self, failing: str):
+        self.failing = failing
+        self.closed = []
+
+    async def __call__(self, campaign, party, character_class=None, character_type=None):
+        try:
+            await asyncio.sleep(0)
+            if character_class == self.failing:
+                raise RuntimeError("roll failed")
+            yield Character(
+                campaign_id=campaign.id,
+                name=None,
+                character_class=character_class,
+                character_type=character_type,
+                backstory="",
+                attributes={},
+                primary_goal="",
+                inventory=[],
+            )
+            await asyncio.sleep(60)
+        finally:
+            self.closed.append(character_class)
+
+
+@pytest.mark.parametrize("failing", ["Fighter", "Rogue"])
+def test_failed_roll_raises_and_leaves_no_tasks(monkeypatch, failing):
+    roller = FakeRoller(failing)
+    monkeypatch.setattr(game.rngesus, "roll_character", roller)
+    monkeypatch.setattr(
+        game.rngesus, "assign_roles", lambda campaign, characters, count: ROLES
+    )
+    monkeypatch.setattr(config, "CHARACTER_BATCH_CONCURRENCY", len(ROLES))
+
+    async def generate() -> None:
+        campaign = Campaign(id=1, title="Skyward")
+        async for _ in game._generate_characters(campaign, [], len(ROLES)):
+            pass
+
+    async def run() -> set:
+        with pytest.raises(RuntimeError, match="roll failed"):
+            await asyncio.wait_for(generate(), 5)
+        return asyncio.all_tasks() - {asyncio.current_task()}
+
+    assert asyncio.run(run()) == set()
+    # the slots still rolling were stopped rather than left to finish
+    assert sorted(roller.closed) == sorted(role for role, _ in ROLES)
@@ -0,0 +1,127 @@
+"""
+What happens to a chat reply when its client leaves halfway through: under "abort" the
+LLM stream is closed once the grace period is over, under "finish" the reply is still
+written and saved in full.
+"""
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+
+import pytest
+from sqlmodel import SQLModel
+
+from rngesus import config, database, game, generations, migrations, retrieval
+from rngesus.models import Campaign, Character
+from rngesus.rngesus import chat
+
+WORDS = 50
+SECONDS_PER_WORD = 0.02
+GRACE_SECONDS = 0.1
+MARGIN_SECONDS = 0.2
+
+
+class FakeChatProgram:
+    """Streams a reply of WORDS words, a word at a time, like Program.stream."""
+
+    def __init__(self):
+        self.open = False
+        self.closed_at: float | None = None
+
+    async def _reply(self):
+        self.open = True
+        try:
+            for n in range(1, WORDS + 1):
+                await asyncio.sleep(SECONDS_PER_WORD)
+                yield {"next": " ".join(["word"] * n)}
+        finally:
+            self.open = False
+            self.closed_at = time.monotonic()
+
+    def stream(self, **kwargs):
+        return self._reply()
+
+
+@pytest.fixture
+def campaign_id(tmp_path, monkeypatch) -> int:
+    engine = database.create_database_engine(f"sqlite:///{tmp_path / 'chat.db'}")
+    SQLModel.metadata.create_all(engine)
+    migrations.migrate(engine)
+    monkeypatch.setattr(database, "engine", engine)
+    # the caches are keyed by campaign id, which starts again at 1 here
+    chat_states = game.ChatStateCache()
+    monkeypatch.setattr(game, "chat_states", chat_states)
+    monkeypatch.setattr(game, "system_prompts", OrderedDict())
+    monkeypatch.setattr(retrieval, "indexes", {})
+    monkeypatch.setattr(retrieval, "loaded", OrderedDict())
+    monkeypatch.setattr(
+        database, "listeners", [chat_states.on_change, retrieval.on_change]
+    )
+    monkeypatch.setattr(config, "GENERATION_ABORT_GRACE_SECONDS", GRACE_SECONDS)
+    campaign = database.upsert_campaign(
+        Campaign(
+            prompt="a heist in a floating city",
+            title="Skyward",
+            description="A heist game.",
+            summary="A heist game.",
+            character_classes=["Thief"],
+            character_types=["Human"],
+            attributes=["Agility"],
+            # a scenario means the reply is the only thing the program generates
+            scenario="Rob the sky bank.",
+        )
+    )
+    database.upsert_character(
+        Character(
+            campaign_id=campaign.id,
+            name="Vex",
+            character_class="Thief",
+            character_type="Human",
+            backstory="Grew up on the docks.",
+            attributes={"Agility": 15},
+            primary_goal="Get rich",
+            inventory=[],
+            activated=1,
+        )
+    )
+    yield campaign.id
+    engine.dispose()
+
+
+async def leave_after_first_update(
+    campaign_id: int, program: FakeChatProgram
+) -> generations.Generation:
+    generation = game.respond_to_chat(campaign_id, "I pick the lock")
+    updates = generation.subscribe()
+    await updates.__anext__()
+    assert program.open
+    # the client disconnects
+    await updates.aclose()
+    return generation
+
+
+@pytest.mark.parametrize("policy", ["abort", "finish"])
+def test_client_leaving_mid_reply(monkeypatch, campaign_id, policy):
+    # the policy is read from the config when the module is imported
+    start = functools.partial(generations.start, on_disconnect=policy)
+    monkeypatch.setattr(generations, "start", start)
+    program = FakeChatProgram()
+    monkeypatch.setattr(chat, "gen_chat", program)
+
+    async def run() -> tuple:
+        generation = await leave_after_first_update(campaign_id, program)
+        left = time.monotonic()
+        await asyncio.wait([generation.task], timeout=WORDS * SECONDS_PER_WORD + 5)
+        return generation, left
+
+    generation, left = asyncio.run(run())
+    reply = database.get_chat_history(campaign_id)[-1]
+    assert reply.user_type == "assistant"
+    if policy == "abort":
+        assert generation.aborted
+        assert program.closed_at - left <= GRACE_SECONDS + MARGIN_SECONDS
+        # what was written before the abort is kept
+        assert 0 < len(reply.message.split()) < WORDS
+    else:
+        assert not generation.aborted and generation.error is None
+        assert reply.message == " ".join(["word"] * WORDS)
@@ -0,0 +1,40 @@
+import asyncio
+from typing import AsyncIterator, List
+
+from rngesus import generations
+
+
+async def numbers(gate: asyncio.Event) -> AsyncIterator[int]:
+    # 0..4 straight away, then 5..9 once the gate opens
+    for i in range(10):
+        if i == 5:
+            await gate.wait()
+        yield i
+
+
+async def follow(snapshots: bool, offset: int | None) -> List[int]:
+    gate = asyncio.Event()
+    generation = generations.Generation(None, numbers(gate), snapshots=snapshots)
+    while generation.count < 5:
+        await asyncio.sleep(0)
+    seen = []
+    async for item in generation.subscribe(offset):
+        seen.append(item)
+        if item == 4 or (offset is None and len(seen) == 1):
+            # the subscriber is slow: the rest is produced before it reads again
+            gate.set()
+            while not generation.done:
+                await asyncio.sleep(0)
+    return seen
+
+
+def test_new_subscriber_starts_at_the_latest_snapshot():
+    assert asyncio.run(follow(True, None)) == [4, 9]
+
+
+def test_resume_replays_what_was_missed_then_skips_to_the_latest():
+    assert asyncio.run(follow(True, 2)) == [2, 3, 4, 9]
+
+
+def test_updates_are_all_delivered():
+    assert asyncio.run(follow(False, 2)) == [2, 3, 4, 5, 6, 7, 8, 9]
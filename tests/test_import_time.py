@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+
+# the LLM libraries are only imported once something generates text
+LAZY = ["guidance", "openai", "tiktoken"]
+BUDGET_SECONDS = 1.0
+RUNS = 3
+
+CHECK = f"""
+import json, sys, time
+start = time.perf_counter()
+import rngesus.app
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [m for m in {LAZY!r} if m in sys.modules]]))
+"""
+
+
+def import_app() -> tuple:
+    env = {k: v for k, v in os.environ.items() if k != "OPENAI_API_KEY"}
+    out = subprocess.run(
+        [sys.executable, "-c", CHECK],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    seconds, loaded = json.loads(out.stdout.splitlines()[-1])
+    return seconds, loaded
+
+
+def test_app_imports_quickly_without_the_llm_libraries():
+    runs = [import_app() for _ in range(RUNS)]
+    for _, loaded in runs:
+        assert loaded == []
+    # the fastest run, since the others include a cold disk cache or a busy machine
+    assert min(seconds for seconds, _ in runs) < BUDGET_SECONDS
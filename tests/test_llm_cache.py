@@ -0,0 +1,100 @@
+import asyncio
+from typing import Any, Dict, List
+
+import guidance
+import pytest
+import tiktoken
+
+from rngesus import config, llm, llm_cache, metrics, openai_llm
+
+
+class Encoding:
+    # stands in for tiktoken's, which is downloaded on first use
+    name = "words"
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        return list(range(len(text.split())))
+
+    def decode(self, tokens: List[int]) -> str:
+        return ""
+
+
+class FakeOpenAI:
+    """The OpenAI completion API, answering "Hello" and counting its calls."""
+
+    def __init__(self):
+        self.calls: List[Dict[str, Any]] = []
+
+    def __call__(self, **kwargs) -> Any:
+        self.calls.append(kwargs)
+        if kwargs["stream"]:
+            return iter(
+                [
+                    {"choices": [{"text": "Hel", "finish_reason": None, "index": 0}]},
+                    {"choices": [{"text": "lo", "finish_reason": "stop", "index": 0}]},
+                ]
+            )
+        return {"choices": [{"text": "Hello", "finish_reason": "stop", "index": 0}]}
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch) -> FakeOpenAI:
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: Encoding())
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model: Encoding())
+    # installed by llm.configure the way the app does, with the cache in tmp_path
+    cache = llm_cache.LLMCache
+    monkeypatch.setattr(
+        llm_cache, "LLMCache", lambda: cache(path=str(tmp_path / "llm_cache.db"))
+    )
+    monkeypatch.setattr(openai_llm.ScheduledOpenAI, "_cache", None)
+    monkeypatch.setattr(guidance, "llm", None)
+    monkeypatch.setattr(llm, "_configured", False)
+    monkeypatch.setattr(config, "LLM_BACKEND", "openai")
+    monkeypatch.setattr(config, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(config, "OPENAI_MODEL", "text-davinci-003")
+    monkeypatch.setattr(config, "LLM_CACHE", True)
+    monkeypatch.setattr(metrics, "collectors", [])
+    llm.configure()
+    api = FakeOpenAI()
+    guidance.llm._unscheduled_caller = api
+    api.llm = guidance.llm
+    return api
+
+
+def complete(api: FakeOpenAI, **kwargs) -> str:
+    async def call() -> str:
+        out = await api.llm.session(asynchronous=True)("Say hi", max_tokens=5, **kwargs)
+        if isinstance(out, dict):
+            out = [out]
+        return "".join(chunk["choices"][0]["text"] for chunk in out)
+
+    return asyncio.run(call())
+
+
+def test_sampled_calls_are_counted_as_bypassed_once(api):
+    assert complete(api, temperature=1) == "Hello"
+    assert complete(api, temperature=1) == "Hello"
+    assert len(api.calls) == 2
+    assert api.llm.cache.stats["bypassed"] == 2
+    assert api.llm.cache.stats["hits"] == 0
+
+
+def test_repeated_call_is_a_hit(api):
+    assert complete(api, temperature=0) == "Hello"
+    assert complete(api, temperature=0) == "Hello"
+    assert len(api.calls) == 1
+    assert api.llm.cache.stats["hits"] >= 1
+
+
+def test_streamed_call_is_cached(api):
+    assert complete(api, temperature=0, stream=True) == "Hello"
+    assert complete(api, temperature=0, stream=True) == "Hello"
+    assert len(api.calls) == 1
+    assert api.llm.cache.stats["hits"] >= 1
+    assert api.llm.cache.summary()["entries"] == 1
+
+
+def test_sampled_streamed_calls_are_counted_as_bypassed_once(api):
+    assert complete(api, temperature=1, stream=True) == "Hello"
+    assert len(api.calls) == 1
+    assert api.llm.cache.stats["bypassed"] == 1
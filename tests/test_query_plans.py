@@ -0,0 +1,91 @@
+"""
+The hot chat and party queries must keep using the indexes added by the migrations,
+rather than scanning `chat` or `character` as the history grows.
+"""
+from typing import List, Tuple
+
+import pytest
+from sqlalchemy import event, text
+from sqlmodel import SQLModel
+
+from rngesus import database, migrations
+
+
+@pytest.fixture
+def statements(tmp_path, monkeypatch) -> List[Tuple[str, tuple]]:
+    engine = database.create_database_engine(f"sqlite:///{tmp_path / 'plans.db'}")
+    SQLModel.metadata.create_all(engine)
+    migrations.migrate(engine)
+    monkeypatch.setattr(database, "engine", engine)
+    seen: List[Tuple[str, tuple]] = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany) -> None:
+        if statement.lstrip().upper().startswith("SELECT"):
+            seen.append((statement, parameters))
+
+    yield seen
+    engine.dispose()
+
+
+def plan(statement: str, parameters: tuple) -> List[str]:
+    with database.engine.connect() as connection:
+        cursor = connection.connection.cursor()
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[3] for row in cursor.fetchall()]
+
+
+def only_plan(statements: List[Tuple[str, tuple]], call) -> List[str]:
+    statements.clear()
+    call()
+    assert len(statements) == 1
+    return plan(*statements[0])
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        pytest.param(lambda: database.get_chat_history(1), id="history"),
+        pytest.param(lambda: database.get_chat_page(1, before_id=50), id="page"),
+        pytest.param(lambda: database.get_chat_page(1, after_id=50), id="page-after"),
+        pytest.param(lambda: database.get_chat_page(1, tail=True), id="tail"),
+        pytest.param(lambda: database.get_latest_chat_version(1), id="latest"),
+    ],
+)
+def test_chat_queries_use_campaign_index(statements, query):
+    steps = only_plan(statements, query)
+    assert any("USING INDEX ix_chat_campaign_id_id" in step for step in steps), steps
+    assert not any(step.startswith("SCAN chat") for step in steps), steps
+    assert not any("TEMP B-TREE" in step for step in steps), steps
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        pytest.param(lambda: database.get_active_characters_in_campaign(1), id="rows"),
+        pytest.param(lambda: database.get_active_character_prompts(1), id="prompts"),
+    ],
+)
+def test_active_party_uses_activated_index(statements, query):
+    steps = only_plan(statements, query)
+    assert any(
+        "USING INDEX ix_character_campaign_id_activated" in step for step in steps
+    ), steps
+    assert not any(step.startswith("SCAN character") for step in steps), steps
+
+
+def test_summary_lookup_uses_primary_key(statements):
+    steps = only_plan(statements, lambda: database.get_chat_summary(1))
+    assert steps == ["SEARCH chatsummary USING INTEGER PRIMARY KEY (rowid=?)"]
+
+
+def test_migrations_are_recorded(statements):
+    with database.engine.connect() as connection:
+        assert migrations.current_version(connection) == migrations.MIGRATIONS[-1][0]
+        indexes = {
+            row[0]
+            for row in connection.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'index'")
+            )
+        }
+    assert {"ix_chat_campaign_id_id", "ix_character_campaign_id_activated"} <= indexes
@@ -0,0 +1,105 @@
+"""
+A campaign that already has a long history is summarized in bounded batches, and its
+prompt stays bounded while the backlog is worked through.
+"""
+import asyncio
+from typing import List
+
+from rngesus import config, game
+from rngesus.models import Campaign, Chat, ChatSummary
+from rngesus.rngesus import (
+    build_window,
+    count_tokens,
+    prompt_messages,
+    summary_batches,
+)
+
+TURNS = 500
+
+
+def history() -> List[Chat]:
+    words = "the dragon keeps its hoard under the old harbor bridge".split()
+    return [
+        Chat(
+            id=i + 1,
+            campaign_id=1,
+            user_type="user" if i % 2 else "assistant",
+            message=" ".join(words[(i + n) % len(words)] for n in range(150)),
+        )
+        for i in range(TURNS)
+    ]
+
+
+def tokens(chats: List[Chat]) -> int:
+    return sum(count_tokens(chat.message) for chat in chats)
+
+
+def test_prompt_is_bounded_while_a_backlog_waits():
+    window = build_window(history(), None)
+    assert len(window.unsummarized) > 10 * config.CHAT_SUMMARY_BATCH_TURNS
+    messages = prompt_messages(window)
+    assert messages[-len(window.recent) :] == window.recent
+    assert len(messages) <= len(window.recent) + config.CHAT_SUMMARY_BATCH_TURNS
+    budget = config.CHAT_CONTEXT_TOKENS + config.CHAT_SUMMARY_BATCH_TOKENS
+    assert tokens(messages) <= budget
+
+
+def test_batches_are_bounded_and_leave_a_partial_batch():
+    chats = history()[: 3 * config.CHAT_SUMMARY_BATCH_TURNS + 2]
+    batches = summary_batches(chats, max_turns=8, token_budget=600)
+    folded = [chat for batch in batches for chat in batch]
+    assert folded == chats[: len(folded)]
+    for batch in batches:
+        assert len(batch) <= 8
+        assert len(batch) == 1 or tokens(batch) <= 600
+    assert len(chats) - len(folded) < 8
+
+
+def test_long_history_is_summarized_batch_by_batch(monkeypatch):
+    dialog = history()
+    calls = []
+    saved: List[ChatSummary] = []
+
+    async def load_chat_state(campaign_id: int) -> game.ChatState:
+        return game.ChatState(
+            campaign=Campaign(id=1, title="Skyward"),
+            characters=[],
+            dialog=dialog,
+            summary=saved[-1] if saved else None,
+        )
+
+    async def summarize_history(campaign, summary: str, messages: List[Chat]) -> str:
+        calls.append((summary, messages))
+        return f"summary through {messages[-1].id}"
+
+    async def upsert_chat_summary(summary: ChatSummary) -> ChatSummary:
+        saved.append(summary)
+        return summary
+
+    monkeypatch.setattr(game, "load_chat_state", load_chat_state)
+    monkeypatch.setattr(game.rngesus, "summarize_history", summarize_history)
+    monkeypatch.setattr(
+        game.async_database, "upsert_chat_summary", upsert_chat_summary
+    )
+    asyncio.run(game._summarize_history(1))
+
+    assert len(calls) > 10
+    for summary, messages in calls:
+        assert len(messages) <= config.CHAT_SUMMARY_BATCH_TURNS
+        assert len(messages) == 1 or (
+            tokens(messages) <= config.CHAT_SUMMARY_BATCH_TOKENS
+        )
+    # each batch follows on from the last and builds on its summary
+    assert calls[0][0] == ""
+    for (_, previous), (summary, messages) in zip(calls, calls[1:]):
+        assert messages[0].id == previous[-1].id + 1
+        assert summary == f"summary through {previous[-1].id}"
+    through = [summary.through_chat_id for summary in saved]
+    assert through == sorted(through) and len(set(through)) == len(through)
+
+    # what is left is less than a batch, so the next reply doesn't summarize again
+    window = build_window(dialog, saved[-1])
+    assert len(window.unsummarized) < config.CHAT_SUMMARY_BATCH_TURNS
+    calls.clear()
+    asyncio.run(game._summarize_history(1))
+    assert calls == []